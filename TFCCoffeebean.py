@@ -1,56 +1,39 @@
 from stagemovers import StageMover, StageGridMover, StageCalibrator
+from adaptivescan import AdaptiveGridScanner
 import logging
 from datetime import datetime
 import os
-from fakeenvironment import FakeTFC
+import queue
+import time
+from collections import deque
+from fakeenvironment import FakeTFC, Simulation
 import numpy as np
-import matplotlib.pyplot as plt
 from settings import get_settings
-from logger_settings import configure_logger, create_folder_if_not_exists
-
-# Dependencies for Teraflash
-import sys
-sys.path.append("C:\\terasoft\\")
-from Devices.Data.ReadWriteData import Data
-from Devices.TeraFlashClient import TeraFlashClient, State
-import threading
-from Devices.TeraFlashClient.Pulse import TFPulse
-
+from logger_settings import ScanLog, configure_logger, create_folder_if_not_exists
+from pulsestore import PulseStore
+from scanwriter import ScanWriter
+from acquisition import AdaptiveAverager, TraceHub, TraceRecorder
+from tracefeatures import featurize_store, load_features
+from beanmask import BeanMask, MASK_FILE, MASK_SUFFIX
+from tracecodec import pack_store, unpack_store
+from scanmetrics import ScanMetrics, METRICS_SUFFIX
+from scanjournal import ScanJournal, save_scan, load_scan
+from scanindex import BACKGROUND_PREFIX
+
+# Live plot range on the scale of TFPulse.energy(), averaged pulses are rescaled to it (see arraypulse.ArrayPulse).
+# Simulated pulses have sum(E^2) dt as energy, about 800 in the open beam with the default simulation settings.
 PLOT_MAXIMUM_ENERGY = 6000
 PLOT_MINIMUM_ENERGY = 0
 
 
-class TFC(TeraFlashClient):
-    def __init__(self, teraflash_settings):
-        super().__init__(teraflash_settings["toptica_IP"])
-        self.teraflash_settings = teraflash_settings
-
-    def connect_teraflash(self):
-        logging.info(f"Connecting...")
-        connection_result = self.connect()
-        logging.info(f"Connected")
-        return connection_result
-
-    def start_laser(self):
-        self.set_averaging(self.teraflash_settings["TFC_AVERAGING"])
-        if self.teraflash_settings["TRANSFER"] == "block":
-            self.set_block_transfer()
-        else:
-            self.set_sliding_transfer()
-        self.set_begin(self.teraflash_settings["TFC_BEGIN"])
-        self.set_range(self.teraflash_settings["TFC_RANGE"])
-        self.start(wait=True)
-        logging.info("Connected and started the laser")
-
-    def get_corrected_pulse(self):
-        pulse = self.get_next_trace()
-        offset = pulse.E()[0:10].mean()
-        pulse.subtract_offset(offset)
-        return pulse
-
-        
 class MeasurementPlotter:
-    def __init__(self, settings: dict):
+    """
+    Live image of the measured energies. Without live the values are only collected in image_data
+    and matplotlib is never imported, for headless scans.
+    """
+
+    def __init__(self, settings: dict, live: bool = True):
+        self.live = live
         self.width = int(settings["stagegridmover"]["x_n"]) # width
         self.height = int(settings["stagegridmover"]["y_n"]) # height
         self.x_max = settings["stagegridmover"]["x_max"]
@@ -58,12 +41,21 @@ class MeasurementPlotter:
         self.y_max = settings["stagegridmover"]["y_max"]
         self.y_min= settings["stagegridmover"]["y_min"]
 
+        # Grid positions map linearly onto pixels, so a position is converted with one multiply instead of a search
+        self.x_scale = (self.width - 1) / (self.x_max - self.x_min) if self.width > 1 and self.x_max != self.x_min else 0.
+        self.y_scale = (self.height - 1) / (self.y_max - self.y_min) if self.height > 1 and self.y_max != self.y_min else 0.
+
         self.image_data = np.zeros((self.width, self.height))
         self.batch_number = 5
-        self.batch_iteratator = 0
-        self.values = []
+        self.values = deque()  # (measurement, x pixel, y pixel), appended by the scan, consumed by draw_pending
+        self.background = None
+        self.im = None
 
     def create_plot(self):
+        if not self.live:
+            return
+        import matplotlib.pyplot as plt
+
         plt.ion()  # Enable interactive mode
         self.fig, self.ax = plt.subplots()
         self.im = self.ax.imshow(self.image_data, cmap='viridis', interpolation='nearest',
@@ -73,38 +65,89 @@ class MeasurementPlotter:
         self.ax.set_xlabel('X-axis')
         self.ax.set_ylabel('Y-axis')
         plt.show()
-
-    def update_plot(self, new_values):
-        self.batch_iteratator += 1
-        self.values.append([new_values[0], new_values[1]])
-        if self.batch_iteratator % self.batch_number != 0:
+        if self.fig.canvas.supports_blit:
+            # Redraws only blit the image onto a cached background, the axes, labels and colorbar are not redrawn
+            self.im.set_animated(True)
+            self.fig.canvas.mpl_connect("draw_event", self._cache_background)
+            self.fig.canvas.draw()
+
+    def _cache_background(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.im)
+
+    def pixel_of(self, position) -> tuple:
+        x_pixel = int(round((position[0] - self.x_min) * self.x_scale))
+        y_pixel = int(round((position[1] - self.y_min) * self.y_scale))
+        return min(max(x_pixel, 0), self.width - 1), min(max(y_pixel, 0), self.height - 1)
+
+    def update_plot(self, new_values, grid_index=None):
+        self.add_value(new_values, grid_index)
+        self.draw_pending()
+
+    def add_value(self, new_values, grid_index=None):
+        """
+        Buffers a [measurement, position] pair without drawing, safe to call from a processing thread.
+        If the grid index of the point is given, its x and y index are used as pixel directly.
+        """
+        if grid_index is None:
+            x_pixel, y_pixel = self.pixel_of(new_values[1])
+        else:
+            x_pixel, y_pixel = grid_index[0], grid_index[1]
+        self.values.append((new_values[0], x_pixel, y_pixel))
+
+    def draw_pending(self):
+        """
+        Draws the buffered values once a full batch is waiting. Must be called from the thread that owns the figure.
+        """
+        pending = len(self.values)
+        if pending < self.batch_number:
             return
-        
-        x_coords = np.linspace(self.x_min, self.x_max, self.width)
-        y_coords = np.linspace(self.y_min, self.y_max, self.height)
-
-        for value in self.values:
-            measurement, [x_pos, y_pos, _] = value
-
-            # Interpolate positions to map to image grid
-            x_pixel = np.argmin(np.abs(x_coords - x_pos))
-            y_pixel = np.argmin(np.abs(y_coords - y_pos))
 
-            if 0 <= x_pixel < self.width and 0 <= y_pixel < self.height:
-                self.image_data[x_pixel, y_pixel] = measurement
-
-        self.values = []
+        measurements, x_pixels, y_pixels = zip(*(self.values.popleft() for _ in range(pending)))
+        self.image_data[list(x_pixels), list(y_pixels)] = measurements
+        if self.im is None:
+            return
 
         # Update the displayed image
         self.im.set_data(self.image_data)
-        self.fig.canvas.draw()
+        if self.background is not None:
+            self.fig.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.im)
+            self.fig.canvas.blit(self.ax.bbox)
+        else:
+            self.fig.canvas.draw_idle()
         self.fig.canvas.flush_events()
 
+    def show(self, image=None):
+        """
+        Shows the final image (image_data, or the given image) and keeps the window open until it is closed.
+        """
+        if image is not None:
+            self.image_data = image
+        if self.im is None:
+            return
+        import matplotlib.pyplot as plt
+
+        self.im.set_data(self.image_data)
+        plt.ioff()  # Turn off interactive mode to keep the plot open after the program finishes
+        plt.show()
+
 
 class TFCCoffeeBean:
-    def __init__(self, settings):
+    def __init__(self, settings, simulation: Simulation = None):
+        """
+        With a simulation, or settings["simulation"]["enabled"], the TeraFlash and the stages are simulated.
+        """
         self.settings = settings
-        self.teraflash = TFC(self.settings["teraflash"])
+        self.simulation = simulation
+        if self.simulation is None and self.settings["simulation"]["enabled"]:
+            self.simulation = Simulation(self.settings["simulation"], self.settings["teraflash"])
+        if self.simulation is None:
+            from teraflash import TFC  # imports the TeraFlash driver, only needed for the real device
+
+            self.teraflash = TFC(self.settings["teraflash"])
+        else:
+            self.teraflash = self.simulation.teraflash
         self.stagemover = StageMover(self.settings["stagemover"])
         logging.debug(f"Settings: {self.settings}")
 
@@ -115,52 +158,207 @@ class TFCCoffeeBean:
         self.measurement_savepath = os.path.join(self.measurement_savefolder, self.settings["general"]["measurement_name"])
         self.measurement_savepath_screen = os.path.join(self.measurement_savefolder, self.settings["general"]["measurement_name_screen"])
         logging.debug(f"Savepaths: {self.measurement_savepath}, {self.measurement_savepath_screen}")
-        self.pulse_db = []
-        self.temp_pulse_db = []
+        self.pulse_store = PulseStore(os.path.join(self.measurement_savefolder_pulses, f"{self.settings['general']['pulse_store_name']}-manual"))
+        self.scan_cube = None
+        self.scan_journal = None
+        self.scan_writer = None
         self.plot_batch_counter = 0
-        self.current_trace = None
-
-
-        self.save_pulse_file_name = "C:\\Users\\20192137\\Documents\\THz-coffee-bean\\measurements\\pulses"
-
-
-    def save_pulse(self, pulse):
-        dat = Data(pulse=pulse)
-        dat.save(self.save_pulse_file_name)
-        logging.info(f'pulse saved to: {dat.filename}')
-        return dat.filename
-
-
-    def measurement_thread(self):
-        self.stopped = False
-        while not self.stopped:
-            if self.teraflash.running():
-                self.current_trace = self.teraflash.get_corrected_pulse()
-
+        self.trace_hub = TraceHub(self.teraflash)
+        self.scan_subscription = None
+        self.recorder = None
+        self.metrics = ScanMetrics(self.settings["general"]["scan_metrics"])
+        self.averager = None
+        self.bean_mask = None  # of the last screening, restricts the next grid scan
+
+    def create_scan_cube(self, store_name, grid_shape):
+        """
+        Creates a new scan cube for a grid run, numbering the folder if a previous run already used the name.
+        """
+        folder = os.path.join(self.measurement_savefolder_pulses, store_name)
+        run = 1
+        while os.path.exists(folder):
+            run += 1
+            folder = os.path.join(self.measurement_savefolder_pulses, f"{store_name}-{run}")
+        logging.info(f"Saving grid {grid_shape} to scan cube {folder}")
+        return PulseStore(folder, grid_shape=grid_shape)
+
+    def save_pulse(self, pulse, position=None, timestamp=None, grid_index=None):
+        """
+        Stores the pulse in the scan cube at grid_index, or appends it to the manual pulse store when no grid index is given.
+        Returns the reference of the stored trace.
+        """
+        if grid_index is None:
+            store = self.pulse_store
+            row = store.append(pulse, position, timestamp)
+        else:
+            store = self.scan_cube
+            row = store.write_at(grid_index, pulse, position, timestamp)
+        pulse_reference = store.reference(row)
+        logging.debug(f'pulse saved to: {pulse_reference}')
+        return pulse_reference
+
+    def start_scan_writer(self):
+        general_settings = self.settings["general"]
+        self.scan_writer = ScanWriter(general_settings["writer_queue_size"], general_settings["writer_flush_interval"],
+                                      metrics=self.metrics)
+        return self.scan_writer.start()
+
+    def stop_scan_writer(self):
+        """
+        Waits for the scan writer to persist everything that was queued, then closes the scan cube
+        and stores the features of all its traces next to it.
+        """
+        try:
+            self.scan_writer.close()
+        finally:
+            self.scan_cube.close()
+        if self.scan_cube.count > 0:
+            featurize_store(self.scan_cube.folder)
+
+    def create_bean_mask(self, info_path):
+        """
+        Bean mask of the screening scan that just ended, saved next to its info file as <info name>_mask.npz.
+        """
+        if self.scan_cube.count == 0:
+            return None
+        energy = load_features(self.scan_cube.folder)["energy"].reshape(self.scan_cube.grid_shape)
+        bean_mask = BeanMask(energy, self.stagegridmover.grid_axes(), self.settings["masked_scan"])
+        bean_mask.save(os.path.splitext(info_path)[0] + MASK_SUFFIX)
+        return bean_mask
+
+    def masked_grid(self):
+        """
+        Grid points of the current grid scan to measure: the bean mask of the last screening on this grid,
+        or None for all points (no screening, masked_scan disabled or nothing found).
+        """
+        if self.bean_mask is None or not self.settings["masked_scan"]["enabled"]:
+            return None
+        mask = self.bean_mask.on_grid(self.stagegridmover.grid_axes())
+        if not mask.any():
+            logging.warning(f"Bean mask of the screening is empty, scanning the full grid")
+            return None
+        logging.info(f"Masked scan: {int(mask.sum())} of {mask.size} grid points, the others are background")
+        return mask
+
+    def index_background_points(self, mask):
+        """
+        Writes a line with the background energy of the screening to the info file for every grid point the
+        masked scan skips, so the analysis of the scan sees open beam there instead of a hole in the grid.
+        """
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        axes = self.stagegridmover.grid_axes()
+        with open(self.measurement_savepath, 'a') as file:
+            for i, j, k in np.argwhere(~mask):
+                file.write(f"{current_time}_{BACKGROUND_PREFIX}{self.bean_mask.background}_{axes[0][i]},{axes[1][j]},{axes[2][k]}\n")
+
+    def create_scan_log(self, info_path):
+        """
+        Per-point record of a grid run next to its info file, <info name>_scanlog.csv.
+        """
+        return ScanLog(os.path.splitext(info_path)[0] + "_scanlog.csv", StageGridMover.SCAN_LOG_COLUMNS)
+
+    def save_metrics(self, info_path):
+        """
+        Summarizes the phase timings of the scan that just ended and saves them next to its info file.
+        """
+        if self.metrics.enabled and self.metrics.durations:
+            self.metrics.summary()
+            self.metrics.save(os.path.splitext(info_path)[0] + METRICS_SUFFIX)
+
+
+    def next_pulse(self):
+        """
+        First corrected pulse acquired after this call, or with an averager the average of the pulses acquired
+        after this call until it reaches its SNR target.
+        """
+        pulses = self.pulses()
+        if self.averager is None:
+            return next(pulses)
+        return self.averager.average(pulses)
+
+    def pulses(self):
+        """
+        Corrected pulses acquired after this call, one after the other. They come from the trace hub, or straight
+        from the TeraFlash when the hub was not started.
+        Timed as "settle" (waiting for the first trace that started after this call), "acquire" and "offset".
+        """
+        if self.scan_subscription is None:
+            while True:
+                with self.metrics.phase("acquire"):
+                    pulse = self.teraflash.get_corrected_pulse()
+                self._simulate_trace_wait()
+                yield pulse
+        requested = time.time()
+        trace = self._get_trace_after(requested)
+        self.metrics.record("settle", trace.timestamp - requested)
+        while True:
+            self.metrics.record("acquire", trace.acquire_time)
+            self.metrics.record("offset", trace.offset_time)
+            self._simulate_trace_wait()
+            yield trace.pulse
+            trace = self._get_trace_after(trace.timestamp)
+
+    def _get_trace_after(self, timestamp):
+        """
+        Waits for the first trace acquired after timestamp, at most two averaged trace times plus trace_timeout.
+        """
+        teraflash_settings = self.settings["teraflash"]
+        timeout = 2 * self.teraflash.averaging * teraflash_settings["trace_time"] + teraflash_settings["trace_timeout"]
+        try:
+            return self.scan_subscription.get_after(timestamp, timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No THz trace within {timeout:.1f} s, is the TeraFlash acquiring?") from None
+
+    def _simulate_trace_wait(self):
+        # The simulated TeraFlash charges its hardware time to the scan taking the trace, not to the trace hub
+        if self.simulation is not None:
+            self.teraflash.wait_for_trace()
+
+    def create_averager(self):
+        """
+        AdaptiveAverager for a grid or adaptive scan if settings["averaging"]["adaptive"] is set, otherwise None.
+        """
+        if not self.settings["averaging"]["adaptive"]:
+            return None
+        return AdaptiveAverager(self.settings["averaging"])
+
+    def start_recording(self):
+        """
+        Records every trace the TeraFlash delivers into a separate pulse store, until stop_recording.
+        """
+        folder = os.path.join(self.measurement_savefolder_pulses, f"{datetime.now().strftime('%H-%M-%S')}-recording")
+        self.recorder = TraceRecorder(self.trace_hub, PulseStore(folder)).start()
+        logging.info(f"Recording all traces to {folder}")
+
+    def stop_recording(self):
+        self.recorder.stop()
+        self.recorder = None
 
     def connect_teraflash(self):
         try:
             connection_info = self.teraflash.connect_teraflash()
             self.teraflash.start_laser()
             logging.debug(f"Teraflash connection info: \n {connection_info}")
-            logging.debug(f"Starting measurement thread")
-            measure_thread = threading.Thread(target=self.measurement_thread)
-            measure_thread.daemon = True
-            measure_thread.start()
-            logging.debug(f"Thread started")
+            logging.debug(f"Starting trace hub")
+            self.trace_hub.start()
+            self.scan_subscription = self.trace_hub.subscribe("latest")
+            logging.debug(f"Trace hub started")
             return True
         except:
             return False
         #self.stagemover.home()
 
     def connect_stagemover(self):
+        if self.simulation is not None:
+            return self.stagemover.connect(devices=self.simulation.stages)
         connection = self.stagemover.connect()
         return connection
 
     def calibrate(self):
-        self.stagecalibrator = StageCalibrator(self.settings["calibration"], self.teraflash.get_corrected_pulse, self.stagemover)
+        self.stagecalibrator = StageCalibrator(self.settings["calibration"], self.next_pulse, self.stagemover)
 
         logging.info(f"Starting calibration")
+        self.averager = None
         self.teraflash.set_averaging(1)
         [x_min, x_max, y_min, y_max] = self.stagecalibrator.rough_calibration()
         self.teraflash.set_averaging(self.settings["teraflash"]['TFC_AVERAGING'])
@@ -176,38 +374,204 @@ class TFCCoffeeBean:
         return [x_min, x_max, y_min, y_max]
 
     def run_gridmover_screen(self):
-        self.plotter = MeasurementPlotter(self.settings)
+        self.plotter = MeasurementPlotter(self.settings, self.settings["general"]["live_plot"])
         self.plotter.create_plot()
         self.teraflash.set_averaging(2)
         logging.info(f"Starting gridmove screen")
-        self.stagegridmover = StageGridMover(self.stagemover, self.settings["stagegridmover"])
-        self.stagegridmover.run_grid(self.measure_and_log_screen)
+        self.stagegridmover = StageGridMover(self.stagemover, self.settings["stagegridmover"], self.metrics,
+                                             self.create_scan_log(self.measurement_savepath_screen))
+        self.scan_cube = self.create_scan_cube(self.settings["general"]["pulse_store_name_screen"], self.stagegridmover.grid_shape())
+        self.scan_journal = None
+        self.averager = None
+        self.bean_mask = None  # of the last screening, restricts the next grid scan
+        self.metrics.reset()
+        self.start_scan_writer()
+        try:
+            self.stagegridmover.run_grid(self.measure_and_log_screen)
+        finally:
+            self.stagegridmover.scan_log.close()
+            self.stop_scan_writer()
+        self.bean_mask = self.create_bean_mask(self.measurement_savepath_screen)
+        self.save_metrics(self.measurement_savepath_screen)
         self.teraflash.set_averaging(self.settings["teraflash"]['TFC_AVERAGING'])
 
-    def run_gridmover(self):
-        self.plotter = MeasurementPlotter(self.settings)
+    def run_gridmover(self, resume_folder: str = None, fill_gaps: bool = False):
+        """
+        Runs the grid scan into a new scan cube, journaling every completed point.
+        With resume_folder the interrupted scan of that scan cube continues: its settings and info file are
+        reloaded and the stages continue the original path from the first point that is not completed.
+        With fill_gaps as well, only the points that are not completed are measured, in nearest neighbour order.
+        After a screening (see calibrate) a new scan only visits the points of its bean mask, in the order of the
+        full path. The mask is saved in the scan cube as bean_mask.npy, False for the skipped background points,
+        and the skipped points are indexed in the info file with the background energy of the screening.
+        With settings["storage"]["pack_after_scan"] the scan cube is packed once the scan finished, a packed
+        scan cube is unpacked again to resume it, only if it misses points.
+        """
+        grid_indices = None
+        keep_order = False
+        mask = None
+        if resume_folder is not None:
+            scan = load_scan(resume_folder)
+            # The scan's own settings, but simulation and plotting as set up for this session
+            scan["settings"]["simulation"] = self.settings["simulation"]
+            scan["settings"]["general"]["live_plot"] = self.settings["general"]["live_plot"]
+            scan["settings"].setdefault("averaging", self.settings["averaging"])  # scans saved before adaptive averaging
+            scan["settings"].setdefault("storage", self.settings["storage"])
+            for key in ("trace_time", "trace_timeout"):  # scans saved before the trace timeout
+                scan["settings"]["teraflash"].setdefault(key, self.settings["teraflash"][key])
+            self.settings = scan["settings"]
+            self.measurement_savepath = scan["info_path"]
+            self.stagegridmover = StageGridMover(self.stagemover, self.settings["stagegridmover"], self.metrics)
+            # A packed cube still has its timestamps, so the missing points are found without unpacking it
+            self.scan_cube = PulseStore(resume_folder)
+            self.scan_journal = ScanJournal(resume_folder)
+            if os.path.exists(os.path.join(resume_folder, MASK_FILE)):
+                mask = np.load(os.path.join(resume_folder, MASK_FILE))
+            if fill_gaps:
+                all_points = np.argwhere(np.ones(self.scan_cube.grid_shape, dtype=bool) if mask is None else mask)
+                grid_indices = self.scan_journal.missing(all_points, self.scan_cube)
+            else:
+                path = self.stagegridmover.plan_path()
+                if mask is not None:
+                    path = path[mask[tuple(path.T)]]
+                missing = self.scan_journal.missing(path, self.scan_cube)
+                if len(missing) > 0:
+                    first_missing = int(np.flatnonzero((path == missing[0]).all(axis=1))[0])
+                    grid_indices = path[first_missing:]
+                else:
+                    grid_indices = missing
+                keep_order = True
+            if len(grid_indices) == 0:
+                logging.info(f"Scan {resume_folder} is complete, nothing to resume")
+                return
+            if self.scan_cube.packed:
+                unpack_store(resume_folder)
+                self.scan_cube = PulseStore(resume_folder)
+            logging.info(f"{'Filling gaps of' if fill_gaps else 'Resuming'} scan {resume_folder}: {len(grid_indices)} points")
+        else:
+            self.stagegridmover = StageGridMover(self.stagemover, self.settings["stagegridmover"], self.metrics)
+            self.scan_cube = self.create_scan_cube(self.settings["general"]["pulse_store_name"], self.stagegridmover.grid_shape())
+            self.scan_journal = ScanJournal(self.scan_cube.folder)
+            save_scan(self.scan_cube.folder, self.settings, self.measurement_savepath)
+            mask = self.masked_grid()
+            if mask is not None:
+                # Skipped points are background, saved with the scan cube so resume and fill-gaps skip them as well
+                np.save(os.path.join(self.scan_cube.folder, MASK_FILE), mask)
+                self.index_background_points(mask)
+                path = self.stagegridmover.plan_path()
+                grid_indices = path[mask[tuple(path.T)]]
+                keep_order = True
+
+        self.plotter = MeasurementPlotter(self.settings, self.settings["general"]["live_plot"])
+        if mask is not None and self.bean_mask is not None:
+            self.plotter.image_data[~mask.any(axis=2)] = self.bean_mask.background
         self.plotter.create_plot()
         logging.info(f"Starting gridmove")
-        self.stagegridmover = StageGridMover(self.stagemover, self.settings["stagegridmover"])
-        self.stagegridmover.run_grid(self.measure_and_log)
-        
-        plt.ioff()  # Turn off interactive mode to keep the plot open after the program finishes
-        plt.show()
-
-    def measure_and_log(self, position):
-        pulse = self.teraflash.get_corrected_pulse()
-        pulse_name = self.save_pulse(pulse)
-        self.plotter.update_plot([pulse.energy(), position])
+        self.stagegridmover.scan_log = self.create_scan_log(self.measurement_savepath)
+        self.averager = self.create_averager()
+        self.metrics.reset()
+        self.start_scan_writer()
+        try:
+            if self.settings["general"]["pipelined_scan"]:
+                self.stagegridmover.run_grid_pipelined(self.acquire_pulse, self.process_and_log,
+                                                       grid_indices=grid_indices, keep_order=keep_order,
+                                                       while_moving=self.draw_while_moving)
+            else:
+                self.stagegridmover.run_grid(self.measure_and_log, grid_indices, keep_order)
+        finally:
+            self.stagegridmover.scan_log.close()
+            self.stop_scan_writer()
+        self.save_metrics(self.measurement_savepath)
+        if self.settings["storage"]["pack_after_scan"] and self.scan_cube.count > 0:
+            pack_store(self.scan_cube.folder, self.settings["storage"])
+        if self.averager is not None:
+            self.averager.summary()
+        if self.simulation is not None:
+            self.simulation.report()
+
+        self.plotter.show()
+
+    def run_adaptive_scan(self):
+        """
+        Scans the xy plane at z_min of the grid settings with quadtree refinement around the bean edges.
+        Its points are indexed in their own info file <name>_adaptive.txt next to the one of the grid scan, and the
+        interpolated energy image is saved as <name>_adaptive.npz.
+        """
+        info_path = os.path.splitext(self.measurement_savepath)[0] + "_adaptive.txt"
+        grid_settings = self.settings["stagegridmover"]
+        adaptive_settings = dict(self.settings["adaptive"], x_min=grid_settings["x_min"], x_max=grid_settings["x_max"],
+                                 y_min=grid_settings["y_min"], y_max=grid_settings["y_max"], z=grid_settings["z_min"])
+        scanner = AdaptiveGridScanner(self.stagemover, adaptive_settings, grid_settings)
+        fine_grid_settings = scanner.fine_grid_settings()
+
+        self.plotter = MeasurementPlotter({"stagegridmover": fine_grid_settings}, self.settings["general"]["live_plot"])
+        self.plotter.create_plot()
+        logging.info(f"Starting adaptive scan on a {scanner.lattice_shape} lattice")
+        self.scan_cube = self.create_scan_cube(f"{self.settings['general']['pulse_store_name']}-adaptive",
+                                               StageGridMover(self.stagemover, fine_grid_settings).grid_shape())
+        self.scan_journal = None
+        self.averager = self.create_averager()
+        self.metrics.reset()
+        self.start_scan_writer()
+        try:
+            image = scanner.run(lambda position, grid_index: self.measure_and_log(position, grid_index, info_path))
+        finally:
+            self.stop_scan_writer()
+        self.save_metrics(info_path)
+        if self.averager is not None:
+            self.averager.summary()
+
+        image_path = os.path.splitext(self.measurement_savepath)[0] + "_adaptive.npz"
+        np.savez(image_path, image=image, measured=scanner.measured_mask(),
+                 x=np.linspace(fine_grid_settings["x_min"], fine_grid_settings["x_max"], fine_grid_settings["x_n"]),
+                 y=np.linspace(fine_grid_settings["y_min"], fine_grid_settings["y_max"], fine_grid_settings["y_n"]))
+        logging.info(f"Adaptive scan image saved to {image_path}")
+
+        self.plotter.show(image)
+        return image
+
+    def measure_and_log(self, position, grid_index, info_path: str = None):
+        """
+        Measures a point and indexes it in info_path, the info file of the grid scan by default.
+        """
+        pulse = self.next_pulse()
         current_time = datetime.now()
-
-        with open(self.measurement_savepath, 'a') as file:
-            file.write(f"{current_time.strftime('%Y-%m-%d %H:%M:%S.%f')}_{pulse_name}_{position[0]},{position[1]},{position[2]}\n")
+        # Saving the pulse and its line in the info file happens on the scan writer thread
+        self.scan_writer.write_pulse(self.scan_cube, pulse, position, current_time.timestamp(), grid_index,
+                                     info_path or self.measurement_savepath, current_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                     self.scan_journal)
+        with self.metrics.phase("plot"):
+            self.plotter.update_plot([pulse.energy(), position], grid_index)
         return pulse
 
-    def measure_and_log_screen(self, position):
-        pulse = self.teraflash.get_corrected_pulse()
-        self.save_pulse(pulse)
-        self.plotter.update_plot([pulse.energy(), position])
+    def acquire_pulse(self, position, grid_index):
+        """
+        Acquisition stage of the pipelined grid run: only what has to happen while the stages stand still.
+        """
+        return self.next_pulse(), datetime.now()
+
+    def draw_while_moving(self):
+        """
+        Drawing stage of the pipelined grid run, on the scan thread while the stages move to the next point.
+        """
+        with self.metrics.phase("plot"):
+            self.plotter.draw_pending()
+
+    def process_and_log(self, acquired, position, grid_index):
+        """
+        Processing stage of the pipelined grid run, runs on a worker thread while the stages move to the next point.
+        """
+        pulse, current_time = acquired
+        self.scan_writer.write_pulse(self.scan_cube, pulse, position, current_time.timestamp(), grid_index,
+                                     self.measurement_savepath, current_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                     self.scan_journal)
+        self.plotter.add_value([pulse.energy(), position], grid_index)
+
+    def measure_and_log_screen(self, position, grid_index):
+        pulse = self.next_pulse()
+        self.scan_writer.write_pulse(self.scan_cube, pulse, position, datetime.now().timestamp(), grid_index)
+        with self.metrics.phase("plot"):
+            self.plotter.update_plot([pulse.energy(), position], grid_index)
         # current_time = datetime.now()
         # pulse_name = f"{current_time.strftime('%Y-%m-%d_%H-%M-%S-%f')}.npy"
         # pulse_path = os.path.join(self.measurement_savefolder_pulses, pulse_name)
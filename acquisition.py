@@ -0,0 +1,270 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from arraypulse import ArrayPulse, energy_scale
+
+ERROR_CHECK_INTERVAL = 0.1  # s between checks for an error of the hub while waiting for a trace
+
+
+class Trace:
+    """
+    A corrected pulse as published by the TraceHub, numbered in acquisition order.
+    timestamp is the time the acquisition of the trace started, acquire_time and offset_time the seconds
+    spent on reading the trace and on its offset correction.
+    """
+
+    def __init__(self, sequence: int, timestamp: float, pulse, acquire_time: float = 0., offset_time: float = 0.):
+        self.sequence: int = sequence
+        self.timestamp: float = timestamp
+        self.pulse = pulse
+        self.acquire_time: float = acquire_time
+        self.offset_time: float = offset_time
+
+
+class TraceSubscription:
+    """
+    Queue of traces for one consumer of the TraceHub.
+
+    policy "latest": only the newest trace is kept, older unread traces are replaced (live views, scans).
+    policy "lossless": every trace is kept, up to maxsize unread traces. When the queue is full the hub waits
+    up to put_timeout seconds for the consumer, after that the trace is dropped and counted in dropped.
+    """
+
+    def __init__(self, policy: str = "latest", maxsize: int = 100, put_timeout: float = 1.0, hub=None):
+        if policy not in ("latest", "lossless"):
+            raise ValueError(f"Unknown subscription policy '{policy}'")
+        self.policy: str = policy
+        self.hub = hub
+        self.put_timeout: float = put_timeout
+        self.queue: queue.Queue = queue.Queue(maxsize=1 if policy == "latest" else maxsize)
+        self.dropped: int = 0
+
+    def _publish(self, trace: Trace):
+        if self.policy == "latest":
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(trace)
+            return
+        try:
+            self.queue.put(trace, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Trace {trace.sequence} dropped, lossless subscriber too slow ({self.dropped} dropped)")
+
+    def get(self, timeout: float = None) -> Trace:
+        """
+        Next unread trace, waits for one if there is none. Raises queue.Empty after timeout seconds.
+        """
+        return self.queue.get(timeout=timeout)
+
+    def get_after(self, timestamp: float, timeout: float = None) -> Trace:
+        """
+        First trace acquired after timestamp, e.g. after the stages arrived at a point. Older unread traces are discarded.
+        Raises the error of the hub while its acquisition fails, and queue.Empty after timeout seconds without a trace.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.hub is not None and self.hub.error is not None:
+                raise self.hub.error
+            remaining = ERROR_CHECK_INTERVAL if deadline is None else min(max(deadline - time.time(), 0.), ERROR_CHECK_INTERVAL)
+            try:
+                trace = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                continue
+            if trace.timestamp > timestamp:
+                return trace
+
+
+class TraceHub:
+    """
+    Owns the trace acquisition of the TeraFlash: one thread pulls every corrected pulse from the device
+    and publishes it, with a sequence number and timestamp, to all subscriptions.
+    Consumers subscribe instead of calling get_corrected_pulse themselves, so no trace goes to only one of them.
+    Traces are read with get_next_trace and corrected with correct_offset, so both steps are timed separately.
+    While the acquisition fails the hub keeps retrying and holds the last error in error, which get_after of its
+    subscriptions raises.
+    """
+
+    def __init__(self, teraflash):
+        self.teraflash = teraflash
+        self.subscriptions: list = []
+        self.latest: Trace = None
+        self.sequence: int = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+        self.error: Exception = None
+
+    def subscribe(self, policy: str = "latest", maxsize: int = 100) -> TraceSubscription:
+        subscription = TraceSubscription(policy, maxsize, hub=self)
+        with self.lock:
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: TraceSubscription):
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="TraceHub")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if not self.teraflash.running():
+                self.stopped.wait(0.05)
+                continue
+            # Stamped before the acquisition, a trace that was already running when the stages arrived is older
+            started = time.time()
+            try:
+                pulse = self.teraflash.get_next_trace()
+                acquired = time.time()
+                self.teraflash.correct_offset(pulse)
+            except Exception as e:
+                if self.error is None or str(e) != str(self.error):
+                    logging.warning(f"Error acquiring THz trace, retrying: {e}")
+                self.error = e
+                self.stopped.wait(0.05)
+                continue
+            if self.error is not None:
+                logging.info(f"THz trace acquisition recovered from: {self.error}")
+                self.error = None
+            self.sequence += 1
+            trace = Trace(self.sequence, started, pulse, acquired - started, time.time() - acquired)
+            self.latest = trace
+            for subscription in self.subscriptions:
+                subscription._publish(trace)
+
+
+class TraceRecorder:
+    """
+    Lossless subscriber that appends every published trace to a pulse store, until stopped.
+    """
+
+    def __init__(self, hub: TraceHub, store):
+        self.hub = hub
+        self.store = store
+        self.subscription = hub.subscribe("lossless")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="TraceRecorder")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                trace = self.subscription.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.store.append(trace.pulse, timestamp=trace.timestamp)
+
+    def stop(self):
+        self.hub.unsubscribe(self.subscription)
+        self.stopped.set()
+        self.thread.join()
+        while not self.subscription.queue.empty():
+            trace = self.subscription.get()
+            self.store.append(trace.pulse, timestamp=trace.timestamp)
+        self.store.close()
+        logging.info(f"Recorded {self.store.count} traces to {self.store.folder}, {self.subscription.dropped} dropped")
+
+
+class RunningMean:
+    """
+    Streaming mean and variance per sample of a series of traces (Welford's algorithm), without keeping the traces.
+    """
+
+    def __init__(self):
+        self.count: int = 0
+        self.mean: np.ndarray = None
+        self.m2: np.ndarray = None  # sum of squared deviations from the mean
+
+    def add(self, field):
+        field = np.asarray(field, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros_like(field)
+            self.m2 = np.zeros_like(field)
+        self.count += 1
+        delta = field - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (field - self.mean)
+
+    def snr(self, feature: str = "peak") -> float:
+        """
+        Signal to noise ratio of the mean trace, NaN before the second trace. Both are amplitude ratios:
+            peak     largest absolute field of the mean over the RMS standard error
+            energy   RMS of the mean trace over the RMS standard error, the square root of the energy ratio
+        The standard error is pooled over all samples: the detector noise is about the same at every sample,
+        and a per-sample estimate from a few traces would often stop the averaging far too early.
+        """
+        if self.count < 2:
+            return np.nan
+        noise = np.sqrt(max(self.m2.mean() / ((self.count - 1) * self.count), 1e-300))
+        if feature == "energy":
+            return float(np.sqrt(np.dot(self.mean, self.mean) / len(self.mean)) / noise)
+        return float(np.abs(self.mean).max() / noise)
+
+
+class AdaptiveAverager:
+    """
+    Averages traces at a grid point until the mean reaches target_snr or max_traces traces were taken,
+    so bright background points finish after min_traces traces and only attenuated points average long.
+    Works on top of the hardware averaging of the TeraFlash, every trace is already TFC_AVERAGING-fold averaged.
+    Keeps the trace counts of all points since reset for summary.
+    """
+
+    def __init__(self, settings: dict):
+        self.feature: str = settings["snr_feature"]
+        self.target_snr: float = settings["target_snr"]
+        self.min_traces: int = max(int(settings["min_traces"]), 2)
+        self.max_traces: int = max(int(settings["max_traces"]), self.min_traces)
+        if self.feature not in ("peak", "energy"):
+            raise ValueError(f"Unknown SNR feature '{self.feature}', use peak or energy")
+        self.reset()
+
+    def reset(self):
+        self.points: int = 0
+        self.traces: int = 0
+        self.capped: int = 0
+
+    def average(self, pulses) -> ArrayPulse:
+        """
+        Mean of the pulses taken one by one from the iterator pulses, stopping as soon as the SNR target is reached.
+        Its energy() is on the scale of the energy() of the pulses, see arraypulse.energy_scale.
+        """
+        running = RunningMean()
+        snr = np.nan
+        for pulse in pulses:
+            running.add(pulse.E())
+            if running.count >= self.min_traces:
+                snr = running.snr(self.feature)
+                if snr >= self.target_snr or running.count >= self.max_traces:
+                    break
+        self.points += 1
+        self.traces += running.count
+        if snr < self.target_snr:
+            self.capped += 1
+        return ArrayPulse(np.asarray(pulse.t()), running.mean, energy_scale(pulse), traces=running.count, snr=snr)
+
+    def summary(self):
+        if self.points == 0:
+            return
+        logging.info(f"Adaptive averaging: {self.traces} traces for {self.points} points ({self.traces / self.points:.1f} per point), "
+                     f"{self.capped} points stopped at {self.max_traces} traces below SNR {self.target_snr}")
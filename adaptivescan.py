@@ -0,0 +1,132 @@
+import logging
+import math
+
+import numpy as np
+
+from stagemovers import StageGridMover, StageMover
+
+
+class AdaptiveGridScanner:
+    """
+    Scans an xy plane by quadtree refinement instead of measuring every point of a uniform grid.
+
+    All points live on a fine lattice with step min_step (rounded down so the coarse grid falls on the lattice).
+    The coarse grid is measured first, then every cell whose corner energies differ by more than
+    variation_threshold * (largest coarse energy) is split in four, level by level, until cells are one
+    lattice step wide. The new points of a level are visited in one nearest neighbour pass of a StageGridMover.
+    Cells that were not split are filled by bilinear interpolation of their corners, so the result is a
+    regular image on the fine lattice.
+
+    example settings = {
+        x_min: 45,
+        x_max: 55,
+        y_min: 45,
+        y_max: 55,
+        z: 22,
+        coarse_x_n: 5,
+        coarse_y_n: 5,
+        min_step: 0.25,  # mm
+        variation_threshold: 0.2,  # fraction of the largest coarse energy
+    }
+    An axis with min == max is scanned as a single line.
+    """
+
+    def __init__(self, stage_mover: StageMover, settings: dict, grid_settings: dict):
+        self.stage_mover = stage_mover
+        self.settings = settings
+        self.grid_settings = grid_settings
+
+        self.lattice_shape, self.cell_size = self._plan_lattice()
+        self.energies = np.full(self.lattice_shape, np.nan)
+        self.leaves = []
+
+    def _plan_lattice(self):
+        lattice_shape = []
+        cell_size = []
+        for axis in ("x", "y"):
+            extent = self.settings[f"{axis}_max"] - self.settings[f"{axis}_min"]
+            coarse_cells = max(int(self.settings[f"coarse_{axis}_n"]) - 1, 1)
+            if extent <= 0:
+                lattice_shape.append(1)
+                cell_size.append(0)
+                continue
+            levels = max(math.ceil(math.log2(extent / coarse_cells / self.settings["min_step"])), 0)
+            lattice_shape.append(coarse_cells * 2 ** levels + 1)
+            cell_size.append(2 ** levels)
+        return tuple(lattice_shape), tuple(cell_size)
+
+    def fine_grid_settings(self) -> dict:
+        """
+        StageGridMover settings of the fine lattice, the scan cube and the live plot use the same grid.
+        """
+        grid_settings = dict(self.grid_settings)
+        grid_settings.update({
+            "x_min": self.settings["x_min"], "x_max": self.settings["x_max"], "x_n": self.lattice_shape[0],
+            "y_min": self.settings["y_min"], "y_max": self.settings["y_max"], "y_n": self.lattice_shape[1],
+            "z_min": self.settings["z"], "z_max": self.settings["z"], "z_n": 1,
+        })
+        return grid_settings
+
+    def run(self, measure) -> np.ndarray:
+        """
+        Runs the adaptive scan. measure(position, grid_index) is called on every visited point and returns the pulse.
+        grid_index refers to the fine lattice, see fine_grid_settings. Returns the (x_n, y_n) energy image.
+        """
+        grid_mover = StageGridMover(self.stage_mover, self.fine_grid_settings())
+        nx, ny = self.lattice_shape
+        sx, sy = self.cell_size
+
+        cells = [(i, j) for i in range(0, max(nx - 1, 1), max(sx, 1)) for j in range(0, max(ny - 1, 1), max(sy, 1))]
+        new_points = {corner for cell in cells for corner in self._corners(cell, sx, sy)}
+        level = 0
+        while new_points:
+            logging.info(f"Adaptive scan level {level}: {len(new_points)} new points, cell size ({sx}, {sy})")
+            for position, (i, j, _) in grid_mover.visit_grid([(i, j, 0) for i, j in sorted(new_points)]):
+                self.energies[i, j] = measure(position, (i, j, 0)).energy()
+            if level == 0:
+                threshold = self.settings["variation_threshold"] * np.nanmax(self.energies)
+
+            refine = []
+            for cell in cells:
+                corner_energies = [self.energies[corner] for corner in self._corners(cell, sx, sy)]
+                if max(sx, sy) > 1 and max(corner_energies) - min(corner_energies) > threshold:
+                    refine.append(cell)
+                else:
+                    self.leaves.append((cell, sx, sy))
+
+            # Axes that already reached one lattice step (or are a single line) are not split further
+            split_x, split_y = sx > 1, sy > 1
+            sx, sy = (sx // 2 if split_x else sx), (sy // 2 if split_y else sy)
+            cells = [(i + di, j + dj) for i, j in refine
+                     for di in ((0, sx) if split_x else (0,)) for dj in ((0, sy) if split_y else (0,))]
+            new_points = {corner for cell in cells for corner in self._corners(cell, sx, sy)
+                          if np.isnan(self.energies[corner])}
+            level += 1
+
+        measured = int(np.count_nonzero(~np.isnan(self.energies)))
+        logging.info(f"Adaptive scan measured {measured} of {nx * ny} points ({100 * measured / (nx * ny):.0f}%)")
+        return self.image()
+
+    @staticmethod
+    def _corners(cell, sx, sy):
+        i, j = cell
+        return {(i + di, j + dj) for di in (0, sx) for dj in (0, sy)}
+
+    def image(self) -> np.ndarray:
+        """
+        Regular image on the fine lattice, points inside cells that were not refined are bilinearly interpolated.
+        """
+        image = self.energies.copy()
+        for (i, j), sx, sy in self.leaves:
+            u = np.linspace(0, 1, sx + 1)[:, None]
+            v = np.linspace(0, 1, sy + 1)[None, :]
+            e00, e10 = self.energies[i, j], self.energies[i + sx, j]
+            e01, e11 = self.energies[i, j + sy], self.energies[i + sx, j + sy]
+            interpolated = e00 * (1 - u) * (1 - v) + e10 * u * (1 - v) + e01 * (1 - u) * v + e11 * u * v
+            block = image[i:i + sx + 1, j:j + sy + 1]
+            missing = np.isnan(block)
+            block[missing] = interpolated[missing]
+        return image
+
+    def measured_mask(self) -> np.ndarray:
+        return ~np.isnan(self.energies)
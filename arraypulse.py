@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def time_domain_energy(t: np.ndarray, E: np.ndarray) -> float:
+    """
+    sum(E^2) dt, the energy of tracefeatures.extract_features.
+    """
+    return float(np.dot(E, E) * (t[1] - t[0]))
+
+
+def energy_scale(pulse) -> float:
+    """
+    Ratio of pulse.energy() to the time-domain energy of the pulse: for a TFPulse the factor between its energy scale
+    and sum(E^2) dt, assuming both are proportional. 1 when either energy is zero.
+    """
+    reference = time_domain_energy(np.asarray(pulse.t()), np.asarray(pulse.E()))
+    energy = pulse.energy()
+    return energy / reference if reference > 0 and energy > 0 else 1.
+
+
+class ArrayPulse:
+    """
+    Pulse held as numpy arrays with the interface of TFPulse the scans use: t(), E(), f(), S(), energy() and
+    subtract_offset(). Used for simulated traces and for averages of several traces.
+    energy() is sum(E^2) dt times energy_scale. Pulses computed from TeraFlash pulses pass the energy_scale of
+    those, so their energies stay on the TFPulse scale the live plot range (PLOT_MAXIMUM_ENERGY) is set for.
+    position is the stage position a simulated trace was taken at, traces and snr describe an average and are
+    stored with it as extra pulse store columns.
+    """
+
+    def __init__(self, t: np.ndarray, field: np.ndarray, energy_scale: float = 1., position=None,
+                 traces: int = None, snr: float = None):
+        self._t = t
+        self._E = field
+        self.energy_scale: float = energy_scale
+        self.position = position
+        self.traces: int = traces
+        self.snr: float = snr
+
+    def t(self):
+        return self._t
+
+    def E(self):
+        return self._E
+
+    def f(self):
+        return np.fft.rfftfreq(len(self._t), self._t[1] - self._t[0])
+
+    def S(self):
+        return np.abs(np.fft.rfft(self._E)) ** 2
+
+    def energy(self):
+        return self.energy_scale * time_domain_energy(self._t, self._E)
+
+    def subtract_offset(self, offset):
+        self._E = self._E - offset
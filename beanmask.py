@@ -0,0 +1,76 @@
+import logging
+
+import numpy as np
+
+MASK_SUFFIX = "_mask.npz"
+MASK_FILE = "bean_mask.npy"
+
+
+class BeanMask:
+    """
+    Grid points of a screening scan that belong to the bean, found from the energy of every screened point.
+
+    The bean attenuates the THz pulse, so points with an energy below threshold * background are bean,
+    background being the background_percentile percentile of all screened energies (the open beam).
+    The thresholded mask is cleaned with scipy.ndimage: a binary opening removes isolated noisy points,
+    holes (e.g. a bright crack in the bean) are filled and only the largest connected region is kept.
+    Finally it is grown by border grid points in every direction, so the edge of the bean is measured fully.
+    Points that were not screened (NaN energy) count as bean.
+
+    example settings = {
+        threshold: 0.5,  # fraction of the background energy
+        background_percentile: 90,
+        opening: 1,  # grid points, 0 to skip
+        border: 1,  # grid points
+    }
+    """
+
+    def __init__(self, energy: np.ndarray, axes: list, settings: dict):
+        from scipy import ndimage
+
+        self.energy: np.ndarray = np.asarray(energy, dtype=np.float64)
+        self.axes: list = [np.asarray(axis, dtype=np.float64) for axis in axes]
+        self.background: float = float(np.nanpercentile(self.energy, settings["background_percentile"])) \
+            if np.isfinite(self.energy).any() else np.nan
+
+        with np.errstate(invalid="ignore"):
+            mask = ~(self.energy >= settings["threshold"] * self.background)
+        # Single point axes are squeezed out, erosion would treat their neighbours outside the grid as background
+        shape = mask.shape
+        mask = mask.reshape([n for n in shape if n > 1] or [1])
+        structure = ndimage.generate_binary_structure(mask.ndim, 1)
+        if settings["opening"] > 0:
+            mask = ndimage.binary_opening(mask, structure, iterations=int(settings["opening"]))
+        mask = ndimage.binary_fill_holes(mask, structure)
+        labels, regions = ndimage.label(mask, structure)
+        if regions > 1:
+            sizes = np.bincount(labels.ravel())[1:]
+            mask = labels == int(sizes.argmax()) + 1
+        if settings["border"] > 0 and mask.any():
+            mask = ndimage.binary_dilation(mask, structure, iterations=int(settings["border"]))
+        self.mask: np.ndarray = mask.reshape(shape)
+        logging.info(f"Bean mask: {int(self.mask.sum())} of {self.mask.size} screened points, background energy {self.background:.4g}")
+
+    def on_grid(self, grid_axes: list) -> np.ndarray:
+        """
+        The mask on another grid, e.g. a finer measurement grid: every grid point takes the mask value
+        of the nearest screened point.
+        """
+        nearest = [np.abs(np.asarray(grid_axis)[:, None] - mask_axis[None, :]).argmin(axis=1)
+                   for grid_axis, mask_axis in zip(grid_axes, self.axes)]
+        return self.mask[np.ix_(*nearest)]
+
+    def save(self, path: str):
+        np.savez(path, energy=self.energy, mask=self.mask, background=self.background,
+                 x=self.axes[0], y=self.axes[1], z=self.axes[2])
+        logging.info(f"Bean mask saved to {path}")
+
+    @classmethod
+    def load(cls, path: str) -> "BeanMask":
+        with np.load(path) as data:
+            bean_mask = cls.__new__(cls)
+            bean_mask.energy = data["energy"]
+            bean_mask.mask = data["mask"]
+            bean_mask.background = float(data["background"])
+            bean_mask.axes = [data["x"], data["y"], data["z"]]
+        return bean_mask
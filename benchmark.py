@@ -0,0 +1,341 @@
+"""
+End-to-end benchmarks of the scan software against the simulated TeraFlash and stages of fakeenvironment.
+
+    python benchmark.py                      run all benchmarks and compare against benchmark_baseline.json
+    python benchmark.py scan calibration     run only some benchmarks
+    python benchmark.py --save-baseline      store the results as the new baseline
+
+Every benchmark reports points/s, per-point latency percentiles and the peak traced memory. A benchmark fails
+when its points/s drops, or its p95 latency or peak memory grows, by more than --tolerance against the baseline.
+The exit code is 1 if any benchmark failed or has no baseline yet, the baseline is taken on the machine that runs
+the comparison, as points/s depend on it. Memory tracing slows allocation heavy code down, so compare
+runs with and without --no-memory only against baselines taken the same way.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")  # benchmarks draw off screen, plt.show returns immediately
+
+import numpy as np
+
+from settings import get_settings
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# Higher is better for points_per_s, lower is better for the others
+COMPARED_METRICS = {"points_per_s": 1, "latency_p95_ms": -1, "peak_memory_mb": -1}
+
+
+class PointTimer:
+    """
+    Collects the perf_counter time at which every point of a benchmark finished. Benchmarks call start once
+    their setup is done, so connecting and preparing data does not count towards the first point.
+    """
+
+    def __init__(self):
+        self.start_time: float = time.perf_counter()
+        self.stamps: list = []
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.stamps = []
+
+    def point(self):
+        self.stamps.append(time.perf_counter())
+
+
+class BenchmarkResult:
+    """
+    Points/s, latency percentiles and peak memory of one benchmark run.
+    """
+
+    def __init__(self, name: str, timer: PointTimer, peak_memory: int):
+        self.name = name
+        start, stamps = timer.start_time, timer.stamps
+        duration = (stamps[-1] if stamps else time.perf_counter()) - start
+        latencies = np.diff(np.concatenate([[start], stamps])) * 1e3
+        self.metrics = {
+            "points": len(stamps),
+            "duration_s": duration,
+            "points_per_s": len(stamps) / duration if duration > 0 else 0.,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(stamps) else 0.,
+            "latency_p95_ms": float(np.percentile(latencies, 95)) if len(stamps) else 0.,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(stamps) else 0.,
+            "peak_memory_mb": peak_memory / 2 ** 20,
+        }
+
+    def __str__(self):
+        m = self.metrics
+        return (f"{self.name:<12} {m['points']:>7} points {m['points_per_s']:>10.1f} points/s   "
+                f"latency p50 {m['latency_p50_ms']:.2f} ms, p95 {m['latency_p95_ms']:.2f} ms, p99 {m['latency_p99_ms']:.2f} ms   "
+                f"peak memory {m['peak_memory_mb']:.1f} MB")
+
+
+def stamped(func, timer: PointTimer):
+    """
+    Wraps func so every call that returns finishes a point.
+    """
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        timer.point()
+        return result
+    return wrapper
+
+
+def run_benchmark(name: str, benchmark, settings: dict, trace_memory: bool = True) -> BenchmarkResult:
+    """
+    Runs benchmark(settings, timer), the benchmark marks every finished point on the timer. Peak memory is the
+    peak of the allocations traced by tracemalloc during the whole run, 0 without trace_memory.
+    """
+    timer = PointTimer()
+    peak_memory = 0
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        benchmark(settings, timer)
+    finally:
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return BenchmarkResult(name, timer, peak_memory)
+
+
+def connected_bean(settings: dict):
+    from TFCCoffeebean import TFCCoffeeBean
+
+    bean = TFCCoffeeBean(settings)
+    bean.connect_teraflash()
+    bean.connect_stagemover()
+    return bean
+
+
+def benchmark_scan(settings: dict, timer: PointTimer):
+    """
+    Full TFCCoffeeBean.run_gridmover, pipelined or not as configured, one point per grid point.
+    """
+    bean = connected_bean(settings)
+    bean.acquire_pulse = stamped(bean.acquire_pulse, timer)
+    bean.measure_and_log = stamped(bean.measure_and_log, timer)
+    timer.start()
+    try:
+        bean.run_gridmover()
+    finally:
+        bean.trace_hub.stop()
+
+
+def benchmark_calibration(settings: dict, timer: PointTimer):
+    """
+    StageCalibrator.rough_calibration starting at the bean center, one point per measurement.
+    """
+    from stagemovers import StageCalibrator
+
+    bean = connected_bean(settings)
+    bean.stagemover.move_all(list(settings["simulation"]["bean_center"]))
+    calibrator = StageCalibrator(settings["calibration"], stamped(bean.next_pulse, timer), bean.stagemover)
+    timer.start()
+    try:
+        edges = calibrator.rough_calibration()
+    finally:
+        bean.trace_hub.stop()
+    logging.info(f"Calibrated edges: {edges}")
+
+
+def benchmark_plotter(settings: dict, timer: PointTimer):
+    """
+    MeasurementPlotter.update_plot for every point of the grid.
+    """
+    from TFCCoffeebean import MeasurementPlotter
+    from stagemovers import StageGridMover
+
+    grid_settings = settings["stagegridmover"]
+    plotter = MeasurementPlotter(settings)
+    plotter.create_plot()
+    grid_mover = StageGridMover(None, grid_settings)
+    rng = np.random.default_rng(0)
+    timer.start()
+    for grid_index in np.ndindex(*grid_mover.grid_shape()):
+        position = [axis[i] for axis, i in zip(grid_mover.grid_axes(), grid_index)]
+        plotter.update_plot([rng.uniform(0, 1000), position], grid_index)
+        timer.point()
+
+
+def simulated_pulses(settings: dict, count: int) -> list:
+    from fakeenvironment import Simulation
+
+    simulation = Simulation(dict(settings["simulation"], time_scale=0.), settings["teraflash"])
+    return [simulation.teraflash.get_corrected_pulse() for _ in range(count)]
+
+
+def benchmark_saving(settings: dict, timer: PointTimer):
+    """
+    ScanWriter.write_pulse into a scan cube including the info file line, one point per queued pulse.
+    The final close, which waits for the writer, counts towards the duration of the last point.
+    """
+    from pulsestore import PulseStore
+    from scanwriter import ScanWriter
+
+    folder = settings["general"]["measurement_savefolder"]
+    pulses = simulated_pulses(settings, 64)
+    grid_shape = (settings["stagegridmover"]["x_n"], settings["stagegridmover"]["y_n"], settings["stagegridmover"]["z_n"])
+    cube = PulseStore(os.path.join(folder, "pulses", "saving"), grid_shape=grid_shape)
+    writer = ScanWriter(settings["general"]["writer_queue_size"], settings["general"]["writer_flush_interval"]).start()
+    info_path = os.path.join(folder, "saving_info.txt")
+    indices = list(np.ndindex(*grid_shape))
+    timer.start()
+    try:
+        for i, grid_index in enumerate(indices):
+            now = time.time()
+            writer.write_pulse(cube, pulses[i % len(pulses)], [float(v) for v in grid_index], now, grid_index,
+                               info_path, time.strftime('%Y-%m-%d %H:%M:%S.000000'))
+            if i < len(indices) - 1:
+                timer.point()
+    finally:
+        writer.close()
+        cube.close()
+    timer.point()
+
+
+def benchmark_loaders(settings: dict, timer: PointTimer):
+    """
+    Analysis path of the scan written by the saving benchmark: featurize_store, load_scan_index without and
+    with the parse cache, and image_builder. Each of the four steps counts as one point.
+    """
+    from scanimage import image_builder
+    from scanindex import SIDECAR_SUFFIX, load_scan_index
+    from tracefeatures import featurize_store
+
+    folder = settings["general"]["measurement_savefolder"]
+    info_path = os.path.join(folder, "saving_info.txt")
+    if not os.path.exists(info_path):
+        benchmark_saving(settings, PointTimer())
+    if os.path.exists(info_path + SIDECAR_SUFFIX):
+        os.remove(info_path + SIDECAR_SUFFIX)
+
+    timer.start()
+    featurize_store(os.path.join(folder, "pulses", "saving"))
+    timer.point()
+    load_scan_index(info_path)
+    timer.point()
+    scan = load_scan_index(info_path)
+    timer.point()
+    image_builder(scan["x"], scan["y"]).image(scan["values"])
+    timer.point()
+
+
+BENCHMARKS = {
+    "scan": benchmark_scan,
+    "calibration": benchmark_calibration,
+    "plotter": benchmark_plotter,
+    "saving": benchmark_saving,
+    "loaders": benchmark_loaders,
+}
+
+
+def benchmark_settings(args, folder: str) -> dict:
+    settings = get_settings()
+    simulation = settings["simulation"]
+    simulation["enabled"] = True
+    simulation["time_scale"] = args.time_scale
+    simulation["settle_time"] = args.settle_time
+    simulation["trace_time"] = args.trace_time
+    simulation["connect_time"] = 0.
+    if args.stage_speed is not None:
+        simulation["stage_speeds"] = [args.stage_speed] * 3
+    center = simulation["bean_center"]
+    half_size = 1.2 * np.array(simulation["bean_semi_axes"])
+    settings["stagegridmover"].update(
+        x_min=center[0] - half_size[0], x_max=center[0] + half_size[0], x_n=args.grid[0],
+        y_min=center[1] - half_size[1], y_max=center[1] + half_size[1], y_n=args.grid[1],
+        z_min=center[2], z_max=center[2], z_n=1)
+    general = settings["general"]
+    general["measurement_savefolder"] = folder
+    general["measurement_name"] = "benchmark_info.txt"
+    general["measurement_name_screen"] = "benchmark_info_screening.txt"
+    general["pulse_store_name"] = "benchmark"
+    general["pulse_store_name_screen"] = "benchmark-screening"
+    return settings
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Names of the metrics that regressed by more than tolerance (fraction) against the baseline, and of the
+    benchmarks the baseline does not have.
+    """
+    failures = []
+    for result in results:
+        if result.name not in baseline:
+            print(f"{result.name:<12} no baseline")
+            failures.append(f"{result.name} (no baseline)")
+            continue
+        for metric, better in COMPARED_METRICS.items():
+            reference = baseline[result.name][metric]
+            value = result.metrics[metric]
+            if reference <= 0:
+                continue
+            change = (value - reference) / reference
+            regressed = better * change < -tolerance
+            print(f"{result.name:<12} {metric:<16} {value:>12.2f} baseline {reference:>12.2f} ({change:+.0%})"
+                  f"{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                failures.append(f"{result.name}.{metric}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan throughput benchmarks against the simulated hardware")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run out of {', '.join(BENCHMARKS)}, default all")
+    parser.add_argument("--grid", type=int, nargs=2, default=[40, 40], metavar=("X_N", "Y_N"), help="scan grid size")
+    parser.add_argument("--time-scale", type=float, default=0.001, help="real s per simulated hardware s")
+    parser.add_argument("--settle-time", type=float, default=0.05, help="simulated s after every stage move")
+    parser.add_argument("--trace-time", type=float, default=0.01, help="simulated s per averaged trace")
+    parser.add_argument("--stage-speed", type=float, default=None, help="simulated stage speed in mm/s")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline json file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed regression as a fraction")
+    parser.add_argument("--no-memory", action="store_true", help="skip memory tracing, which slows allocations down")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks {unknown}, choose from {list(BENCHMARKS)}")
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name in args.benchmarks or list(BENCHMARKS):
+            settings = benchmark_settings(args, folder)
+            result = run_benchmark(name, BENCHMARKS[name], settings, trace_memory=not args.no_memory)
+            print(result)
+            results.append(result)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update({result.name: result.metrics for result in results})
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"FAILED: no baseline at {args.baseline}, run with --save-baseline to create one")
+        return 1
+    with open(args.baseline) as file:
+        failures = compare(results, json.load(file), args.tolerance)
+    if failures:
+        print(f"FAILED: {', '.join(failures)}, regressions are changes of more than {args.tolerance:.0%}")
+        return 1
+    print("All benchmarks within tolerance of the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
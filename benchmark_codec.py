@@ -0,0 +1,116 @@
+"""
+Size and speed of the trace encodings of tracecodec.
+
+    python benchmark_codec.py                               simulated traces across the bean
+    python benchmark_codec.py measurements/2024-01-15/pulses/12-00-00 --rows 2048
+
+For every encoding the traces are packed in chunks as pack_store does and decoded again. Reports the size of the
+field relative to float64 with a time axis per trace (the unpacked store), the encode and decode throughput,
+the time to read single random rows and the largest read-back error relative to the documented bound.
+"""
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+from settings import get_settings
+from tracecodec import check_codec, decode_chunk, encode_chunk, error_bound, row_scales
+
+DTYPES = ("int16", "float32")
+FILTERS = ("none", "shuffle", "delta")
+COMPRESSORS = ("none", "zlib", "lzma")
+
+
+def simulated_traces(rows: int) -> np.ndarray:
+    """
+    (rows, samples) corrected fields of the simulated TeraFlash at random positions in and around the bean.
+    """
+    from fakeenvironment import Simulation
+
+    settings = get_settings()
+    simulation_settings = dict(settings["simulation"], time_scale=0.)
+    simulation = Simulation(simulation_settings, settings["teraflash"])
+    rng = np.random.default_rng(simulation_settings["seed"])
+    center = np.array(simulation_settings["bean_center"])
+    semi_axes = np.array(simulation_settings["bean_semi_axes"])
+    traces = []
+    for _ in range(rows):
+        for stage, position in zip(simulation.stages, center + rng.uniform(-1.5, 1.5, 3) * semi_axes):
+            stage.pos = position
+        traces.append(simulation.teraflash.get_corrected_pulse().E())
+    return np.array(traces)
+
+
+def store_traces(folder: str, rows: int) -> np.ndarray:
+    from pulsestore import PulseStore
+
+    columns = PulseStore.load(folder)
+    written = np.flatnonzero(~np.isnan(columns["timestamps"]))[:rows]
+    return np.asarray(columns["E"][written], dtype=np.float64)
+
+
+def benchmark_encoding(E: np.ndarray, settings: dict, random_reads: int = 50) -> dict:
+    chunk_rows = settings["chunk_rows"]
+    chunks = []
+    start_time = time.perf_counter()
+    for start in range(0, len(E), chunk_rows):
+        chunk = E[start:start + chunk_rows]
+        scales = row_scales(chunk)
+        chunks.append((encode_chunk(chunk, settings, scales), scales, chunk.shape))
+    encode_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    decoded = np.concatenate([decode_chunk(data, settings, shape, scales) for data, scales, shape in chunks])
+    decode_time = time.perf_counter() - start_time
+
+    rng = np.random.default_rng(0)
+    start_time = time.perf_counter()
+    for row in rng.integers(0, len(E), random_reads):
+        data, scales, shape = chunks[row // chunk_rows]
+        decode_chunk(data, settings, shape, scales)[row % chunk_rows]
+    random_read_time = (time.perf_counter() - start_time) / random_reads
+
+    raw = 2 * E.nbytes  # t and E as float64, one time axis per trace
+    packed = sum(len(data) for data, _, _ in chunks) + (8 * len(E) if settings["trace_dtype"] == "int16" else 0) \
+        + 8 * E.shape[1]
+    bound = error_bound(E, settings)
+    return {
+        "ratio": packed / raw,
+        "encode_mb_s": E.nbytes / 1e6 / encode_time,
+        "decode_mb_s": E.nbytes / 1e6 / decode_time,
+        "random_read_ms": random_read_time * 1e3,
+        "error_to_bound": float(np.max(np.abs(decoded - E) / np.where(bound > 0, bound, np.inf))),
+        "max_error": float(np.max(np.abs(decoded - E))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Size and speed of the trace encodings")
+    parser.add_argument("store", nargs="?", help="pulse store to take the traces from, simulated traces if not given")
+    parser.add_argument("--rows", type=int, default=1024, help="traces to encode")
+    parser.add_argument("--chunk-rows", type=int, default=get_settings()["storage"]["chunk_rows"])
+    parser.add_argument("--level", type=int, help="zlib level and lzma preset, default from the storage settings")
+    args = parser.parse_args()
+
+    E = store_traces(args.store, args.rows) if args.store else simulated_traces(args.rows)
+    level = get_settings()["storage"]["level"] if args.level is None else args.level
+    print(f"{len(E)} traces of {E.shape[1]} samples, {2 * E.nbytes / 1e6:.1f} MB unpacked, "
+          f"peak field {np.abs(E).max():.3g}")
+    print(f"{'dtype':<8} {'filter':<8} {'compressor':<10} {'size':>7} {'encode':>11} {'decode':>11} "
+          f"{'random row':>11} {'max error':>10} {'of bound':>9}")
+    for trace_dtype, trace_filter, compressor in itertools.product(DTYPES, FILTERS, COMPRESSORS):
+        settings = {"trace_dtype": trace_dtype, "filter": trace_filter, "compressor": compressor, "level": level,
+                    "chunk_rows": args.chunk_rows}
+        try:
+            check_codec(settings)
+        except ValueError:
+            continue
+        result = benchmark_encoding(E, settings)
+        print(f"{trace_dtype:<8} {trace_filter:<8} {compressor:<10} {result['ratio']:>7.1%} "
+              f"{result['encode_mb_s']:>6.0f} MB/s {result['decode_mb_s']:>6.0f} MB/s {result['random_read_ms']:>8.2f} ms "
+              f"{result['max_error']:>10.2e} {result['error_to_bound']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Import time of the entry points, each measured in fresh interpreters.
+
+    python benchmark_imports.py                 all entry points, 5 runs each
+    python benchmark_imports.py scan_cli -n 10
+
+Reports the median import time and which of the heavy dependencies (GUI, plotting, device drivers) the import
+pulled in. A headless scan only pays for what scan_cli and TFCCoffeebean import at module level.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ENTRY_POINTS = ("scan_cli", "TFCCoffeebean", "stagemovers", "gui_main")
+HEAVY_MODULES = ("matplotlib", "PyQt5", "guiqwt", "qwt", "Devices", "zaber_motion", "scipy")
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+print(json.dumps([duration, [name for name in {heavy} if name in sys.modules]]))
+"""
+
+
+def measure_import(module: str, runs: int) -> tuple:
+    """
+    Median import time in s and the heavy modules loaded, or (None, error) if the import fails.
+    """
+    durations = []
+    loaded = []
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", MEASURE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=folder, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        duration, loaded = json.loads(result.stdout.strip().splitlines()[-1])
+        durations.append(duration)
+    return float(np.median(durations)), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the entry points")
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_POINTS))
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    args = parser.parse_args()
+    for module in args.modules:
+        duration, loaded = measure_import(module, args.runs)
+        if duration is None:
+            print(f"{module:<16} import failed: {loaded}")
+            continue
+        print(f"{module:<16} {duration * 1e3:8.1f} ms   loads: {', '.join(loaded) if loaded else '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 
 import time
 import logging
+import threading
+import contextvars
 import numpy as np
 
+from arraypulse import ArrayPulse
+
 global realworld_positions
 realworld_positions = [0, 0, 0]
 
@@ -20,7 +24,6 @@ class FakePulse:
             meas = 100
         else:
             meas = 0.5
-        logging.debug(f"{meas}, {self.bean_center}, {self.position}, {distance}")
         return meas
 
 class FakeTFC:
@@ -37,13 +40,18 @@ class FakeTFC:
     def set_averaging(self, n):
         self.averaging = n
 
-    def get_corrected_pulse(self, position):
+    def get_corrected_pulse(self):
         time.sleep(self.averaging/10000)
-        return FakePulse(position)
+        return FakePulse(list(realworld_positions))
+
+class FakeCommandFailedException(Exception):
+    # Stands in for zaber_motion.BinaryCommandFailedException when no real stages are connected
+    pass
+
 
 class FakeConnection:
-        def __init__(self):
-            time.sleep(1)
+        def __init__(self, connect_time: float = 1):
+            time.sleep(connect_time)
             pass
             
         def close(self):
@@ -75,4 +83,270 @@ class FakeStage:
         self.pos = self.pos + position
         global realworld_positions
         realworld_positions[self.device_id] = self.pos
-        return self.pos
\ No newline at end of file
+        return self.pos
+
+SPEED_OF_LIGHT = 0.299792458  # mm/ps
+MIN_TRACE_INTERVAL = 0.001  # real s between simulated traces, keeps the trace hub from spinning
+
+
+class _Timeline:
+    # Hardware time of one thread of the simulation, see VirtualClock
+    def __init__(self, time: float, thread: int, parent=None):
+        self.time = time
+        self.thread = thread
+        self.parent = parent
+        self.children_end = time  # latest end of the sleeps of the work this thread handed to others
+
+
+class VirtualClock:
+    """
+    Time source of the simulation. In virtual mode sleep advances the clock and only waits time_scale times
+    as long, so a long scan simulates in seconds while now() still reports the time the hardware would have taken.
+    All threads share one timeline: the sleeps of a thread follow each other, work handed to a pool with
+    contextvars.copy_context (e.g. parallel stage moves) starts at the time of the thread that handed it over,
+    so concurrent sleeps overlap, and that thread carries on once the longest of them is over.
+    """
+
+    def __init__(self, virtual: bool = True, time_scale: float = 0.):
+        self.virtual = virtual
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.virtual_time = 0.
+        self.timeline = contextvars.ContextVar(f"timeline_{id(self)}", default=None)
+
+    def _current_timeline(self) -> _Timeline:
+        timeline = self.timeline.get()
+        thread = threading.get_ident()
+        if timeline is None:
+            # A thread on its own joins at the latest time of the clock
+            timeline = _Timeline(self.virtual_time, thread)
+            self.timeline.set(timeline)
+        elif timeline.thread != thread:
+            # Work handed over by another thread starts where that thread is
+            timeline = _Timeline(timeline.time, thread, timeline)
+            self.timeline.set(timeline)
+        timeline.time = max(timeline.time, timeline.children_end)
+        return timeline
+
+    def sleep(self, seconds: float):
+        if seconds <= 0:
+            return
+        if not self.virtual:
+            time.sleep(seconds)
+            return
+        with self.lock:
+            timeline = self._current_timeline()
+            timeline.time += seconds
+            parent = timeline.parent
+            while parent is not None:
+                parent.children_end = max(parent.children_end, timeline.time)
+                parent = parent.parent
+            self.virtual_time = max(self.virtual_time, timeline.time)
+        if self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def now(self) -> float:
+        """
+        Hardware time in s since the clock started.
+        """
+        if not self.virtual:
+            return time.perf_counter() - self.start
+        return self.virtual_time
+
+
+class BeanModel:
+    """
+    Ellipsoidal bean in stage coordinates. A beam along beam_axis through the stage position crosses a chord of
+    length L, which delays the pulse by (n - 1) L / c and attenuates every frequency by exp(-alpha(f) L),
+    alpha(f) = absorption * f / 1 THz (amplitude, 1/mm).
+    """
+
+    def __init__(self, settings: dict):
+        self.center = np.array(settings["bean_center"], dtype=float)
+        self.semi_axes = np.array(settings["bean_semi_axes"], dtype=float)
+        self.refractive_index = settings["refractive_index"]
+        self.absorption = settings["absorption"]
+        self.beam_axis = settings["beam_axis"]
+
+    def chord(self, position) -> float:
+        relative = (np.asarray(position, dtype=float) - self.center) / self.semi_axes
+        across = np.delete(relative, self.beam_axis)
+        r2 = float(np.dot(across, across))
+        if r2 >= 1:
+            return 0.
+        return 2 * self.semi_axes[self.beam_axis] * np.sqrt(1 - r2)
+
+
+class _Signal:
+    # Stand-in for the Qt state signals of the TeraFlash client
+    def connect(self, slot):
+        pass
+
+
+class SimulatedTFC:
+    """
+    Simulated TeraFlash with the interface of TFC. Every trace takes averaging * trace_time seconds of hardware time,
+    charged to the consumer that waits for it (wait_for_trace), and shows the reference pulse transmitted through the bean at the current stage position, plus noise
+    that drops with the square root of the averaging.
+    """
+
+    def __init__(self, teraflash_settings: dict, settings: dict, clock: VirtualClock, bean: BeanModel, get_position):
+        self.teraflash_settings = teraflash_settings
+        self.settings = settings
+        self.clock = clock
+        self.bean = bean
+        self.get_position = get_position
+        self.averaging = teraflash_settings["TFC_AVERAGING"]
+        self.begin = teraflash_settings["TFC_BEGIN"]
+        self.range = teraflash_settings["TFC_RANGE"]
+        self.started = False
+        self.rng = np.random.default_rng(settings["seed"])
+        self.signal_acq_state = _Signal()
+        self.signal_laser_state = _Signal()
+        self._update_time_axis()
+
+    def _update_time_axis(self):
+        spacing = self.settings["sample_spacing"]
+        self.time_axis = self.begin + np.arange(int(round(self.range / spacing))) * spacing
+        # Reference pulse: first derivative of a Gaussian, a single cycle THz transient
+        tau = self.settings["pulse_width"]
+        relative = (self.time_axis - (self.begin + self.settings["pulse_position"] * self.range)) / tau
+        self.reference = -self.settings["amplitude"] * relative * np.exp(-relative ** 2)
+        self.reference_spectrum = np.fft.rfft(self.reference)
+        self.frequencies = np.fft.rfftfreq(len(self.time_axis), spacing)
+
+    def connect_teraflash(self):
+        self.clock.sleep(self.settings["connect_time"])
+        return "Simulated TeraFlash"
+
+    def connect(self):
+        return self.connect_teraflash()
+
+    def start_laser(self):
+        self.started = True
+        logging.info("Simulated laser started")
+
+    def start(self, wait=True):
+        self.started = True
+
+    def running(self):
+        return self.started
+
+    def set_averaging(self, n):
+        self.averaging = int(n)
+
+    def set_begin(self, begin):
+        self.begin = begin
+        self._update_time_axis()
+
+    def set_range(self, time_range):
+        self.range = time_range
+        self._update_time_axis()
+
+    def trace_duration(self) -> float:
+        return self.averaging * self.settings["trace_time"]
+
+    def wait_for_trace(self):
+        """
+        Charges the acquisition of one trace to the thread that waits for it. With a virtual clock the traces
+        themselves take no hardware time, so a trace hub that runs while nobody waits does not advance the clock.
+        """
+        if self.clock.virtual:
+            self.clock.sleep(self.trace_duration())
+
+    def get_next_trace(self):
+        if self.clock.virtual:
+            # Only paces the trace hub in real time, see wait_for_trace
+            time.sleep(max(self.trace_duration() * self.clock.time_scale, MIN_TRACE_INTERVAL))
+        else:
+            self.clock.sleep(self.trace_duration())
+        position = list(self.get_position())
+        chord = self.bean.chord(position)
+        delay = (self.bean.refractive_index - 1) * chord / SPEED_OF_LIGHT
+        transmission = np.exp(-self.bean.absorption * self.frequencies * chord - 2j * np.pi * self.frequencies * delay)
+        field = np.fft.irfft(self.reference_spectrum * transmission, len(self.time_axis))
+        noise = self.settings["noise"] / np.sqrt(self.averaging)
+        field = field + self.settings["offset"] + self.rng.normal(0, noise, len(field))
+        return ArrayPulse(self.time_axis, field, position=position)
+
+    def get_corrected_pulse(self):
+        return self.correct_offset(self.get_next_trace())
+
+    def correct_offset(self, pulse):
+        offset = pulse.E()[0:10].mean()
+        pulse.subtract_offset(offset)
+        return pulse
+
+
+class SimulatedStage:
+    """
+    Simulated linear stage with the device interface StageMover uses. Moves take distance / speed + settle_time
+    seconds on the clock.
+    """
+
+    def __init__(self, device_id: int, clock: VirtualClock, speed: float, settle_time: float, position: float = 25):
+        self.device_id = device_id
+        self.clock = clock
+        self.speed = speed
+        self.settle_time = settle_time
+        self.pos = position
+
+    def _travel(self, target):
+        self.clock.sleep(abs(target - self.pos) / self.speed + self.settle_time)
+        self.pos = target
+        return self.pos
+
+    def move_absolute(self, position, unit="s"):
+        return self._travel(position)
+
+    def move_relative(self, position, unit="s"):
+        return self._travel(self.pos + position)
+
+    def get_position(self, unit="s"):
+        return self.pos
+
+    def home(self):
+        self._travel(0)
+
+
+class Simulation:
+    """
+    Bundles a virtual clock, a bean model, three simulated stages and a simulated TeraFlash that sees the bean
+    at the position of the stages.
+
+    example settings = {
+        virtual_clock: True,
+        time_scale: 0.001,  # real s per simulated s
+        seed: 0,
+        bean_center: [93.4, 33.8, 24],  # mm, stage coordinates
+        bean_semi_axes: [5, 4, 3.5],  # mm
+        refractive_index: 1.6,
+        absorption: 0.4,  # 1/mm at 1 THz
+        beam_axis: 2,
+        stage_speeds: [5, 5, 5],  # mm/s
+        settle_time: 0.05,  # s
+        trace_time: 0.01,  # s per averaged trace
+        connect_time: 1,  # s
+        sample_spacing: 0.05,  # ps
+        pulse_position: 0.3,  # fraction of the range
+        pulse_width: 0.25,  # ps
+        amplitude: 100,
+        noise: 0.5,
+        offset: 2,
+    }
+    """
+
+    def __init__(self, settings: dict, teraflash_settings: dict):
+        self.settings = settings
+        self.clock = VirtualClock(settings["virtual_clock"], settings["time_scale"])
+        self.bean = BeanModel(settings)
+        self.stages = [SimulatedStage(i, self.clock, settings["stage_speeds"][i], settings["settle_time"]) for i in range(3)]
+        self.teraflash = SimulatedTFC(teraflash_settings, settings, self.clock, self.bean,
+                                      lambda: [stage.pos for stage in self.stages])
+        self.wall_start = time.perf_counter()
+
+    def report(self):
+        wall_time = time.perf_counter() - self.wall_start
+        logging.info(f"Simulation: {self.clock.now():.1f} s hardware time in {wall_time:.1f} s wall time")
+        return self.clock.now(), wall_time
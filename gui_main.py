@@ -6,28 +6,33 @@ from datetime import datetime
 from functools import partial
 import logging
 
-from settings import get_settings
+from settings import get_settings, load_settings
 from logger_settings import configure_logger, create_folder_if_not_exists
 from TFCCoffeebean import TFCCoffeeBean
-from Devices.TeraFlashClient.Pulse import TFPulse
+from traceframes import TraceFrame
 from Devices.TeraFlashClient import State
 from guiqwt.curve import CurvePlot
 from guiqwt.builder import make
 from qwt import QwtPlot
 import threading
 import time
+import queue
 
 # Worker class handling device operations in a separate thread
 class TFCCofffeebeanWorker(QObject):
     connected_stagemover = pyqtSignal(bool)
     connected_teraflash = pyqtSignal(bool)
-    trace = pyqtSignal(TFPulse)
+    frame = pyqtSignal(TraceFrame)
     updated_position = pyqtSignal(list)
     message_sent = pyqtSignal(str)
 
     def __init__(self, tfccoffeebean:TFCCoffeeBean):
         super().__init__()
         self.tfccoffeebean = tfccoffeebean
+        self.min_frame_interval = 1 / self.tfccoffeebean.settings["gui"]["max_redraw_rate"]
+        self.frame_points = 2000  # curve points per frame, set to the plot width by the GUI
+        self.frame_pending = False  # a frame was emitted and the GUI did not draw it yet
+        self.last_frame_time = 0
 
     def update_settings(self, settings:dict):
         self.tfccoffeebean.settings = settings
@@ -48,13 +53,30 @@ class TFCCofffeebeanWorker(QObject):
     @pyqtSlot()
     def continous_measurement_collector(self):
         self.stopped = False
+        subscription = self.tfccoffeebean.trace_hub.subscribe("latest")
         while not self.stopped:
             try:
-                self.current_pulse = self.tfccoffeebean.teraflash.get_corrected_pulse()
-                self.trace.emit(self.current_pulse)
+                trace = subscription.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.current_pulse = trace.pulse
+                self.emit_frame(self.current_pulse)
             except Exception as e:
                 logging.warning(f"Error making THz measurement: {e}")
-            time.sleep(0.05)
+        self.tfccoffeebean.trace_hub.unsubscribe(subscription)
+
+    def emit_frame(self, pulse):
+        """
+        Emits the pulse as a preprocessed TraceFrame, at most max_redraw_rate times per second and only once the GUI
+        drew the previous frame. Traces arriving in between are dropped from the live view.
+        """
+        now = time.perf_counter()
+        if self.frame_pending or now - self.last_frame_time < self.min_frame_interval:
+            return
+        self.last_frame_time = now
+        self.frame_pending = True
+        self.frame.emit(TraceFrame(pulse, self.frame_points))
 
     @pyqtSlot()
     def measure_trace(self):
@@ -100,11 +122,8 @@ class TFCCofffeebeanWorker(QObject):
         gridmover_thread.daemon = True
         gridmover_thread.start()
 
-# Your settings dictionary
-settings = get_settings()
-
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, settings: dict):
         super().__init__()
         self.settings = settings
         self.TFC = TFCCoffeeBean(self.settings)
@@ -196,7 +215,7 @@ class MainWindow(QWidget):
         self.connect_teraflash_button = QPushButton("Connect", self)
         self.connect_teraflash_button.clicked.connect(self.connect_teraflash)
         ip_label = QLabel("IP:")
-        ip_entry = QLineEdit(str(settings['teraflash']['toptica_IP']))
+        ip_entry = QLineEdit(str(self.settings['teraflash']['toptica_IP']))
         ip_entry.setFixedSize(100, 30)
         ip_entry.textChanged.connect(self.update_toptica_ip)
         layout = QHBoxLayout()
@@ -217,7 +236,7 @@ class MainWindow(QWidget):
         self.connect_stagemover_button = QPushButton("Connect", self)
         self.connect_stagemover_button.clicked.connect(self.connect_stagemover)
         com_label = QLabel("COM:")
-        port_entry = QLineEdit(str(settings['stagemover']['port']))
+        port_entry = QLineEdit(str(self.settings['stagemover']['port']))
         port_entry.setFixedSize(100, 30)
         port_entry.textChanged.connect(self.update_stagemover_port)
         layout = QHBoxLayout()
@@ -236,7 +255,7 @@ class MainWindow(QWidget):
         settings_group_box = []
         #settings_group_box = QGroupBox("Settings")
 
-        for category, values in settings.items():
+        for category, values in self.settings.items():
             layout = QVBoxLayout()
             settings_group_box.append(QGroupBox(f"{category.capitalize()}"))
             #layout.addWidget(QLabel(category.capitalize() + ":"))
@@ -270,19 +289,20 @@ class MainWindow(QWidget):
         except Exception as e:
             logging.warning(f"Step size ({size}) not convertable to float, leaving it as {self.step_size}.")
 
-    def update_plot(self, updated_trace):
-        self.curve_time.set_data(updated_trace.t(), updated_trace.E())
+    def update_plot(self, frame):
+        self.curve_time.set_data(frame.t, frame.E)
         self.plot_time.replot()
-        self.curve_freq.set_data(updated_trace.f(), updated_trace.S())
+        self.curve_freq.set_data(frame.f, frame.S)
         self.plot_freq.replot()
 
-        pp_trace = updated_trace.E().max() - updated_trace.E().min()
-        energy_trace = updated_trace.energy()
-        pp_str = '%.2f' % pp_trace
-        energy_str = '%.2f' % energy_trace
+        pp_str = '%.2f' % frame.peak_peak
+        energy_str = '%.2f' % frame.energy
         self.peakpeak.set_text('%-20s %s<br>%-20s        %s' % \
                                ('peak-peak (nA):', pp_str, \
                                 'energy:', energy_str))
+        # min/max decimation keeps two points per bin, so one bin per pixel column
+        self.TFCCofffeebeanWorker.frame_points = 2 * max(self.plot_time.width(), self.plot_freq.width())
+        self.TFCCofffeebeanWorker.frame_pending = False
 
     def autoscale(self):
         self.plot_time.do_autoscale(replot=False)
@@ -378,7 +398,7 @@ class MainWindow(QWidget):
         spinBoxRange.valueChanged.connect(self.update_range)
 
 
-        self.TFCCofffeebeanWorker.trace.connect(lambda trace: self.update_plot(trace))
+        self.TFCCofffeebeanWorker.frame.connect(lambda frame: self.update_plot(frame))
 
         self.plot_time = CurvePlot()
         self.curve_time = make.curve([], [], color='b', title='pulse')
@@ -493,7 +513,7 @@ class MainWindow(QWidget):
         self.connection_status_teraflash.setText("Teraflash: Connecting...")
         self.connection_status_teraflash.setStyleSheet("color: gray")
         QApplication.processEvents()
-        logging.info(f"Connecting to teraflash at {settings['teraflash']['toptica_IP']}...")
+        logging.info(f"Connecting to teraflash at {self.settings['teraflash']['toptica_IP']}...")
         self.TFCCofffeebeanWorker.connected_teraflash.connect(lambda status: self.update_teraflash_status(status))
         self.TFCCofffeebeanWorker.connect_teraflash()
         self.TFCCofffeebeanWorker.start_continous_measurement_collector_thread()
@@ -536,8 +556,10 @@ class MainWindow(QWidget):
 
 def main():
     configure_logger()
+    # Optional settings file as first argument, see settings.load_settings
+    settings = load_settings(sys.argv[1]) if len(sys.argv) > 1 else get_settings()
     app = QApplication(sys.argv)
-    window = MainWindow()
+    window = MainWindow(settings)
     window.show()
 
     sys.exit(app.exec_())
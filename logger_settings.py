@@ -1,8 +1,26 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 from datetime import datetime
 
+_listener: logging.handlers.QueueListener = None
+
+
 def configure_logger():
+    """
+    Routes the root logger through a queue: logging calls only enqueue the record, a listener thread formats it
+    and writes it to the debug log, the info log and the console. Returns the listener, which is stopped
+    (flushing all queued records) at exit or by stop_logger.
+    """
+    global _listener
+    stop_logger()
+    # Attached first, so records logged while the handlers are set up wait in the queue
+    log_queue = queue.SimpleQueue()
+    logging.root.addHandler(logging.handlers.QueueHandler(log_queue))
+    logging.root.setLevel(logging.DEBUG)
+
     filename_time = datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
     create_folder_if_not_exists(f'./logs')
     file_handler = logging.FileHandler(f'./logs/debug_log_{filename_time}.log')
@@ -18,10 +36,62 @@ def configure_logger():
     file_handler.setFormatter(formatter)
     file_handler_warning.setFormatter(formatter)
     console_handler.setFormatter(formatter)
-    logging.root.addHandler(file_handler)
-    logging.root.addHandler(file_handler_warning)
-    logging.root.addHandler(console_handler)
-    logging.root.setLevel(logging.DEBUG)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, file_handler_warning, console_handler,
+                                               respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logger():
+    """
+    Writes all queued log records and stops the listener thread of configure_logger.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    for handler in [h for h in logging.root.handlers if isinstance(h, logging.handlers.QueueHandler)]:
+        logging.root.removeHandler(handler)
+    _listener = None
+
+
+atexit.register(stop_logger)
+
+
+class ScanLog:
+    """
+    Structured per-point record of a scan, one CSV row per point with the columns given at creation.
+    Rows are collected in memory and appended to the file every buffer_rows rows and on close,
+    so per-point detail costs no write of its own and stays out of the text logs.
+    """
+
+    def __init__(self, path: str, columns: tuple, buffer_rows: int = 500):
+        self.path: str = path
+        self.columns: tuple = columns
+        self.buffer_rows: int = buffer_rows
+        self.rows: list = []
+        if not os.path.exists(path):
+            with open(path, 'w') as file:
+                file.write(",".join(columns) + "\n")
+
+    def write(self, *values):
+        self.rows.append(",".join(str(value) for value in values) + "\n")
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        with open(self.path, 'a') as file:
+            file.writelines(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
 
 def create_folder_if_not_exists(folder_path):
     # Check if the folder exists
@@ -0,0 +1,74 @@
+"""
+Packs the finished pulse stores under a folder into the compact trace encoding of tracecodec, or unpacks them.
+
+    python pack_stores.py ./measurements
+    python pack_stores.py ./measurements/2024-01-15 --compressor lzma --level 9
+    python pack_stores.py ./measurements/2024-01-15/pulses/12-00-00 --unpack
+
+Stores changed within the last --min-age seconds are skipped, they may still be written by a running scan.
+The encoding defaults to the "storage" settings.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from logger_settings import configure_logger
+from pulsestore import PulseStore
+from settings import get_settings
+from tracecodec import is_packed, pack_store, unpack_store
+
+
+def find_stores(root: str) -> list:
+    """
+    All pulse store folders under root, including root itself.
+    """
+    stores = []
+    for folder, subfolders, files in os.walk(root):
+        subfolders.sort()
+        if PulseStore.META_FILE in files:
+            stores.append(folder)
+    return stores
+
+
+def main():
+    storage = get_settings()["storage"]
+    parser = argparse.ArgumentParser(description="Pack or unpack pulse stores")
+    parser.add_argument("root", nargs="?", default="./measurements", help="folder to search for pulse stores")
+    parser.add_argument("--unpack", action="store_true", help="restore t.npy and E.npy of packed stores")
+    parser.add_argument("--trace-dtype", choices=("int16", "float32"), default=storage["trace_dtype"])
+    parser.add_argument("--filter", choices=("none", "shuffle", "delta"), default=storage["filter"])
+    parser.add_argument("--compressor", choices=("none", "zlib", "lzma"), default=storage["compressor"])
+    parser.add_argument("--level", type=int, default=storage["level"])
+    parser.add_argument("--chunk-rows", type=int, default=storage["chunk_rows"])
+    parser.add_argument("--min-age", type=float, default=600, help="s since the last change of a store")
+    args = parser.parse_args()
+    storage.update(trace_dtype=args.trace_dtype, filter=args.filter, compressor=args.compressor, level=args.level,
+                   chunk_rows=args.chunk_rows)
+
+    configure_logger()
+    raw = packed = 0
+    for folder in find_stores(args.root):
+        if args.unpack:
+            unpack_store(folder)
+            continue
+        if is_packed(folder):
+            continue
+        if time.time() - os.path.getmtime(os.path.join(folder, PulseStore.META_FILE)) < args.min_age:
+            logging.info(f"Skipping {folder}, changed less than {args.min_age:.0f} s ago")
+            continue
+        try:
+            sizes = pack_store(folder, storage)
+        except Exception as e:
+            logging.warning(f"Packing {folder} failed: {e}")
+            continue
+        raw += sizes.get("raw", 0)
+        packed += sizes.get("packed", 0)
+    if raw:
+        logging.info(f"Packed traces: {raw / 1e6:.1f} MB -> {packed / 1e6:.1f} MB ({packed / raw:.1%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
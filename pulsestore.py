@@ -0,0 +1,279 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+class PulseStore:
+    """
+    Scan-level container for THz traces, replacing the one-file-per-trace saving.
+
+    A store is a folder holding one preallocated .npy file per column:
+        t.npy           (capacity, samples)  time axis of every trace
+        E.npy           (capacity, samples)  offset corrected electric field of every trace
+        positions.npy   (capacity, 3)        stage position (x, y, z) in mm, NaN if unknown
+        timestamps.npy  (capacity,)          POSIX time of the measurement, NaN for unwritten rows
+        meta.json       sample count, capacity and number of written rows
+    Traces of an adaptive averaging run (pulses with traces and snr attributes, see arraypulse.ArrayPulse)
+    add two optional columns, created on the first such trace:
+        traces.npy      (capacity,)          number of averaged traces, NaN for rows without
+        snr.npy         (capacity,)          signal to noise ratio reached by the average
+    A finished store can be packed by tracecodec.pack_store, which replaces t.npy and E.npy by a compressed
+    encoding (packed.json). Packed stores are read like any other store, but can no longer be written.
+    The files are memory mapped, so storing a trace is a write into an already open file.
+    When the capacity runs out the columns grow by chunk_size rows.
+
+    With a grid_shape (x_n, y_n, z_n) the store is a scan cube instead: all grid points are preallocated,
+    row = np.ravel_multi_index(grid_index, grid_shape), traces are written in place with write_at and
+    load_cube returns the columns as (x_n, y_n, z_n, ...) memory maps, so an xy plane or a z line
+    can be sliced straight from disk.
+    """
+
+    META_FILE = "meta.json"
+    COLUMNS = ("t", "E", "positions", "timestamps")
+    OPTIONAL_COLUMNS = ("traces", "snr")
+    PACKED_FILE = "packed.json"
+
+    def __init__(self, folder: str, capacity: int = 0, chunk_size: int = 1024, flush_every: int = 50,
+                 grid_shape: tuple = None):
+        self.folder: str = folder
+        self.name: str = os.path.basename(os.path.normpath(folder))
+        self.chunk_size: int = chunk_size
+        self.flush_every: int = flush_every
+
+        self.samples: int = 0
+        self.capacity: int = 0
+        self.count: int = 0
+        self.columns: dict = {}
+        self.packed: bool = False
+        self.grid_shape: tuple = None if grid_shape is None else tuple(int(n) for n in grid_shape)
+        if self.grid_shape is not None:
+            capacity = int(np.prod(self.grid_shape))
+        self._requested_capacity: int = capacity
+        self._unflushed: int = 0
+
+        if os.path.exists(os.path.join(self.folder, self.META_FILE)):
+            self._open_existing()
+
+    def _open_existing(self):
+        with open(os.path.join(self.folder, self.META_FILE), 'r') as file:
+            meta = json.load(file)
+        self.samples = meta["samples"]
+        self.capacity = meta["capacity"]
+        if meta.get("grid_shape") is not None:
+            self.grid_shape = tuple(meta["grid_shape"])
+        self.packed = os.path.exists(os.path.join(self.folder, self.PACKED_FILE))
+        # A packed store has no t and E files, its other columns are opened so it can still be inspected
+        self.columns = {column: np.load(self._column_path(column), mmap_mode="r+") for column in self.COLUMNS
+                        if not (self.packed and column in ("t", "E"))}
+        for column in self.OPTIONAL_COLUMNS:
+            if os.path.exists(self._column_path(column)):
+                self.columns[column] = np.load(self._column_path(column), mmap_mode="r+")
+        self.count = _written_rows(meta, self.columns["timestamps"])
+        logging.debug(f"Opened pulse store {self.folder} with {self.count}/{self.capacity} rows")
+
+    def _column_path(self, column: str) -> str:
+        return os.path.join(self.folder, f"{column}.npy")
+
+    def _column_shape(self, column: str, rows: int) -> tuple:
+        if column in ("t", "E"):
+            return (rows, self.samples)
+        if column == "positions":
+            return (rows, 3)
+        return (rows,)
+
+    def _allocate(self, samples: int):
+        os.makedirs(self.folder, exist_ok=True)
+        self.samples = samples
+        if self.grid_shape is not None:
+            self.capacity = self._requested_capacity
+        else:
+            self.capacity = max(self._requested_capacity, self.chunk_size)
+        for column in self.COLUMNS:
+            self.columns[column] = open_memmap(self._column_path(column), mode="w+", dtype=np.float64,
+                                               shape=self._column_shape(column, self.capacity))
+        self.columns["positions"][:] = np.nan
+        self.columns["timestamps"][:] = np.nan
+        self._write_meta()
+        logging.info(f"Allocated pulse store {self.folder} for {self.capacity} traces of {samples} samples")
+
+    def _allocate_optional(self):
+        for column in self.OPTIONAL_COLUMNS:
+            self.columns[column] = open_memmap(self._column_path(column), mode="w+", dtype=np.float64,
+                                               shape=self._column_shape(column, self.capacity))
+            self.columns[column][:] = np.nan
+
+    def reserve(self, capacity: int):
+        """
+        Make sure at least "capacity" rows are allocated, e.g. the size of the grid that is about to be scanned.
+        """
+        if self.grid_shape is not None:
+            raise ValueError(f"Scan cube {self.folder} has a fixed size of {self.capacity} rows")
+        if not self.columns:
+            self._requested_capacity = max(self._requested_capacity, capacity)
+        elif capacity > self.capacity:
+            self._grow(capacity)
+
+    def _grow(self, capacity: int):
+        logging.debug(f"Growing pulse store {self.folder} from {self.capacity} to {capacity} rows")
+        for column in list(self.columns):
+            old = self.columns.pop(column)
+            old.flush()
+            tmp_path = self._column_path(column) + ".tmp"
+            new = open_memmap(tmp_path, mode="w+", dtype=np.float64, shape=self._column_shape(column, capacity))
+            new[:self.capacity] = old
+            if column not in ("t", "E"):
+                new[self.capacity:] = np.nan
+            new.flush()
+            del old, new
+            os.replace(tmp_path, self._column_path(column))
+            self.columns[column] = np.load(self._column_path(column), mmap_mode="r+")
+        self.capacity = capacity
+        self._write_meta()
+
+    def append(self, pulse, position=None, timestamp: float = None) -> int:
+        """
+        Store one trace in the next free row. Returns the row index.
+        """
+        if self.grid_shape is not None:
+            raise ValueError(f"Scan cube {self.folder} is written by grid index, use write_at")
+        field = self._check_samples(pulse)
+        if self.count >= self.capacity:
+            self._grow(self.capacity + self.chunk_size)
+        row = self.count
+        self._write_row(row, pulse, field, position, timestamp)
+        self.count += 1
+        return row
+
+    def write_at(self, grid_index, pulse, position=None, timestamp: float = None) -> int:
+        """
+        Store one trace at its (x, y, z) grid index of a scan cube. Returns the row index.
+        """
+        if self.grid_shape is None:
+            raise ValueError(f"Pulse store {self.folder} has no grid shape, use append")
+        field = self._check_samples(pulse)
+        row = int(np.ravel_multi_index(tuple(grid_index), self.grid_shape))
+        if np.isnan(self.columns["timestamps"][row]):
+            self.count += 1
+        self._write_row(row, pulse, field, position, timestamp)
+        return row
+
+    def _check_samples(self, pulse):
+        if self.packed:
+            raise ValueError(f"Pulse store {self.folder} is packed, unpack it with tracecodec.unpack_store to write to it")
+        field = np.asarray(pulse.E(), dtype=np.float64)
+        if not self.columns:
+            self._allocate(field.shape[0])
+        elif field.shape[0] != self.samples:
+            raise ValueError(f"Trace has {field.shape[0]} samples, store {self.folder} holds {self.samples}")
+        return field
+
+    def _write_row(self, row: int, pulse, field, position, timestamp):
+        # Assign straight into the memory maps, the trace is copied once: from the pulse into the file
+        self.columns["t"][row] = pulse.t()
+        self.columns["E"][row] = field
+        if position is not None:
+            self.columns["positions"][row] = position[:3]
+        self.columns["timestamps"][row] = time.time() if timestamp is None else timestamp
+        traces = getattr(pulse, "traces", None)
+        if traces is not None:
+            if "traces" not in self.columns:
+                self._allocate_optional()
+            self.columns["traces"][row] = traces
+            self.columns["snr"][row] = pulse.snr
+
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def written_mask(self) -> np.ndarray:
+        """
+        Boolean (x_n, y_n, z_n) array of the grid points of a scan cube that hold a trace.
+        """
+        if self.grid_shape is None:
+            raise ValueError(f"Pulse store {self.folder} has no grid shape")
+        if not self.columns:
+            return np.zeros(self.grid_shape, dtype=bool)
+        return ~np.isnan(np.asarray(self.columns["timestamps"])).reshape(self.grid_shape)
+
+    def reference(self, row: int) -> str:
+        """
+        Name of a stored trace as written in the measurement info files: "<store name>/<row>".
+        """
+        return f"{self.name}/{row}"
+
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+        self._write_meta()
+        self._unflushed = 0
+
+    def close(self):
+        if self.columns:
+            self.flush()
+
+    def _write_meta(self):
+        meta = {"samples": self.samples, "capacity": self.capacity, "count": self.count,
+                "grid_shape": None if self.grid_shape is None else list(self.grid_shape)}
+        tmp_path = os.path.join(self.folder, self.META_FILE + ".tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, os.path.join(self.folder, self.META_FILE))
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool = True) -> dict:
+        """
+        Read a store back as one array per column, trimmed to the written rows.
+        Scan cubes are not trimmed, unmeasured grid points have a NaN timestamp.
+        With mmap=True the arrays are read-only memory maps, so nothing is loaded until it is sliced.
+        In a packed store t and E are row-indexed views that decode the rows when sliced, see tracecodec.
+        """
+        meta, columns = cls._load_columns(folder, mmap)
+        if meta.get("grid_shape") is not None:
+            return columns
+        count = _written_rows(meta, columns["timestamps"])
+        # Packed columns only hold the written rows
+        return {column: values[:count] if isinstance(values, np.ndarray) else values for column, values in columns.items()}
+
+    @classmethod
+    def load_cube(cls, folder: str, mmap: bool = True) -> dict:
+        """
+        Read a scan cube back with every column shaped as (x_n, y_n, z_n, ...).
+        E.g. load_cube(folder)["E"][:, :, k] is the xy plane at z index k, ["E"][i, j] the z line at (i, j).
+        t and E of a packed store are decoded into memory.
+        """
+        meta, columns = cls._load_columns(folder, mmap)
+        if meta.get("grid_shape") is None:
+            raise ValueError(f"Pulse store {folder} is not a scan cube")
+        grid_shape = tuple(meta["grid_shape"])
+        return {column: np.asarray(values).reshape(grid_shape + values.shape[1:]) for column, values in columns.items()}
+
+    @classmethod
+    def _load_columns(cls, folder: str, mmap: bool):
+        with open(os.path.join(folder, cls.META_FILE), 'r') as file:
+            meta = json.load(file)
+        mmap_mode = "r" if mmap else None
+        packed = os.path.exists(os.path.join(folder, cls.PACKED_FILE))
+        columns = {column: np.load(os.path.join(folder, f"{column}.npy"), mmap_mode=mmap_mode)
+                   for column in cls.COLUMNS + cls.OPTIONAL_COLUMNS
+                   if not (packed and column in ("t", "E"))
+                   and (column in cls.COLUMNS or os.path.exists(os.path.join(folder, f"{column}.npy")))}
+        if packed:
+            from tracecodec import PackedTraces, SharedTimeAxis
+
+            columns["t"] = SharedTimeAxis(folder)
+            columns["E"] = PackedTraces(folder)
+        return meta, columns
+
+
+def _written_rows(meta: dict, timestamps) -> int:
+    # meta.json is only rewritten on flush, so rows written after the last flush are recovered from the timestamps
+    written = np.flatnonzero(~np.isnan(timestamps))
+    if meta.get("grid_shape") is not None:
+        return len(written)
+    if len(written) == 0:
+        return meta["count"]
+    return max(meta["count"], int(written[-1]) + 1)
@@ -0,0 +1,238 @@
+"""
+Batch reprocessing of measurement folders: features of every stored trace and feature images of every scan.
+
+    python reprocess.py ./measurements
+    python reprocess.py ./measurements/2024-01-15 --workers 8 --force
+
+Scans are the info files found under the root. Their pulse stores are split into chunks of --chunk-rows traces,
+featurized in a process pool and saved as features.npz as soon as all chunks of a store are done. Once all stores
+of a scan are done, its images are rendered in the pool and saved as <info name>_images.npz.
+Stores and scans whose outputs are newer than their inputs are skipped, unless --force is given.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from logger_settings import configure_logger
+from scanimage import grid_axis, image_builder
+from scanindex import default_pulse_folder, load_scan_columns, resolve_feature
+from tracefeatures import (DEFAULT_BANDS, FEATURES_FILE, add_features, empty_features, features_up_to_date,
+                           featurize_rows, save_features, store_rows)
+
+IMAGES_SUFFIX = "_images.npz"
+IMAGE_FEATURES = ("energy", "peak_peak", "peak_time", "band_power")
+INFO_LINE = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+_.+_[-+.\deE]+,[-+.\deE]+,[-+.\deE]+$")
+
+
+def find_scans(root: str) -> list:
+    """
+    All measurement info files under root, recognized by the format of their first line.
+    """
+    scans = []
+    for folder, subfolders, files in os.walk(root):
+        subfolders[:] = sorted(name for name in subfolders if name not in ("pulses", "logs"))
+        for name in sorted(files):
+            if not name.endswith(".txt"):
+                continue
+            path = os.path.join(folder, name)
+            with open(path, 'r') as file:
+                first_line = file.readline().strip()
+            if INFO_LINE.match(first_line):
+                scans.append(path)
+    return scans
+
+
+def images_path(info_path: str) -> str:
+    return os.path.splitext(info_path)[0] + IMAGES_SUFFIX
+
+
+def scan_up_to_date(info_path: str, store_folders: list) -> bool:
+    output = images_path(info_path)
+    if not os.path.exists(output):
+        return False
+    inputs = [info_path] + [os.path.join(folder, FEATURES_FILE) for folder in store_folders]
+    return all(os.path.exists(path) and os.path.getmtime(path) <= os.path.getmtime(output) for path in inputs)
+
+
+def render_scan(info_path: str, tolerance: float = None) -> str:
+    """
+    Renders every feature of a scan as images over the two stage axes with the most distinct coordinates.
+    If the remaining axis varies as well, there is one image per plane of that axis.
+    tolerance clusters the coordinates into grid lines, derived from their spacing by default (see scanimage.grid_axis).
+    Saves <info name>_images.npz with one (planes, rows, columns[, bands]) array per feature ("value" for old
+    files with inline values) and the axes, returns its path.
+    """
+    columns = load_scan_columns(info_path)
+    pulse_folder = default_pulse_folder(info_path)
+    positions = np.column_stack([columns["x"], columns["y"], columns["z"]])
+    distinct = [len(grid_axis(positions[:, axis], tolerance)[0]) for axis in range(3)]
+    column_axis, row_axis = sorted(np.argsort(distinct, kind="stable")[::-1][:2])
+    plane_axis = 3 - column_axis - row_axis
+    planes, plane_index = grid_axis(positions[:, plane_axis], tolerance)
+
+    features = IMAGE_FEATURES if len(columns["stores"]) else ("value",)
+    values = {name: resolve_feature(columns, "energy" if name == "value" else name, pulse_folder) for name in features}
+    images = {name: [] for name in features}
+    shape = None
+    for plane in range(len(planes)):
+        points = plane_index == plane
+        builder = image_builder(positions[points, column_axis], positions[points, row_axis], tolerance)
+        if shape is not None and builder.shape != shape:
+            # Planes of an irregular scan are interpolated onto the pixel count of the first one
+            builder = image_builder(positions[points, column_axis], positions[points, row_axis], tolerance, shape)
+        if shape is None:
+            shape = builder.shape
+            column_values, row_values = builder.x_axis, builder.y_axis
+        for name in features:
+            images[name].append(builder.image(values[name][points]))
+
+    output = images_path(info_path)
+    np.savez(output, axes=np.array(["xyz"[column_axis], "xyz"[row_axis], "xyz"[plane_axis]]),
+             column_axis=column_values, row_axis=row_values, planes=planes,
+             **{name: np.stack(stack) for name, stack in images.items()})
+    return output
+
+
+class Reprocessor:
+    """
+    Schedules the feature chunks and scan renders of a set of scans on a process pool and writes every result
+    as soon as it is complete.
+    """
+
+    def __init__(self, scans: list, bands: list = DEFAULT_BANDS, chunk_rows: int = 4096, force: bool = False,
+                 progress_interval: float = 1.0):
+        self.bands = bands
+        self.chunk_rows = chunk_rows
+        self.progress_interval = progress_interval
+        self.store_features: dict = {}  # store folder: features being filled
+        self.store_chunks_left: dict = {}  # store folder: chunks still running
+        self.scan_stores: dict = {}  # info path: store folders it still waits for
+        self.chunks: list = []  # (store folder, start, stop)
+        self.ready_scans: list = []
+        self.failed: list = []
+
+        for info_path in scans:
+            try:
+                self._add_scan(info_path, force)
+            except Exception as e:
+                logging.warning(f"Reading scan {info_path} failed: {e}")
+                self.failed.append(info_path)
+        up_to_date = len(scans) - len(self.scan_stores) - len(self.failed)
+        logging.info(f"Reprocessing {len(self.scan_stores)} of {len(scans)} scans: {len(self.store_chunks_left)} pulse stores "
+                     f"in {len(self.chunks)} chunks, {up_to_date} scans up to date, {len(self.failed)} unreadable")
+
+    def _add_scan(self, info_path: str, force: bool):
+        columns = load_scan_columns(info_path)
+        pulse_folder = default_pulse_folder(info_path)
+        store_folders = [os.path.join(pulse_folder, str(name)) for name in columns["stores"]]
+        if not force and all(features_up_to_date(folder) for folder in store_folders) \
+                and scan_up_to_date(info_path, store_folders):
+            return
+        # Stores are only added once all of them could be read, so a failing scan leaves no work behind
+        new_stores = [(folder, store_rows(folder)) for folder in store_folders
+                      if folder not in self.store_chunks_left and (force or not features_up_to_date(folder))]
+        waiting = {folder for folder in store_folders if folder in self.store_chunks_left}
+        for folder, rows in new_stores:
+            self._add_store(folder, rows)
+            waiting.add(folder)
+        self.scan_stores[info_path] = waiting
+        if not waiting:
+            self.ready_scans.append(info_path)
+
+    def _add_store(self, folder: str, rows: int):
+        self.store_features[folder] = empty_features(rows, self.bands)
+        starts = range(0, rows, self.chunk_rows)
+        self.store_chunks_left[folder] = len(starts)
+        self.chunks.extend((folder, start, min(start + self.chunk_rows, rows)) for start in starts)
+
+    def _store_done(self, folder: str) -> list:
+        save_features(folder, self.store_features.pop(folder))
+        del self.store_chunks_left[folder]
+        ready = []
+        for info_path, waiting in self.scan_stores.items():
+            if folder in waiting:
+                waiting.discard(folder)
+                if not waiting:
+                    ready.append(info_path)
+        return ready
+
+    def run(self, workers: int = None) -> list:
+        """
+        Runs all work units, returns the scans that failed.
+        """
+        total = len(self.chunks) + len(self.scan_stores)
+        done = 0
+        start_time = time.perf_counter()
+        last_progress = start_time
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for chunk in self.chunks:
+                pending[executor.submit(featurize_rows, *chunk, self.bands)] = ("chunk", chunk)
+            for info_path in self.ready_scans:
+                pending[executor.submit(render_scan, info_path)] = ("scan", info_path)
+
+            while pending:
+                finished, _ = wait(pending, timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    kind, unit = pending.pop(future)
+                    done += 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        name = unit[0] if kind == "chunk" else unit
+                        logging.warning(f"Reprocessing {kind} of {name} failed: {e}")
+                        self.failed.append(name)
+                        continue
+                    if kind == "scan":
+                        logging.info(f"Images of {unit} saved to {result}")
+                        continue
+                    folder = unit[0]
+                    add_features(self.store_features[folder], result)
+                    self.store_chunks_left[folder] -= 1
+                    if self.store_chunks_left[folder] == 0:
+                        for info_path in self._store_done(folder):
+                            pending[executor.submit(render_scan, info_path)] = ("scan", info_path)
+
+                now = time.perf_counter()
+                if now - last_progress >= self.progress_interval or not pending:
+                    last_progress = now
+                    elapsed = now - start_time
+                    time_left = elapsed * total / done - elapsed if done else 0.
+                    logging.info(f"Reprocessing: {done}/{total} units, {elapsed:.0f} s passed, about {time_left:.0f} s left")
+        return self.failed
+
+
+def parse_bands(text: str) -> list:
+    """
+    "0.1-0.5,0.5-1" -> [(0.1, 0.5), (0.5, 1.0)]
+    """
+    return [tuple(float(f) for f in band.split("-")) for band in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch reprocessing of measurement folders")
+    parser.add_argument("root", nargs="?", default="./measurements", help="folder to search for scans")
+    parser.add_argument("--workers", type=int, default=None, help="processes, default one per core")
+    parser.add_argument("--chunk-rows", type=int, default=4096, help="traces per work unit")
+    parser.add_argument("--bands", type=parse_bands, default=DEFAULT_BANDS, help="THz bands, e.g. 0.1-0.5,0.5-1")
+    parser.add_argument("--force", action="store_true", help="reprocess scans that are up to date")
+    args = parser.parse_args()
+
+    configure_logger()
+    scans = find_scans(args.root)
+    reprocessor = Reprocessor(scans, args.bands, args.chunk_rows, args.force)
+    failed = reprocessor.run(args.workers)
+    if failed:
+        logging.warning(f"{len(failed)} work units failed: {failed}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
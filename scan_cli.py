@@ -0,0 +1,86 @@
+"""
+Headless entry point for calibration and grid scans, without the GUI and by default without live plots.
+
+    python scan_cli.py scan --settings overnight.json
+    python scan_cli.py calibrate scan --simulate
+    python scan_cli.py resume --scan measurements/2024-01-01/pulses/12-00-00
+    python scan_cli.py scan --mask measurements/2024-01-01/12-00-00_info_screening_mask.npz
+
+Commands run in the given order:
+    calibrate   rough calibration of the bean edges followed by a screening grid (TFCCoffeeBean.calibrate)
+    screen      screening grid with the current grid settings
+    scan        grid scan with the current grid settings
+    adaptive    adaptive xy scan at z_min
+    resume      continue the interrupted grid scan of --scan from its first missing point
+    fill-gaps   measure only the missing points of the grid scan of --scan
+A scan after calibrate or screen only visits the bean mask of the screening, --mask takes it from an earlier screening.
+The settings file only needs the values that differ from settings.get_settings, see settings.load_settings.
+"""
+import argparse
+import logging
+import sys
+
+from logger_settings import configure_logger
+from settings import get_settings, load_settings
+
+COMMANDS = ("calibrate", "screen", "scan", "adaptive", "resume", "fill-gaps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless calibration and grid scans")
+    parser.add_argument("commands", nargs="+", help=f"any of {', '.join(COMMANDS)}, run in order")
+    parser.add_argument("--settings", help="json settings file, defaults from settings.get_settings")
+    parser.add_argument("--simulate", action="store_true", help="run against the simulated TeraFlash and stages")
+    parser.add_argument("--plot", action="store_true", help="show the live image of the scan")
+    parser.add_argument("--scan", help="scan cube folder of the grid scan to resume or fill")
+    parser.add_argument("--mask", help="bean mask (<screening info name>_mask.npz) restricting the scan")
+    args = parser.parse_args()
+    unknown = [command for command in args.commands if command not in COMMANDS]
+    if unknown:
+        parser.error(f"unknown commands {unknown}, choose from {list(COMMANDS)}")
+    if ("resume" in args.commands or "fill-gaps" in args.commands) and not args.scan:
+        parser.error("resume and fill-gaps need the scan cube folder given with --scan")
+
+    configure_logger()
+    settings = load_settings(args.settings) if args.settings else get_settings()
+    settings["general"]["live_plot"] = args.plot
+    if args.simulate:
+        settings["simulation"]["enabled"] = True
+
+    from TFCCoffeebean import TFCCoffeeBean
+
+    bean = TFCCoffeeBean(settings)
+    if args.mask:
+        from beanmask import BeanMask
+
+        bean.bean_mask = BeanMask.load(args.mask)
+    if not bean.connect_teraflash():
+        logging.critical("Could not connect to the TeraFlash")
+        return 1
+    try:
+        if not bean.connect_stagemover():
+            logging.critical("Could not connect to the stages")
+            return 1
+        for command in args.commands:
+            logging.info(f"Running {command}")
+            if command == "calibrate":
+                bean.calibrate()
+            elif command == "screen":
+                bean.run_gridmover_screen()
+            elif command == "scan":
+                bean.run_gridmover()
+            elif command == "adaptive":
+                bean.run_adaptive_scan()
+            elif command == "resume":
+                bean.run_gridmover(resume_folder=args.scan)
+            elif command == "fill-gaps":
+                bean.run_gridmover(resume_folder=args.scan, fill_gaps=True)
+    finally:
+        bean.trace_hub.stop()
+        if bean.stagemover.port_opened:
+            bean.stagemover.disconnect()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+
+import numpy as np
+
+
+def axis_tolerance(values: np.ndarray) -> float:
+    """
+    Clustering tolerance of one coordinate of a scan, derived from its spacing. The gaps between the sorted
+    coordinates are either grid steps or jitter around a grid line, they are split at the largest ratio between
+    consecutive gap sizes and the tolerance lies between both. Without a clear split (ratio below 4) every distinct
+    coordinate is a grid line of its own. So is every coordinate of a refined lattice (e.g. an adaptive scan), where
+    the small gaps are one fine step and the large gaps are multiples of it, see _refined_lattice.
+    """
+    gaps = np.sort(np.diff(np.sort(np.asarray(values, dtype=np.float64))))[::-1]
+    gaps = gaps[gaps > 0]
+    if len(gaps) == 0:
+        return 0.
+    if len(gaps) > 1:
+        ratios = gaps[:-1] / gaps[1:]
+        split = int(ratios.argmax())
+        if ratios[split] >= 4 and not _refined_lattice(gaps[:split + 1], gaps[split + 1:]):
+            return float(np.sqrt(gaps[split] * gaps[split + 1]))
+    return float(gaps[-1] / 2)
+
+
+def _refined_lattice(large_gaps: np.ndarray, small_gaps: np.ndarray) -> bool:
+    # Jitter gaps scatter, the fine steps of a lattice are all alike and the coarse steps are whole multiples of them
+    step = np.median(small_gaps)
+    if np.any(np.abs(small_gaps - step) > 0.1 * step):
+        return False
+    multiples = large_gaps / step
+    return bool(np.all(np.abs(multiples - np.round(multiples)) <= 0.1))
+
+
+def grid_axis(values: np.ndarray, tolerance: float = None):
+    """
+    Clusters coordinates that lie within tolerance of each other, by default axis_tolerance of the values.
+    Returns the sorted axis (cluster means) and the axis index of every value.
+    """
+    if tolerance is None:
+        tolerance = axis_tolerance(values)
+    order = np.argsort(values)
+    sorted_values = values[order]
+    new_cluster = np.concatenate([[True], np.diff(sorted_values) > tolerance])
+    cluster_of_sorted = np.cumsum(new_cluster) - 1
+    axis = np.bincount(cluster_of_sorted, weights=sorted_values) / np.bincount(cluster_of_sorted)
+    index = np.empty(len(values), dtype=np.int64)
+    index[order] = cluster_of_sorted
+    return axis, index
+
+
+def _evenly_spaced(axis: np.ndarray) -> bool:
+    if len(axis) < 3:
+        return True
+    steps = np.diff(axis)
+    step = np.median(steps)
+    return bool(np.all(np.abs(steps - step) <= 0.2 * step))
+
+
+class ScanImageBuilder:
+    """
+    Turns per point values of a scan into an image (y rows, x columns), reusing all geometry work for every
+    feature or frequency band rendered from the same points.
+
+    If the points lie on a regular or near-regular grid, values are placed by direct index mapping. The coordinates
+    are clustered into grid lines within tolerance mm, derived from the spacing of each axis if not given
+    (see axis_tolerance). The points form a grid if there is at most one point per grid cell, at least min_fill
+    of the cells hold a point and the grid lines of both axes are evenly spaced (steps within 20 % of their median).
+    Otherwise the points are
+    triangulated once and the barycentric interpolation weights of every pixel are kept, so each image is a
+    weighted sum instead of a new griddata call.
+    """
+
+    def __init__(self, x, y, tolerance: float = None, shape: tuple = None, fill_value: float = 0., min_fill: float = 0.9):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.fill_value = fill_value
+
+        self.x_axis, self.x_index = grid_axis(self.x, tolerance)
+        self.y_axis, self.y_index = grid_axis(self.y, tolerance)
+        cells = self.y_index * len(self.x_axis) + self.x_index
+        self.regular = shape is None and len(np.unique(cells)) == len(cells) \
+            and len(cells) >= min_fill * len(self.x_axis) * len(self.y_axis) \
+            and _evenly_spaced(self.x_axis) and _evenly_spaced(self.y_axis)
+        if self.regular:
+            logging.debug(f"Regular {len(self.y_axis)}x{len(self.x_axis)} grid, placing values by index")
+            return
+
+        if shape is not None:
+            self.x_axis = np.linspace(self.x.min(), self.x.max(), shape[1])
+            self.y_axis = np.linspace(self.y.min(), self.y.max(), shape[0])
+        self._triangulate()
+
+    def _triangulate(self):
+        from scipy.spatial import Delaunay
+
+        logging.debug(f"Triangulating {len(self.x)} scattered points")
+        x_mesh, y_mesh = np.meshgrid(self.x_axis, self.y_axis)
+        pixels = np.column_stack([x_mesh.ravel(), y_mesh.ravel()])
+        triangulation = Delaunay(np.column_stack([self.x, self.y]))
+        simplex = triangulation.find_simplex(pixels)
+        self.inside = simplex >= 0
+        self.vertices = triangulation.simplices[simplex[self.inside]]
+        transform = triangulation.transform[simplex[self.inside]]
+        barycentric = np.einsum("ijk,ik->ij", transform[:, :2], pixels[self.inside] - transform[:, 2])
+        self.weights = np.column_stack([barycentric, 1 - barycentric.sum(axis=1)])
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.y_axis), len(self.x_axis)
+
+    def image(self, values) -> np.ndarray:
+        """
+        Image of one value per point (N,), or a stack of images for (N, k) values, e.g. k frequency bands.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        extra = values.shape[1:]
+        image = np.full(self.shape + extra, self.fill_value)
+        if self.regular:
+            image[self.y_index, self.x_index] = values
+            return image
+        flat = image.reshape((-1,) + extra)
+        flat[self.inside] = np.einsum("ij,ij...->i...", self.weights, values[self.vertices])
+        return image
+
+
+_builders = {}
+
+
+def image_builder(x, y, tolerance: float = None, shape: tuple = None) -> ScanImageBuilder:
+    """
+    ScanImageBuilder for a point set, cached on the coordinates so repeated renders of a scan share one triangulation.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    key = (hashlib.sha1(x.tobytes() + y.tobytes()).hexdigest(), tolerance, shape)
+    if key not in _builders:
+        if len(_builders) >= 16:
+            _builders.pop(next(iter(_builders)))
+        _builders[key] = ScanImageBuilder(x, y, tolerance, shape)
+    return _builders[key]
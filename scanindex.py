@@ -0,0 +1,162 @@
+import logging
+import os
+import re
+
+import numpy as np
+
+from tracefeatures import featurize_store, features_up_to_date, load_features
+
+SIDECAR_SUFFIX = ".index.npz"
+PULSE_REFERENCE = re.compile(r"^[^/\\:]+/\d+$")  # <store>/<row>
+BACKGROUND_PREFIX = "background="  # middle field of a point skipped by a masked scan, followed by its energy
+
+
+def parse_scan_index(info_path: str) -> dict:
+    """
+    Parses a measurement info file, one line per point: "<%Y-%m-%d %H:%M:%S.%f>_<value or pulse reference>_<x>,<y>,<z>".
+    The middle field is a pulse reference "<store>/<row>" in current files and a measured value in old files.
+    The first files named the file a pulse was saved to with the TeraFlash software's Data class instead; those
+    points get no value. Masked scans write "background=<energy>" for the grid points they skip.
+    Returns the columns:
+        time          datetime64[us]
+        x, y, z       position in mm
+        stores        names of the referenced pulse stores
+        store_index   index into stores per point, -1 for points with an inline value
+        row           row in the pulse store, -1 for points with an inline value
+        inline_value  value written in the file, NaN for points with a pulse reference
+        files         pulse file named by old files, "" for the other points
+        background    True for points a masked scan skipped, their inline_value is the background energy
+    A pulse reference written more than once (a point measured again by a resumed scan) keeps only its last line.
+    """
+    with open(info_path, 'r') as file:
+        lines = file.read().splitlines()
+    lines = [line for line in lines if line.strip()]
+
+    date_strings, middles, positions = [], [], []
+    for line in lines:
+        date_str, rest = line.split('_', 1)
+        middle, pos_str = rest.rsplit('_', 1)
+        date_strings.append(date_str.replace(' ', 'T'))
+        middles.append(middle)
+        positions.append(pos_str)
+
+    xyz = np.array(','.join(positions).split(','), dtype=np.float64).reshape(-1, 3) if positions else np.empty((0, 3))
+    stores = []
+    store_index = np.full(len(lines), -1, dtype=np.int64)
+    row = np.full(len(lines), -1, dtype=np.int64)
+    inline_value = np.full(len(lines), np.nan)
+    files = np.full(len(lines), "", dtype=object)
+    background = np.zeros(len(lines), dtype=bool)
+    for i, middle in enumerate(middles):
+        if middle.startswith(BACKGROUND_PREFIX):
+            background[i] = True
+            inline_value[i] = float(middle[len(BACKGROUND_PREFIX):])
+            continue
+        if PULSE_REFERENCE.match(middle):
+            store_name, row_str = middle.rsplit('/', 1)
+            if store_name not in stores:
+                stores.append(store_name)
+            store_index[i] = stores.index(store_name)
+            row[i] = int(row_str)
+            continue
+        try:
+            inline_value[i] = float(middle)
+        except ValueError:
+            files[i] = middle
+
+    keep = np.ones(len(lines), dtype=bool)
+    referenced = np.flatnonzero(row >= 0)
+    if len(referenced):
+        keys = store_index[referenced] * (row.max() + 1) + row[referenced]
+        _, last_from_end = np.unique(keys[::-1], return_index=True)
+        keep[referenced] = False
+        keep[referenced[len(referenced) - 1 - last_from_end]] = True
+
+    return {
+        "time": np.array(date_strings, dtype="datetime64[us]")[keep],
+        "x": xyz[keep, 0], "y": xyz[keep, 1], "z": xyz[keep, 2],
+        "stores": np.array(stores, dtype=str),
+        "store_index": store_index[keep],
+        "row": row[keep],
+        "inline_value": inline_value[keep],
+        "files": files[keep].astype(str),
+        "background": background[keep],
+    }
+
+
+def load_scan_index(info_path: str, feature: str = "energy", pulse_folder: str = None, cache: bool = True) -> dict:
+    """
+    Loads a measurement info file with the value of every point resolved into the column "values":
+    the inline value for old files, otherwise the stored feature of the referenced pulse
+    (features are computed and saved with the store when missing).
+    Parsed columns are cached in "<info file>.index.npz", which is reused as long as the info file is unchanged.
+    pulse_folder is where the pulse stores live, "pulses" next to the info file by default.
+    """
+    columns = load_scan_columns(info_path, cache)
+    columns["values"] = resolve_feature(columns, feature, pulse_folder or default_pulse_folder(info_path))
+    return columns
+
+
+def load_scan_columns(info_path: str, cache: bool = True) -> dict:
+    """
+    The columns of parse_scan_index, from the "<info file>.index.npz" cache while the info file is unchanged.
+    """
+    sidecar_path = info_path + SIDECAR_SUFFIX
+    stat = os.stat(info_path)
+    key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+    if cache and os.path.exists(sidecar_path):
+        with np.load(sidecar_path) as sidecar:
+            # Caches written before the files and background columns are parsed again
+            if np.array_equal(sidecar["key"], key) and {"files", "background"} <= set(sidecar.files):
+                return {name: sidecar[name] for name in sidecar.files if name != "key"}
+    columns = parse_scan_index(info_path)
+    if cache:
+        np.savez(sidecar_path, key=key, **columns)
+        logging.debug(f"Cached parsed index of {info_path} in {sidecar_path}")
+    return columns
+
+
+def default_pulse_folder(info_path: str) -> str:
+    return os.path.join(os.path.dirname(info_path), "pulses")
+
+
+def resolve_feature(columns: dict, feature: str, pulse_folder: str) -> np.ndarray:
+    """
+    One value per point: the inline value, or the stored feature of the referenced pulse.
+    Multi-valued features such as band_power give an (N, k) array.
+    Points that name a pulse file of the TeraFlash software are NaN: those files can only be read with it.
+    Points skipped by a masked scan have the background energy as energy and NaN for the other features.
+    """
+    file_points = int(np.count_nonzero(columns["files"] != ""))
+    if file_points:
+        logging.warning(f"{file_points} points name a pulse file of the TeraFlash software "
+                        f"(e.g. {columns['files'][columns['files'] != ''][0]}), their {feature} is left NaN")
+    values = None
+    for i, store_name in enumerate(columns["stores"]):
+        points = columns["store_index"] == i
+        store_values = store_feature(os.path.join(pulse_folder, str(store_name)), feature)[columns["row"][points]]
+        if values is None:
+            values = np.full((len(columns["row"]),) + store_values.shape[1:], np.nan)
+        values[points] = store_values
+    if values is None:
+        values = columns["inline_value"].copy()
+        if feature != "energy":
+            values[columns["background"]] = np.nan
+        return values
+    if values.ndim == 1:
+        inline = columns["store_index"] < 0
+        if feature != "energy":
+            inline &= ~columns["background"]
+        values[inline] = columns["inline_value"][inline]
+    return values
+
+
+def store_feature(store_folder: str, feature: str = "energy") -> np.ndarray:
+    """
+    One feature for every row of a pulse store, from its features.npz. The features are (re)computed first when
+    the file is missing or older than the store.
+    """
+    if not features_up_to_date(store_folder):
+        return featurize_store(store_folder)[feature]
+    return load_features(store_folder)[feature]
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+JOURNAL_FILE = "journal.txt"
+SCAN_FILE = "scan.json"
+
+
+def save_scan(folder: str, settings: dict, info_path: str):
+    """
+    Stores what is needed to resume the grid scan of a scan cube: its settings and info file.
+    """
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, SCAN_FILE), 'w') as file:
+        json.dump({"info_path": info_path, "settings": settings}, file, indent=4,
+                  default=lambda value: value.tolist() if hasattr(value, "tolist") else str(value))
+
+
+def load_scan(folder: str) -> dict:
+    with open(os.path.join(folder, SCAN_FILE), 'r') as file:
+        return json.load(file)
+
+
+class ScanJournal:
+    """
+    Completed grid indices of a scan, one "x,y,z" line per point in journal.txt of the scan cube.
+    Points are added by the scan writer after their pulse is stored and written on flush after the cube itself,
+    so every journaled point is on disk.
+    """
+
+    def __init__(self, folder: str):
+        self.path: str = os.path.join(folder, JOURNAL_FILE)
+        self.pending: list = []
+
+    def add(self, grid_index):
+        self.pending.append(",".join(str(int(i)) for i in grid_index) + "\n")
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.path, 'a') as file:
+            file.writelines(self.pending)
+        self.pending = []
+
+    def completed(self) -> np.ndarray:
+        """
+        (N, 3) grid indices of the journaled points.
+        """
+        if not os.path.exists(self.path):
+            return np.empty((0, 3), dtype=int)
+        with open(self.path, 'r') as file:
+            # Every complete line ends with a newline: the last piece is empty, or a line cut short by a crash
+            lines = file.read().split("\n")[:-1]
+        completed = []
+        for line in lines:
+            try:
+                grid_index = [int(i) for i in line.split(",")]
+            except ValueError:
+                grid_index = None
+            if grid_index is None or len(grid_index) != 3:
+                logging.warning(f"Skipping unreadable line '{line}' of journal {self.path}")
+                continue
+            completed.append(grid_index)
+        return np.array(completed, dtype=int).reshape(-1, 3)
+
+    def missing(self, path: np.ndarray, store) -> np.ndarray:
+        """
+        The grid indices of path, in path order, that are not completed: not journaled, or journaled but
+        without a stored trace in the scan cube store.
+        """
+        done = np.zeros(store.grid_shape, dtype=bool)
+        completed = self.completed()
+        done[tuple(completed.T)] = True
+        done &= store.written_mask()
+        path = np.asarray(path, dtype=int).reshape(-1, 3)
+        missing = path[~done[tuple(path.T)]]
+        logging.info(f"Journal {self.path}: {int(done.sum())} points completed, {len(missing)} of {len(path)} missing")
+        return missing
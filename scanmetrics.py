@@ -0,0 +1,112 @@
+import logging
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+METRICS_SUFFIX = "_metrics.npz"
+# Log-spaced histogram bins from 1 us to 1000 s, 10 per decade; durations outside land in the first or last bin
+HISTOGRAM_EDGES = np.logspace(-6, 3, 91)
+
+_DISABLED = nullcontext()
+
+
+class _Phase:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class ScanMetrics:
+    """
+    Per-phase timings of a scan, e.g. move, settle, acquire, offset, persist, plot and log.
+
+        with metrics.phase("move"):
+            ...
+        metrics.record("settle", seconds)
+
+    Every duration is kept until the scan ends, then summarized and saved as log-spaced histograms.
+    Phases may be timed from several threads. enabled can be switched at any time; while it is off phase
+    returns a shared no-op context and record returns immediately, so the instrumentation costs one attribute check.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled: bool = enabled
+        self.durations: dict = {}
+        self.start_time: float = time.perf_counter()
+
+    def reset(self):
+        """
+        Drops all timings, call at the start of a scan.
+        """
+        self.durations = {}
+        self.start_time = time.perf_counter()
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return _DISABLED
+        return _Phase(self, name)
+
+    def record(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations.setdefault(name, [])
+        durations.append(seconds)
+
+    def statistics(self) -> dict:
+        """
+        {phase: {count, total, mean, p50, p95, p99, max}} in seconds.
+        """
+        statistics = {}
+        for name, durations in list(self.durations.items()):
+            durations = np.asarray(durations)
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            statistics[name] = {"count": len(durations), "total": durations.sum(), "mean": durations.mean(),
+                                "p50": p50, "p95": p95, "p99": p99, "max": durations.max()}
+        return statistics
+
+    def summary(self):
+        """
+        Logs one line per phase with its share of the scan time, returns the statistics.
+        """
+        statistics = self.statistics()
+        wall_time = time.perf_counter() - self.start_time
+        logging.info(f"Scan phases over {wall_time:.2f} s:")
+        for name, s in sorted(statistics.items(), key=lambda item: -item[1]["total"]):
+            logging.info(
+                f"  {name:<8} {s['count']:>7}x  total {s['total']:8.2f} s ({s['total'] / wall_time:4.0%})  mean {s['mean'] * 1e3:8.3f} ms  "
+                f"p50 {s['p50'] * 1e3:8.3f} ms  p95 {s['p95'] * 1e3:8.3f} ms  max {s['max'] * 1e3:8.3f} ms")
+        return statistics
+
+    def save(self, path: str):
+        """
+        Saves per phase the histogram counts over HISTOGRAM_EDGES and the statistics into one npz file.
+        """
+        statistics = self.statistics()
+        names = sorted(statistics)
+        counts = np.zeros((len(names), len(HISTOGRAM_EDGES) - 1), dtype=np.int64)
+        for i, name in enumerate(names):
+            clipped = np.clip(self.durations[name], HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1])
+            counts[i], _ = np.histogram(clipped, HISTOGRAM_EDGES)
+        columns = {key: np.array([statistics[name][key] for name in names], dtype=np.float64)
+                   for key in ("count", "total", "mean", "p50", "p95", "p99", "max")}
+        np.savez(path, phases=np.array(names, dtype=str), edges=HISTOGRAM_EDGES, counts=counts,
+                 wall_time=time.perf_counter() - self.start_time, **columns)
+        logging.info(f"Scan metrics saved to {path}")
+
+
+def load_metrics(path: str) -> dict:
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
@@ -0,0 +1,106 @@
+import itertools
+import logging
+
+import numpy as np
+
+AXIS_NAMES = "xyz"
+
+
+def parse_axis_order(axis_order: str) -> tuple:
+    """
+    Converts an axis order like "zxy" (outer loop first, inner loop last) into axis indices (2, 0, 1).
+    """
+    order = tuple(AXIS_NAMES.index(axis) for axis in axis_order)
+    if sorted(order) != [0, 1, 2]:
+        raise ValueError(f"Axis order '{axis_order}' must contain x, y and z once")
+    return order
+
+
+def grid_path(grid_shape: tuple, axis_order: tuple = (2, 0, 1), serpentine: bool = True) -> np.ndarray:
+    """
+    Returns the (N, 3) grid indices (x, y, z) of every grid point in visiting order.
+    axis_order lists the axes from the outer to the inner loop. In raster order every inner axis flies back
+    to its first index when an outer axis steps, serpentine (boustrophedon) order reverses the inner axis
+    on every other pass instead, so consecutive points are always neighbours.
+    """
+    shape = [int(grid_shape[axis]) for axis in axis_order]
+    digits = np.indices(shape).reshape(3, -1)
+    if serpentine:
+        passes = np.zeros(digits.shape[1], dtype=int)
+        reflected = digits.copy()
+        for level in range(1, 3):
+            # An axis runs backwards when the number of passes of the axes outside it is odd
+            passes = passes * shape[level - 1] + digits[level - 1]
+            odd = passes % 2 == 1
+            reflected[level, odd] = shape[level] - 1 - digits[level, odd]
+        digits = reflected
+    indices = np.empty_like(digits)
+    indices[list(axis_order)] = digits
+    return indices.T
+
+
+def nearest_neighbour_path(points: np.ndarray, start=None) -> np.ndarray:
+    """
+    Greedy nearest neighbour ordering of a sparse (N, 3) point list. Returns the visiting order as indices into points.
+    """
+    points = np.asarray(points, dtype=float)
+    remaining = np.ones(len(points), dtype=bool)
+    order = np.empty(len(points), dtype=int)
+    current = points[0] if start is None else np.asarray(start, dtype=float)
+    for i in range(len(points)):
+        distances = np.abs(points - current).sum(axis=1)
+        distances[~remaining] = np.inf
+        nearest = int(np.argmin(distances))
+        order[i] = nearest
+        remaining[nearest] = False
+        current = points[nearest]
+    return order
+
+
+def travel_distance(positions: np.ndarray, start=None) -> np.ndarray:
+    """
+    Predicted travel per axis in mm when visiting positions (N, 3) in order, starting from start if given.
+    """
+    return np.abs(_steps(positions, start)).sum(axis=0)
+
+
+def travel_time(positions: np.ndarray, speeds, start=None, concurrent: bool = False) -> float:
+    """
+    Predicted motion time in s when visiting positions (N, 3) in order. Axes that move one after another take
+    the sum of their move times per point, axes moving concurrently the time of the slowest axis.
+    """
+    axis_times = np.abs(_steps(positions, start)) / np.asarray(speeds, dtype=float)
+    if concurrent:
+        return float(axis_times.max(axis=1, initial=0.).sum())
+    return float(axis_times.sum())
+
+
+def _steps(positions: np.ndarray, start=None) -> np.ndarray:
+    positions = np.asarray(positions, dtype=float)
+    if start is not None:
+        positions = np.vstack([np.asarray(start, dtype=float)[None, :3], positions])
+    return np.diff(positions, axis=0)
+
+
+def best_axis_order(grid_shape: tuple, grid_axes: list, speeds, serpentine: bool = True, concurrent: bool = False) -> tuple:
+    """
+    Tries every axis order and returns the one with the lowest predicted travel time.
+    """
+    def predicted_time(axis_order):
+        return travel_time(grid_positions(grid_path(grid_shape, axis_order, serpentine), grid_axes), speeds, concurrent=concurrent)
+    return min(itertools.permutations(range(3)), key=predicted_time)
+
+
+def grid_positions(indices: np.ndarray, grid_axes: list) -> np.ndarray:
+    """
+    Converts (N, 3) grid indices into (N, 3) positions in mm, grid_axes holds the coordinates of every axis.
+    """
+    return np.column_stack([grid_axes[axis][indices[:, axis]] for axis in range(3)])
+
+
+def log_path_prediction(name: str, positions: np.ndarray, speeds, start=None, concurrent: bool = False):
+    distance = travel_distance(positions, start)
+    logging.info(
+        f"Scan path '{name}': {len(positions)} points, predicted travel x: {distance[0]:.1f} mm, y: {distance[1]:.1f} mm, "
+        f"z: {distance[2]:.1f} mm, total {distance.sum():.1f} mm, ~{travel_time(positions, speeds, start, concurrent):.0f} s of motion")
+    return distance
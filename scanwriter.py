@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+import time
+
+from scanmetrics import ScanMetrics
+
+
+class ScanWriterError(Exception):
+    pass
+
+
+class ScanWriter:
+    """
+    Persists measurements on a dedicated thread, so the thread driving the stages only waits on acquisition.
+
+    Pulses are written into their pulse store as they arrive, index lines are buffered per file.
+    Every flush_interval seconds (and on close) the buffered lines are appended with one open per file
+    and the pulse stores are flushed. The queue is bounded: when the disk cannot keep up, submit blocks
+    for at most put_timeout seconds (forever if None) before raising a ScanWriterError.
+    An error on the writer thread stops the writer and is raised again by the next submit or by close.
+    Writing a pulse is timed as phase "persist", flushing as phase "flush" of metrics.
+    """
+
+    def __init__(self, queue_size: int = 64, flush_interval: float = 1.0, put_timeout: float = None,
+                 metrics: ScanMetrics = None):
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval: float = flush_interval
+        self.put_timeout: float = put_timeout
+        self.error: Exception = None
+        self.thread: threading.Thread = None
+        self._index_lines: dict = {}
+        self._dirty_stores: list = []
+        self._dirty_journals: list = []
+        self.metrics: ScanMetrics = metrics if metrics is not None else ScanMetrics(enabled=False)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="ScanWriter")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def write_pulse(self, store, pulse, position, timestamp: float, grid_index=None, index_path: str = None, index_time: str = None,
+                    journal=None):
+        """
+        Queues a pulse for store. If index_path is given, the line "<index_time>_<pulse reference>_<x>,<y>,<z>"
+        is appended to it once the pulse is stored. If a ScanJournal is given, the grid index is journaled
+        once the store is flushed.
+        """
+        self._submit((store, pulse, position, timestamp, grid_index, index_path, index_time, journal))
+
+    def _submit(self, item):
+        self._raise_error()
+        if self.thread is None:
+            raise ScanWriterError("Scan writer not started. Use ScanWriter.start()")
+        waited = 0.
+        while True:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                # Back-pressure: wait for the writer, but stop waiting when it died in the meantime
+                self._raise_error()
+                waited += 0.1
+                if self.put_timeout is not None and waited >= self.put_timeout:
+                    raise ScanWriterError(f"Scan writer queue full for {self.put_timeout} s, disk cannot keep up")
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise ScanWriterError(f"Scan writer failed: {self.error}") from self.error
+
+    def _run(self):
+        last_flush = time.perf_counter()
+        stopping = False
+        while not stopping:
+            timeout = max(0., self.flush_interval - (time.perf_counter() - last_flush))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            try:
+                if item is None:
+                    stopping = True
+                elif item:
+                    with self.metrics.phase("persist"):
+                        self._write(item)
+                if stopping or time.perf_counter() - last_flush >= self.flush_interval:
+                    with self.metrics.phase("flush"):
+                        self._flush()
+                    last_flush = time.perf_counter()
+            except Exception as e:
+                logging.critical(f"Scan writer stopped: {e}")
+                self.error = e
+                stopping = True
+            finally:
+                if item is not False:
+                    self.queue.task_done()
+        self._drain()
+
+    def _drain(self):
+        # After an error nothing is written anymore, but blocked producers must not hang on a full queue
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                return
+
+    def _write(self, item):
+        store, pulse, position, timestamp, grid_index, index_path, index_time, journal = item
+        if grid_index is None:
+            row = store.append(pulse, position, timestamp)
+        else:
+            row = store.write_at(grid_index, pulse, position, timestamp)
+        if store not in self._dirty_stores:
+            self._dirty_stores.append(store)
+        if index_path is not None:
+            line = f"{index_time}_{store.reference(row)}_{position[0]},{position[1]},{position[2]}\n"
+            self._index_lines.setdefault(index_path, []).append(line)
+        if journal is not None:
+            journal.add(grid_index)
+            if journal not in self._dirty_journals:
+                self._dirty_journals.append(journal)
+
+    def _flush(self):
+        for index_path, lines in self._index_lines.items():
+            with open(index_path, 'a') as file:
+                file.writelines(lines)
+        self._index_lines = {}
+        for store in self._dirty_stores:
+            store.flush()
+        self._dirty_stores = []
+        # After the stores, so a journaled point is always on disk
+        for journal in self._dirty_journals:
+            journal.flush()
+        self._dirty_journals = []
+
+    def close(self):
+        """
+        Writes everything still queued, stops the writer thread and raises any error that occurred.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 
 def get_settings():
@@ -9,12 +10,23 @@ def get_settings():
             "TRANSFER": "block",
             "TFC_RANGE": 200.,
             "RESOLUTION": 0.001,
+            "trace_time": 0.05,  # s per trace before averaging, a generous estimate
+            "trace_timeout": 2.,  # s a scan waits for a trace on top of two averaged trace times
+        },
+        "averaging": {
+            "adaptive": False,  # average every point of grid and adaptive scans until target_snr, instead of one trace
+            "snr_feature": "peak",  # peak or energy, see acquisition.RunningMean.snr
+            "target_snr": 50.,
+            "min_traces": 2,  # the SNR needs at least two traces
+            "max_traces": 64,
         },
         "stagemover": {
             "port": "COM4",
             "device_names": ["x", "y", "z"],
             "max_lenghts": [148, 48, 48],
             "permutation": [1, 0, 2],
+            "speeds": [5, 5, 5],  # mm/s
+            "parallel": False,  # move, home and query all axes at once, not yet checked on the single serial line of the rig
         },
         "stagegridmover": {
             "x_min": 92.0,
@@ -26,17 +38,88 @@ def get_settings():
             "z_min": 0.5,
             "z_max": 47.5,
             "z_n": 100,
+            "path": "serpentine",  # raster, serpentine or nearest
+            "axis_order": "auto",  # outer loop first (e.g. zxy), or auto for the fastest order
+            "progress_interval": 1.0,  # s between scan progress lines, every point goes to the scan log
+        },
+        "adaptive": {
+            "coarse_x_n": 5,
+            "coarse_y_n": 5,
+            "min_step": 0.25,  # mm
+            "variation_threshold": 0.2,  # refine cells whose energies differ by this fraction of the largest coarse energy
+        },
+        "masked_scan": {
+            "enabled": True,  # after a screening, the grid scan only visits the bean mask of the screening
+            "threshold": 0.5,  # bean where the screened energy is below this fraction of the background energy
+            "background_percentile": 90,  # percentile of the screened energies taken as background
+            "opening": 1,  # grid points, removes isolated points from the mask, 0 to skip
+            "border": 1,  # grid points added around the mask
         },
         "calibration": {
             "rough_step_size": 1,  # mm
             "margin": 0.6,
-            "max_deviation_from_center": 15  # mm
+            "max_deviation_from_center": 15,  # mm
+            "mode": "bisection",  # bisection or linear
+            "coarse_step_size": 4,  # mm, bracketing step of the bisection mode
+            "edge_accuracy": 0.1,  # mm, target edge accuracy of the bisection mode
+            "background_measurements": 1,  # measurements at the search limit for the background energy
+        },
+        "gui": {
+            "max_redraw_rate": 20,  # Hz, live trace frames arriving faster are dropped
+        },
+        "simulation": {
+            "enabled": False,  # run against the simulated TeraFlash and stages of fakeenvironment.Simulation
+            "virtual_clock": True,  # simulate the hardware time instead of waiting for it
+            "time_scale": 0.001,  # real s per simulated s on the virtual clock
+            "seed": 0,
+            "bean_center": [93.4, 33.8, 24.],  # mm, stage coordinates
+            "bean_semi_axes": [5., 4., 3.5],  # mm
+            "refractive_index": 1.6,
+            "absorption": 0.4,  # 1/mm at 1 THz, amplitude, proportional to frequency
+            "beam_axis": 2,  # stage axis along the THz beam
+            "stage_speeds": [5, 5, 5],  # mm/s
+            "settle_time": 0.05,  # s after every move
+            "trace_time": 0.01,  # s per averaged trace
+            "connect_time": 1,  # s
+            "sample_spacing": 0.05,  # ps
+            "pulse_position": 0.3,  # fraction of the range
+            "pulse_width": 0.25,  # ps
+            "amplitude": 100.,
+            "noise": 0.5,
+            "offset": 2.,
+        },
+        "storage": {
+            "pack_after_scan": False,  # pack the scan cube of a finished grid scan, see tracecodec
+            "trace_dtype": "int16",  # int16 (error <= peak / 65534) or float32 (relative error <= 6e-8)
+            "filter": "shuffle",  # none, shuffle or delta (int16 only)
+            "compressor": "zlib",  # none, zlib or lzma
+            "level": 6,  # zlib level or lzma preset
+            "chunk_rows": 64,  # traces per compressed chunk, the unit of random access
         },
         "general": {
             "measurement_savefolder": f"./measurements/{datetime.now().strftime('%Y-%m-%d')}",
             "measurement_name": f"{datetime.now().strftime('%H-%M-%S')}_info.txt",
             "measurement_name_screen": f"{datetime.now().strftime('%H-%M-%S')}_info_screening.txt",
+            "pulse_store_name": f"{datetime.now().strftime('%H-%M-%S')}",
+            "pulse_store_name_screen": f"{datetime.now().strftime('%H-%M-%S')}-screening",
+            "writer_queue_size": 64,  # traces waiting to be saved before the scan blocks
+            "writer_flush_interval": 1.0,  # s
+            "pipelined_scan": True,  # process and save point N while the stages move to point N+1
+            "live_plot": True,  # live image of the scan, headless scans run without matplotlib
+            "scan_metrics": True,  # time every phase of every grid point, saved as <info name>_metrics.npz
         }
     }
     return settings
 
+
+def load_settings(path: str) -> dict:
+    """
+    Settings from a json file of the same layout as get_settings. Sections and keys missing in the file keep
+    their default, so the file only needs to list what differs, e.g. {"stagegridmover": {"x_n": 20}}.
+    """
+    settings = get_settings()
+    with open(path, 'r') as file:
+        overrides = json.load(file)
+    for section, values in overrides.items():
+        settings.setdefault(section, {}).update(values)
+    return settings
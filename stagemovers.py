@@ -1,12 +1,16 @@
+import contextvars
 import logging
-from zaber_motion import Units, BinaryCommandFailedException
-from zaber_motion.binary import Connection
 import numpy as np
 from datetime import datetime
 from string import Template
-import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from fakeenvironment import FakeConnection, FakeStage
+from fakeenvironment import FakeConnection, FakeStage, FakeCommandFailedException
+from logger_settings import ScanLog, configure_logger
+from scanmetrics import ScanMetrics
+from scanpaths import AXIS_NAMES, grid_path, grid_positions, nearest_neighbour_path, best_axis_order, parse_axis_order, log_path_prediction
 
 
 def rearrange_devices(device_list, permutation):
@@ -21,24 +25,40 @@ class StageMover:
         self.device_names: list = settings["device_names"]
         self.max_lengths: list = settings["max_lenghts"]
         self.permutation: list = settings["permutation"]
+        self.speeds: list = settings["speeds"]  # mm/s, used to predict travel time
+        self.parallel: bool = settings["parallel"]  # move, home and query all axes at once
 
         self.port_opened: bool = False
         self.homed: bool = False
         self.device_list: list = []
         self.connection = None
-
-    def connect(self, fake: bool = False):
+        # Tracked stage positions, updated from the end position every move returns.
+        # None means unknown, the next get_pos then queries the hardware.
+        self.positions: list = None
+        self.executor: ThreadPoolExecutor = None
+        # Length unit and command failure of the device library, zaber_motion is only imported for real stages
+        self.unit_mm = "mm"
+        self.command_failed_exception = FakeCommandFailedException
+
+    def connect(self, fake: bool = False, devices: list = None):
         """
-        Connect with the three stages.
+        Connect with the three stages. With fake the stages are faked, devices injects stage objects
+        (e.g. the simulated stages of fakeenvironment.Simulation) instead of the serial connection.
         """
-        if fake:
-            self.connection = FakeConnection()
-            self.device_list = [FakeStage(i) for i in range(3)]
+        if fake or devices is not None:
+            self.connection = FakeConnection(0 if devices is not None else 1)
+            self.device_list = devices if devices is not None else [FakeStage(i) for i in range(3)]
             logging.info(f"Found {len(self.device_list)} devices")
             self.port_opened = True
+            self._start_executor()
             return True
 
         try:
+            from zaber_motion import Units, BinaryCommandFailedException
+            from zaber_motion.binary import Connection
+
+            self.unit_mm = Units.LENGTH_MILLIMETRES
+            self.command_failed_exception = BinaryCommandFailedException
             self.connection = Connection.open_serial_port(port_name=self.port, baud_rate=9600)
             logging.info("Connected with serial port")
             self.device_list = self.connection.detect_devices()
@@ -48,21 +68,49 @@ class StageMover:
             return False
         self.port_opened = True
         logging.info(f"Found {len(self.device_list)} devices")
+        self._start_executor()
         return True
 
+    def _start_executor(self):
+        # One thread per device, the blocking device calls of different axes then run at the same time
+        if self.parallel and self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.device_list), thread_name_prefix="Stage")
+
     def disconnect(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
         self.connection.close()
 
-    def get_pos(self):
+    def _for_each(self, func, items: list) -> list:
         """
-        Get current position of all stages.
+        Calls func on every item, concurrently when parallel is set. Waits for all calls before raising the first error.
+        """
+        if self.executor is None or len(items) < 2:
+            return [func(item) for item in items]
+        # Each call runs in a copy of the caller's context, so it sees its context variables (e.g. the simulated timeline)
+        futures = [self.executor.submit(contextvars.copy_context().run, func, item) for item in items]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def get_pos(self, sync: bool = False):
+        """
+        Get current position of all stages. Returns the tracked positions, unless they are unknown or sync is set,
+        in which case the stages are queried over the serial line.
+        """
+        if sync or self.positions is None:
+            return self.sync_pos()
+        return list(self.positions)
+
+    def sync_pos(self):
+        """
+        Query the position of all stages and reset the tracked positions to them.
         """
         assert self.port_opened, "Device not connected yet. Use Stage_object.connect()"
-        unit = Units.LENGTH_MILLIMETRES
-        position = []
-        for device in self.device_list:
-            position.append(device.get_position(unit=unit))
-        return position
+        unit = self.unit_mm
+        position = self._for_each(lambda device: device.get_position(unit=unit), self.device_list)
+        self.positions = position
+        return list(position)
 
     def home(self):
         """
@@ -72,18 +120,20 @@ class StageMover:
         assert self.port_opened, "Device not connected yet. Use Stage_object.connect()"
         logging.info("Performing home operation")
         try:
-            for device in self.device_list:
-                device.home()
+            self._for_each(lambda device: device.home(), self.device_list)
             self.homed = True
-        except BinaryCommandFailedException as e:
+        except self.command_failed_exception as e:
             logging.critical(f"Home failed: {e}")
             logging.critical(f"Make sure the knobs on the stages are turned into neutral position.")
         except Exception as e:
             logging.critical(f"Home failed: {e}")
+        # Re-sync on the next get_pos, after a failed home the stages can be anywhere
+        self.positions = None
 
     def move(self, pos: float, device_name: str, mode: str = "absolute") -> float:
         """
         Move stage on axis "device_name" to "pos". Returns ended up position
+        Relative targets and limit clipping use the tracked positions, so no position query is sent.
         """
         device_index = self.device_names.index(device_name)
 
@@ -109,23 +159,35 @@ class StageMover:
         device = self.device_list[device_index]
         try:
             if mode == "absolute":
-                end_pos = device.move_absolute(position=float(pos), unit=Units.LENGTH_MILLIMETRES)
+                end_pos = device.move_absolute(position=float(pos), unit=self.unit_mm)
             elif mode == "relative":
-                end_pos = device.move_relative(position=float(pos), unit=Units.LENGTH_MILLIMETRES)
+                end_pos = device.move_relative(position=float(pos), unit=self.unit_mm)
             else:
                 logging.warning(f"Moving {device_name} with mode '{mode}' not found.")
-        except BinaryCommandFailedException as e:
+        except self.command_failed_exception as e:
             logging.warning(f"Movement exceeded maximum length of axis {device_name}. Please adjust the limits. {pos}, {mode}")
             logging.warning(f"Resulted in error: {e}")
-            end_pos = self.get_pos()[device_index]
+            # Only this axis is queried, in this thread: move runs on the pool workers when axes move concurrently
+            end_pos = device.get_position(unit=self.unit_mm)
+        except Exception:
+            self.positions = None
+            raise
+        if self.positions is not None:
+            self.positions[device_index] = end_pos
         return end_pos
 
 
     def move_all(self, pos_list: list, mode: str = "absolute") -> list:
-        end_pos = []
-        for device_name, pos in zip(self.device_names, pos_list):
-            end_pos.append(self.move(pos, device_name, mode))
-        return end_pos
+        return self.move_axes(dict(zip(self.device_names, pos_list)), mode)
+
+    def move_axes(self, targets: dict, mode: str = "absolute") -> list:
+        """
+        Move several axes, {device_name: pos}, and wait until all of them arrived. With parallel set all axes move
+        at once, so the move takes as long as the slowest axis. Returns the ended up positions in the order of targets.
+        """
+        if mode == "relative":
+            self.get_pos()  # make sure the tracked positions are known before the axes move concurrently
+        return self._for_each(lambda target: self.move(target[1], target[0], mode), list(targets.items()))
 
 
 class DeltaTemplate(Template):
@@ -158,11 +220,20 @@ class StageGridMover:
         z_min: 45,
         z_max: 55,
         z_n: 10,
+        path: "serpentine",  # raster, serpentine or nearest
+        axis_order: "zxy",  # outer loop first, or auto
+        progress_interval: 1,  # s between progress lines
     }
     """
 
-    def __init__(self, stage_mover: StageMover, settings: dict):
+    SCAN_LOG_COLUMNS = ("time", "iteration", "x_index", "y_index", "z_index", "x", "y", "z", "move_time")
+
+    def __init__(self, stage_mover: StageMover, settings: dict, metrics: ScanMetrics = None, scan_log: ScanLog = None):
         self.stage_mover = stage_mover
+        # Per-point record of every visited point, with the columns SCAN_LOG_COLUMNS
+        self.scan_log: ScanLog = scan_log
+        # Times the phases "move" and "log" of every point, and "process" and "wait" of pipelined runs
+        self.metrics: ScanMetrics = metrics if metrics is not None else ScanMetrics(enabled=False)
         self.x_min: float = settings["x_min"]
         self.y_min: float = settings["y_min"]
         self.z_min: float = settings["z_min"]
@@ -172,28 +243,152 @@ class StageGridMover:
         self.x_n: float = settings["x_n"]
         self.y_n: float = settings["y_n"]
         self.z_n: float = settings["z_n"]
+        self.path: str = settings["path"]
+        self.axis_order: str = settings["axis_order"]
+        self.progress_interval: float = settings["progress_interval"]  # s between progress lines
+
+    def grid_shape(self) -> tuple:
+        return int(self.x_n), int(self.y_n), int(self.z_n)
 
-    def run_grid(self, func):
-        x_grid = np.linspace(self.x_min, self.x_max, int(self.x_n))
-        y_grid = np.linspace(self.y_min, self.y_max, int(self.y_n))
-        z_grid = np.linspace(self.z_min, self.z_max, int(self.z_n))
+    def grid_axes(self) -> list:
+        return [np.linspace(self.x_min, self.x_max, int(self.x_n)),
+                np.linspace(self.y_min, self.y_max, int(self.y_n)),
+                np.linspace(self.z_min, self.z_max, int(self.z_n))]
+
+    def plan_path(self, grid_indices=None, keep_order: bool = False) -> np.ndarray:
+        """
+        Returns the (N, 3) grid indices in visiting order and logs the predicted travel.
+        The "path" setting selects "raster" or "serpentine" traversal of the full grid in "axis_order"
+        (outer loop first, e.g. "zxy", or "auto" for the fastest order given the stage speeds),
+        or "nearest" for a nearest neighbour path. A sparse list of grid indices is visited nearest neighbour,
+        or in the given order with keep_order (e.g. the rest of an interrupted path).
+        """
+        grid_axes = self.grid_axes()
+        if grid_indices is not None and keep_order:
+            path = np.asarray(grid_indices, dtype=int).reshape(-1, 3)
+            path_name = "given"
+        elif grid_indices is not None or self.path == "nearest":
+            if grid_indices is None:
+                grid_indices = grid_path(self.grid_shape(), serpentine=False)
+            grid_indices = np.asarray(grid_indices, dtype=int).reshape(-1, 3)
+            path = grid_indices[nearest_neighbour_path(grid_positions(grid_indices, grid_axes))]
+            path_name = "nearest"
+        else:
+            if self.axis_order == "auto":
+                axis_order = best_axis_order(self.grid_shape(), grid_axes, self.stage_mover.speeds,
+                                             self.path == "serpentine", self.stage_mover.parallel)
+            else:
+                axis_order = parse_axis_order(self.axis_order)
+            path = grid_path(self.grid_shape(), axis_order, self.path == "serpentine")
+            path_name = f"{self.path} {''.join(AXIS_NAMES[axis] for axis in axis_order)}"
+        # Targets outside the stage range are clipped by StageMover.move, so predict with clipped positions
+        positions = np.clip(grid_positions(path, grid_axes), 0, self.stage_mover.max_lengths)
+        log_path_prediction(path_name, positions, self.stage_mover.speeds, concurrent=self.stage_mover.parallel)
+        return path
+
+    def visit_grid(self, grid_indices=None, keep_order: bool = False):
+        """
+        Moves the stages along the planned path, yielding (position, grid_index) once the stages arrived at a point,
+        with position = [x, y, z] in mm and grid_index = (x index, y index, z index) into grid_shape().
+        Only the axes whose coordinate changed are moved. grid_indices restricts the run to these points, see plan_path.
+        Progress and the estimated time left are logged every progress_interval seconds and at the last point,
+        every point goes to the scan log if one is set.
+        """
+        grid_axes = self.grid_axes()
+        path = self.plan_path(grid_indices, keep_order)
 
         start_time = datetime.now()
-        total_iterations = self.x_n * self.y_n * self.z_n
+        last_progress = time.perf_counter()
+        total_iterations = len(path)
         logging.info("Starting grid measurement")
-        iteration = 0
-        for z in z_grid:
-            self.stage_mover.move(z, "z")
-            for x in x_grid:
-                self.stage_mover.move(x, "x")
-                for y in y_grid:
-                    iteration += 1
-                    self.stage_mover.move(y, "y")
+        previous_index = None
+        for iteration, grid_index in enumerate(path, start=1):
+            grid_index = tuple(int(i) for i in grid_index)
+            position = [float(grid_axes[axis][grid_index[axis]]) for axis in range(3)]
+            move_start = time.perf_counter()
+            self.stage_mover.move_axes({AXIS_NAMES[axis]: position[axis] for axis in (2, 0, 1)
+                                        if previous_index is None or previous_index[axis] != grid_index[axis]})
+            now = time.perf_counter()
+            self.metrics.record("move", now - move_start)
+            previous_index = grid_index
+            with self.metrics.phase("log"):
+                x, y, z = position
+                if self.scan_log is not None:
+                    self.scan_log.write(f"{time.time():.6f}", iteration, *grid_index, x, y, z, f"{now - move_start:.6f}")
+                if now - last_progress >= self.progress_interval or iteration == total_iterations:
+                    last_progress = now
                     time_passed = datetime.now() - start_time
                     time_left = time_passed * total_iterations / iteration - time_passed
                     logging.info(
                         f"Position: ({x:04f}, {y:04f}, {z:04f}), Iteration: {iteration}/{total_iterations}, Time passed: {strfdelta(time_passed, '%H:%M:%S')}, Estimated time left: {strfdelta(time_left, '%H:%M:%S')}")
-                    func([x, y, z])
+            yield position, grid_index
+
+    def run_grid(self, func, grid_indices=None, keep_order: bool = False):
+        """
+        Calls func(position, grid_index) on every grid point, or on grid_indices only, see visit_grid.
+        """
+        for position, grid_index in self.visit_grid(grid_indices, keep_order):
+            func(position, grid_index)
+
+    def run_grid_pipelined(self, acquire, process, max_pending: int = 2, grid_indices=None, keep_order: bool = False,
+                           while_moving=None) -> dict:
+        """
+        Pipelined version of run_grid. On every grid point acquire(position, grid_index) runs on the calling thread,
+        after which process(acquired, position, grid_index) is handed to a worker thread while the stages already
+        move on to the next point. At most max_pending points wait for processing before the stages hold back.
+        The moves themselves run on a second worker, so while_moving() (e.g. drawing the live plot, which has to
+        stay on the calling thread) runs during every move instead of adding to the time at a point.
+        Returns the time spent per stage in seconds; "overlap" is the time hidden by running stages concurrently.
+        """
+        timings = {"move": 0., "acquire": 0., "process": 0., "wait": 0.}
+
+        def timed_process(acquired, position, grid_index):
+            start = time.perf_counter()
+            process(acquired, position, grid_index)
+            duration = time.perf_counter() - start
+            timings["process"] += duration
+            self.metrics.record("process", duration)
+
+        start_time = time.perf_counter()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ScanProcess") as executor, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix="ScanMove") as mover:
+            points = self.visit_grid(grid_indices, keep_order)
+            while True:
+                start = time.perf_counter()
+                # The worker runs in a copy of this thread's context, see StageMover._for_each
+                next_point = mover.submit(contextvars.copy_context().run, next, points, None)
+                if while_moving is not None:
+                    while_moving()
+                point = next_point.result()
+                timings["move"] += time.perf_counter() - start
+                if point is None:
+                    break
+                position, grid_index = point
+
+                start = time.perf_counter()
+                acquired = acquire(position, grid_index)
+                timings["acquire"] += time.perf_counter() - start
+
+                pending.append(executor.submit(timed_process, acquired, position, grid_index))
+                start = time.perf_counter()
+                while len(pending) > max_pending or (pending and pending[0].done()):
+                    pending.popleft().result()  # raises errors of the processing stage in the scan thread
+                duration = time.perf_counter() - start
+                timings["wait"] += duration
+                self.metrics.record("wait", duration)
+
+            start = time.perf_counter()
+            while pending:
+                pending.popleft().result()
+            timings["wait"] += time.perf_counter() - start
+
+        timings["total"] = time.perf_counter() - start_time
+        timings["overlap"] = max(0., timings["move"] + timings["acquire"] + timings["process"] - timings["total"])
+        logging.info(
+            f"Pipelined grid finished in {timings['total']:.2f} s: move {timings['move']:.2f} s, acquire {timings['acquire']:.2f} s, "
+            f"process {timings['process']:.2f} s, waited on processing {timings['wait']:.2f} s, hidden by overlap {timings['overlap']:.2f} s")
+        return timings
 
 
 class StageCalibrator:
@@ -206,7 +401,14 @@ class StageCalibrator:
         self.measure_function = measure_function
         self.stagemover = stagemover
 
-    def rough_calibration(self):
+    def rough_calibration(self, edge_accuracy: float = None):
+        """
+        Finds the bean edges in -x, +x, -y and +y, returns [x_min, x_max, y_min, y_max].
+        With calibration mode "bisection" the edges are searched to edge_accuracy mm (default from the settings),
+        with mode "linear" the stages walk outwards in steps of rough_step_size.
+        """
+        if edge_accuracy is None:
+            edge_accuracy = self.settings["edge_accuracy"]
         self.start_positions = self.stagemover.get_pos()
         self.stagemover.home()
 
@@ -217,7 +419,10 @@ class StageCalibrator:
             for direction in [False, True]:
                 self.stagemover.move_all(self.middle_positions)
                 logging.info(f"Calibrating {self.stagemover.device_names[device_id]} +")
-                offset, _, _ = self.calibrate_axis(device_id, direction)
+                if self.settings["mode"] == "bisection":
+                    offset, _, _ = self.calibrate_axis_bisection(device_id, direction, edge_accuracy)
+                else:
+                    offset, _, _ = self.calibrate_axis(device_id, direction)
                 calibrated_positions.append(offset)
                 middlepos = middlepos + offset / 2
             self.middle_positions[device_id] = middlepos
@@ -263,40 +468,60 @@ class StageCalibrator:
 
         return last_offset, energies_passed, offsets_passed
 
+    def calibrate_axis_bisection(self, device_id: int, direction: bool = True, edge_accuracy: float = 0.1):
+        """
+        Same result as calibrate_axis, the outermost position still below margin * background energy,
+        but found with far fewer measurements: the background reference is measured once at the search limit,
+        the edge is bracketed with coarse_step_size steps and then bisected until the bracket is edge_accuracy wide.
+        """
+        device_name = self.stagemover.device_names[device_id]
+        sign = 1 if direction else -1
+        start = self.stagemover.get_pos()[device_id]
+        limit = self.start_positions[device_id] + sign * self.settings["max_deviation_from_center"]
+        energies = []
+        offsets = []
 
-def create_folder_if_not_exists(folder_path):
-    # Check if the folder exists
-    if not os.path.exists(folder_path):
-        try:
-            # Create the folder if it doesn't exist
-            os.makedirs(folder_path)
-            logging.info(f"Folder '{folder_path}' created successfully.")
-        except OSError as e:
-            logging.critical(f"Failed to create folder '{folder_path}': {e}")
-    else:
-        logging.debug(f"Folder '{folder_path}' already exists, no new one created.")
-
-
-def configure_logger():
-    create_folder_if_not_exists("./logs")
-    filename_time = datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
-    file_handler = logging.FileHandler(f'./logs/log_{filename_time}.log')
-    file_handler.setLevel(logging.DEBUG)  # Set the file handler level to capture all levels
-
-    file_handler_warning = logging.FileHandler(f'./logs/warnlog_{filename_time}.log')
-    file_handler_warning.setLevel(logging.WARNING)  # Set the file handler level to capture all levels
+        def measure_at(pos):
+            pos = self.stagemover.move(pos, device_name)
+            energy = self.measure_function().energy()
+            energies.append(energy)
+            offsets.append(pos)
+            logging.debug(f"{device_name}: {pos} mm, energy {energy}")
+            return pos, energy
+
+        limit, background_energy = measure_at(limit)
+        background_energies = [background_energy] + [self.measure_function().energy()
+                                                     for _ in range(self.settings["background_measurements"] - 1)]
+        energy_margin = self.settings["margin"] * np.mean(background_energies)
+
+        inside, energy = measure_at(start)
+        if energy >= energy_margin:
+            logging.warning(f"Calibration of {device_name} started outside the bean, energy {energy} >= {energy_margin}")
+            return inside, np.array([]), np.array([])
+
+        # Bracket the edge between the last position inside and the first position outside the bean
+        outside = limit
+        pos = inside + sign * self.settings["coarse_step_size"]
+        while sign * (limit - pos) > 0:
+            pos, energy = measure_at(pos)
+            if energy >= energy_margin:
+                outside = pos
+                break
+            inside = pos
+            pos = inside + sign * self.settings["coarse_step_size"]
 
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
+        while abs(outside - inside) > edge_accuracy:
+            pos, energy = measure_at((inside + outside) / 2)
+            if energy >= energy_margin:
+                outside = pos
+            else:
+                inside = pos
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S')
-    file_handler.setFormatter(formatter)
-    file_handler_warning.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-    logging.root.addHandler(file_handler)
-    logging.root.addHandler(file_handler_warning)
-    logging.root.addHandler(console_handler)
-    logging.root.setLevel(logging.DEBUG)
+        energies = np.array(energies)
+        offsets = np.array(offsets)
+        passed = energies < energy_margin
+        logging.info(f"Edge of {device_name} found at {inside} mm (+-{edge_accuracy} mm) after {len(energies) + len(background_energies) - 1} measurements")
+        return inside, energies[passed], offsets[passed]
 
 
 if __name__ == "__main__":
@@ -312,6 +537,9 @@ if __name__ == "__main__":
         "z_min": 22,
         "z_max": 22,
         "z_n": 1,
+        "path": "serpentine",
+        "axis_order": "zxy",
+        "progress_interval": 1,
     }
 
     stagemover_settings = {
@@ -319,6 +547,8 @@ if __name__ == "__main__":
         "device_names": ["x", "y", "z"],
         "max_lenghts": [140, 140, 45],
         "permutation": [2, 0, 1],
+        "speeds": [5, 5, 5],
+        "parallel": True,
     }
 
     try:
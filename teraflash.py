@@ -0,0 +1,43 @@
+import logging
+
+# Dependencies for Teraflash
+import sys
+sys.path.append("C:\\terasoft\\")
+from Devices.TeraFlashClient import TeraFlashClient
+
+
+class TFC(TeraFlashClient):
+    def __init__(self, teraflash_settings):
+        super().__init__(teraflash_settings["toptica_IP"])
+        self.teraflash_settings = teraflash_settings
+        self.averaging = teraflash_settings["TFC_AVERAGING"]
+
+    def connect_teraflash(self):
+        logging.info(f"Connecting...")
+        connection_result = self.connect()
+        logging.info(f"Connected")
+        return connection_result
+
+    def set_averaging(self, n):
+        # Kept for the trace timeout of the scans
+        self.averaging = int(n)
+        super().set_averaging(n)
+
+    def start_laser(self):
+        self.set_averaging(self.teraflash_settings["TFC_AVERAGING"])
+        if self.teraflash_settings["TRANSFER"] == "block":
+            self.set_block_transfer()
+        else:
+            self.set_sliding_transfer()
+        self.set_begin(self.teraflash_settings["TFC_BEGIN"])
+        self.set_range(self.teraflash_settings["TFC_RANGE"])
+        self.start(wait=True)
+        logging.info("Connected and started the laser")
+
+    def get_corrected_pulse(self):
+        return self.correct_offset(self.get_next_trace())
+
+    def correct_offset(self, pulse):
+        offset = pulse.E()[0:10].mean()
+        pulse.subtract_offset(offset)
+        return pulse
@@ -0,0 +1,29 @@
+import numpy as np
+
+from scanimage import ScanImageBuilder, axis_tolerance, grid_axis
+
+
+def test_jittered_grid_is_regular():
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.arange(5.), np.arange(4.))
+    x = x.ravel() + rng.uniform(-0.02, 0.02, x.size)
+    y = y.ravel() + rng.uniform(-0.02, 0.02, y.size)
+    builder = ScanImageBuilder(x, y)
+    assert builder.regular and builder.shape == (4, 5)
+
+
+def test_random_points_are_triangulated():
+    rng = np.random.default_rng(0)
+    builder = ScanImageBuilder(rng.uniform(0, 10, 50), rng.uniform(0, 10, 50))
+    assert not builder.regular
+
+
+def test_refined_lattice_keeps_every_line():
+    # 1 mm lattice refined to 0.25 mm between 5 and 6 mm, as an adaptive scan visits it
+    y = np.concatenate([np.arange(0, 10.01, 1.0), [5.25, 5.5, 5.75]])
+    assert axis_tolerance(y) < 0.25
+    assert len(grid_axis(y)[0]) == 14
+
+    x, y = np.meshgrid(np.arange(0, 4.01, 1.0), y)
+    builder = ScanImageBuilder(x.ravel(), y.ravel())
+    assert builder.shape == (14, 5)
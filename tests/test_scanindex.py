@@ -0,0 +1,46 @@
+import numpy as np
+
+from scanindex import load_scan_columns, parse_scan_index, resolve_feature
+
+
+def write_info(folder, lines):
+    path = folder / "scan.txt"
+    path.write_text("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+def test_parses_values_references_and_pulse_files(tmp_path):
+    info_path = write_info(tmp_path, [
+        "2024-01-15 12:00:00.000001_2.5_92.0,33.8,0.5",
+        "2024-01-15 12:00:01.000001_12-00-00/0_93.0,33.8,0.5",
+        r"2024-01-15 12:00:02.000001_C:\Users\x\pulses\pulse_001.dat_94.0,33.8,0.5",
+        "2024-01-15 12:00:03.000001_C:/Users/x/pulses/pulse002.dat_95.0,33.8,0.5",
+    ])
+    columns = parse_scan_index(info_path)
+    assert columns["x"].tolist() == [92., 93., 94., 95.]
+    assert columns["stores"].tolist() == ["12-00-00"]
+    assert columns["row"].tolist() == [-1, 0, -1, -1]
+    assert columns["files"].tolist() == ["", "", r"C:\Users\x\pulses\pulse_001.dat", "C:/Users/x/pulses/pulse002.dat"]
+    assert np.isnan(columns["inline_value"][1:]).all() and columns["inline_value"][0] == 2.5
+
+
+def test_pulse_files_resolve_to_nan(tmp_path, caplog):
+    info_path = write_info(tmp_path, [
+        "2024-01-15 12:00:00.000001_2.5_92.0,33.8,0.5",
+        r"2024-01-15 12:00:01.000001_C:\Users\x\pulses\pulse001.dat_93.0,33.8,0.5",
+    ])
+    values = resolve_feature(load_scan_columns(info_path), "energy", str(tmp_path / "pulses"))
+    assert values[0] == 2.5 and np.isnan(values[1])
+    assert "pulse001.dat" in caplog.text
+
+
+def test_background_points_have_energy_only(tmp_path):
+    info_path = write_info(tmp_path, [
+        "2024-01-15 12:00:00.000001_background=815.5_92.0,33.8,0.5",
+        "2024-01-15 12:00:01.000001_2.5_93.0,33.8,0.5",
+    ])
+    columns = load_scan_columns(info_path)
+    assert columns["background"].tolist() == [True, False]
+    assert resolve_feature(columns, "energy", str(tmp_path / "pulses")).tolist() == [815.5, 2.5]
+    peak_peak = resolve_feature(columns, "peak_peak", str(tmp_path / "pulses"))
+    assert np.isnan(peak_peak[0]) and peak_peak[1] == 2.5
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+
+from pulsestore import PulseStore
+from scanjournal import JOURNAL_FILE, ScanJournal
+from settings import get_settings
+
+
+def write_journal(folder, text):
+    with open(os.path.join(folder, JOURNAL_FILE), 'w') as file:
+        file.write(text)
+
+
+def test_completed_reads_journaled_points(tmp_path):
+    journal = ScanJournal(str(tmp_path))
+    journal.add((0, 1, 2))
+    journal.add(np.array([3, 4, 5]))
+    journal.flush()
+    assert journal.completed().tolist() == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_completed_without_journal_is_empty(tmp_path):
+    assert ScanJournal(str(tmp_path)).completed().shape == (0, 3)
+
+
+@pytest.mark.parametrize("cut_line", ["0,0,", "0,0", "0,", "0,0,1"])
+def test_completed_drops_line_cut_short(tmp_path, cut_line):
+    # "0,0,1" is "0,0,12" cut short, it must not be read as grid index (0, 0, 1)
+    write_journal(str(tmp_path), f"1,2,3\n4,5,6\n{cut_line}")
+    assert ScanJournal(str(tmp_path)).completed().tolist() == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_completed_skips_unreadable_lines(tmp_path):
+    write_journal(str(tmp_path), "1,2,3\n\n1,x,3\n1,2,3,4\n7,8,9\n")
+    assert ScanJournal(str(tmp_path)).completed().tolist() == [[1, 2, 3], [7, 8, 9]]
+
+
+class FlatPulse:
+    def t(self):
+        return np.arange(8.)
+
+    def E(self):
+        return np.ones(8)
+
+
+def test_missing_needs_journal_and_stored_trace(tmp_path):
+    store = PulseStore(str(tmp_path), grid_shape=(2, 2, 1))
+    store.write_at((0, 0, 0), FlatPulse())
+    store.write_at((1, 0, 0), FlatPulse())
+    store.flush()
+    # (1, 0, 0) is stored but not journaled, (0, 1, 0) journaled but not stored
+    write_journal(str(tmp_path), "0,0,0\n0,1,0\n")
+    path = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]])
+    assert ScanJournal(str(tmp_path)).missing(path, store).tolist() == [[1, 0, 0], [0, 1, 0], [1, 1, 0]]
+
+
+def simulated_settings(folder) -> dict:
+    settings = get_settings()
+    simulation = settings["simulation"]
+    simulation.update(enabled=True, time_scale=0., connect_time=0.)
+    center = simulation["bean_center"]
+    settings["stagegridmover"].update(x_min=center[0] - 5, x_max=center[0] + 5, x_n=4,
+                                      y_min=center[1] - 4, y_max=center[1] + 4, y_n=3,
+                                      z_min=center[2], z_max=center[2], z_n=1)
+    settings["general"].update(measurement_savefolder=str(folder), measurement_name="scan_info.txt",
+                               pulse_store_name="scan", live_plot=False, scan_metrics=False)
+    return settings
+
+
+def test_resume_completes_interrupted_scan(tmp_path):
+    from TFCCoffeebean import TFCCoffeeBean
+
+    bean = TFCCoffeeBean(simulated_settings(tmp_path))
+    bean.connect_teraflash()
+    bean.connect_stagemover()
+    stage = bean.simulation.stages[0]
+    move_absolute = stage.move_absolute
+    moves = []
+
+    def failing_move(position, unit="s"):
+        moves.append(position)
+        if len(moves) == 6:
+            raise RuntimeError("serial link lost")
+        return move_absolute(position, unit)
+
+    stage.move_absolute = failing_move
+    with pytest.raises(RuntimeError):
+        bean.run_gridmover()
+    folder = bean.scan_cube.folder
+    interrupted = len(ScanJournal(folder).completed())
+    assert 0 < interrupted < 12
+
+    stage.move_absolute = move_absolute
+    resumed = TFCCoffeeBean(simulated_settings(tmp_path), simulation=bean.simulation)
+    resumed.connect_teraflash()
+    resumed.connect_stagemover()
+    try:
+        resumed.run_gridmover(resume_folder=folder)
+    finally:
+        bean.trace_hub.stop()
+        resumed.trace_hub.stop()
+
+    completed = ScanJournal(folder).completed()
+    assert len(completed) == 12
+    assert len({tuple(index) for index in completed}) == 12
+    assert PulseStore(folder).written_mask().all()
@@ -0,0 +1,82 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from arraypulse import ArrayPulse
+from pulsestore import PulseStore
+from tracecodec import (PackedTraces, _RowColumn, check_codec, decode_chunk, encode_chunk, pack_store, row_scales,
+                        unpack_store)
+
+
+def codec_settings():
+    for trace_dtype, trace_filter, compressor in itertools.product(("int16", "float32"), ("none", "shuffle", "delta"),
+                                                                   ("none", "zlib", "lzma")):
+        settings = {"trace_dtype": trace_dtype, "filter": trace_filter, "compressor": compressor, "level": 6,
+                    "chunk_rows": 4}
+        try:
+            check_codec(settings)
+        except ValueError:
+            continue
+        yield settings
+
+
+def traces(rows: int = 10, samples: int = 300) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    t = np.linspace(-5, 10, samples)
+    amplitudes = rng.uniform(0.1, 200, (rows, 1))
+    E = -amplitudes * t * np.exp(-t ** 2) + rng.normal(0, 0.5, (rows, samples))
+    E[1] = 0.  # a row without signal has no scale to derive
+    return E
+
+
+def documented_bound(E: np.ndarray, settings: dict) -> np.ndarray:
+    # The bounds of the tracecodec docstring
+    if settings["trace_dtype"] == "int16":
+        return np.broadcast_to(np.abs(E).max(axis=1, keepdims=True) / 65534, E.shape)
+    return np.abs(E) * 2. ** -24
+
+
+@pytest.mark.parametrize("settings", list(codec_settings()), ids=lambda s: f"{s['trace_dtype']}-{s['filter']}-{s['compressor']}")
+def test_round_trip_within_documented_bound(settings):
+    E = traces()
+    scales = row_scales(E)
+    decoded = decode_chunk(encode_chunk(E, settings, scales), settings, E.shape, scales)
+    assert (np.abs(decoded - E) <= documented_bound(E, settings) * (1 + 1e-9)).all()
+
+
+def test_filters_are_lossless():
+    E = traces()
+    scales = row_scales(E)
+    decoded = []
+    for trace_filter in ("none", "shuffle", "delta"):
+        settings = {"trace_dtype": "int16", "filter": trace_filter, "compressor": "zlib", "level": 6}
+        decoded.append(decode_chunk(encode_chunk(E, settings, scales), settings, E.shape, scales))
+    assert np.array_equal(decoded[0], decoded[1]) and np.array_equal(decoded[0], decoded[2])
+
+
+def test_pack_and_unpack_store(tmp_path):
+    E = traces()
+    t = np.linspace(0, 15, E.shape[1])
+    store = PulseStore(str(tmp_path))
+    for row in E:
+        store.append(ArrayPulse(t, row))
+    store.close()
+    settings = {"trace_dtype": "int16", "filter": "delta", "compressor": "zlib", "level": 6, "chunk_rows": 4}
+    pack_store(str(tmp_path), settings)
+
+    columns = PulseStore.load(str(tmp_path))
+    assert isinstance(columns["E"], PackedTraces)
+    bound = documented_bound(E, settings)
+    assert (np.abs(columns["E"][[7, 2]] - E[[7, 2]]) <= bound[[7, 2]]).all()
+    assert (np.abs(np.asarray(columns["E"]) - E) <= bound).all()
+    assert np.array_equal(columns["t"][3], t)
+
+    unpack_store(str(tmp_path))
+    columns = PulseStore.load(str(tmp_path))
+    assert (np.abs(columns["E"] - E) <= bound).all()
+
+
+def test_row_column_needs_rows():
+    with pytest.raises(TypeError):
+        _RowColumn((2, 3))
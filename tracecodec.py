@@ -0,0 +1,302 @@
+"""
+Compact encoding of the traces of a finished pulse store.
+
+pack_store replaces t.npy and E.npy of a store by
+    time_bases.npy       (k, samples)  every distinct time axis once, usually k = 1 for a whole scan
+    time_base_index.npy  (rows,)       time axis of every row
+    scales.npy           (rows,)       int16 scale of every row (trace_dtype "int16" only)
+    E.packed             the field, in chunks of chunk_rows rows, each compressed on its own
+    packed.json          the encoding and the byte offset of every chunk
+The other columns stay as they are. PulseStore.load reads packed stores transparently: "E" and "t" become
+row-indexed views that only decode the chunks of the rows that are accessed.
+
+Encodings of the field:
+    trace_dtype "int16"     every row is scaled by max|E| / 32767 and rounded,
+                            |E - decoded| <= max|E of the row| / 65534 for every sample
+    trace_dtype "float32"   |E - decoded| <= |E| * 2**-24 for every sample
+    filter "shuffle"        groups the bytes of the samples by significance before compressing (lossless)
+    filter "delta"          int16 only: stores sample differences (modulo 2**16, lossless), then shuffles
+    compressor              "zlib", "lzma" or "none", level is the zlib level or the lzma preset
+Both error bounds are far below the noise of a single TeraFlash trace.
+"""
+import json
+import logging
+from abc import ABC, abstractmethod
+import lzma
+import os
+import zlib
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from pulsestore import PulseStore
+
+PACKED_TRACES_FILE = "E.packed"
+INT16_MAX = 32767
+
+
+def _shuffle(data: np.ndarray) -> bytes:
+    return np.ascontiguousarray(data.view(np.uint8).reshape(-1, data.itemsize).T).tobytes()
+
+
+def _unshuffle(data: bytes, dtype, shape: tuple) -> np.ndarray:
+    itemsize = np.dtype(dtype).itemsize
+    raw = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T
+    return np.ascontiguousarray(raw).view(dtype).reshape(shape)
+
+
+def _compress(data: bytes, compressor: str, level: int) -> bytes:
+    if compressor == "zlib":
+        return zlib.compress(data, level)
+    if compressor == "lzma":
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def _decompress(data: bytes, compressor: str) -> bytes:
+    if compressor == "zlib":
+        return zlib.decompress(data)
+    if compressor == "lzma":
+        return lzma.decompress(data)
+    return data
+
+
+def check_codec(settings: dict):
+    if settings["trace_dtype"] not in ("int16", "float32"):
+        raise ValueError(f"Unknown trace dtype '{settings['trace_dtype']}', use int16 or float32")
+    if settings["filter"] not in ("none", "shuffle", "delta"):
+        raise ValueError(f"Unknown filter '{settings['filter']}', use none, shuffle or delta")
+    if settings["filter"] == "delta" and settings["trace_dtype"] != "int16":
+        raise ValueError("The delta filter is only lossless for int16 traces")
+    if settings["compressor"] not in ("none", "zlib", "lzma"):
+        raise ValueError(f"Unknown compressor '{settings['compressor']}', use none, zlib or lzma")
+
+
+def row_scales(E: np.ndarray) -> np.ndarray:
+    scales = np.abs(E).max(axis=1) / INT16_MAX
+    scales[scales == 0] = 1.
+    return scales
+
+
+def encode_chunk(E: np.ndarray, settings: dict, scales: np.ndarray = None) -> bytes:
+    """
+    Encodes the rows of E (rows, samples), with the int16 scales of the rows for trace_dtype "int16".
+    """
+    if settings["trace_dtype"] == "int16":
+        if not np.isfinite(E).all():
+            raise ValueError("Traces with NaN or infinite samples can only be stored as float32")
+        data = np.round(E / scales[:, None]).astype(np.int16)
+        if settings["filter"] == "delta":
+            # int16 arithmetic wraps around, decoding with an int16 cumsum wraps back exactly
+            data[:, 1:] -= data[:, :-1].copy()
+    else:
+        data = E.astype(np.float32)
+    data = _shuffle(data) if settings["filter"] != "none" else data.tobytes()
+    return _compress(data, settings["compressor"], settings["level"])
+
+
+def decode_chunk(data: bytes, settings: dict, shape: tuple, scales: np.ndarray = None) -> np.ndarray:
+    dtype = np.int16 if settings["trace_dtype"] == "int16" else np.float32
+    data = _decompress(data, settings["compressor"])
+    if settings["filter"] != "none":
+        values = _unshuffle(data, dtype, shape)
+    else:
+        values = np.frombuffer(data, dtype=dtype).reshape(shape)
+    if settings["trace_dtype"] == "float32":
+        return values.astype(np.float64)
+    if settings["filter"] == "delta":
+        values = np.cumsum(values, axis=1, dtype=np.int16)
+    return values * scales[:, None]
+
+
+def error_bound(E: np.ndarray, settings: dict) -> np.ndarray:
+    """
+    Largest absolute read-back error of every sample of E (rows, samples) in the given encoding.
+    """
+    if settings["trace_dtype"] == "int16":
+        return np.broadcast_to((row_scales(E) / 2)[:, None], E.shape)
+    return np.abs(E) * 2. ** -24
+
+
+def is_packed(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, PulseStore.PACKED_FILE))
+
+
+def pack_store(folder: str, settings: dict, verify: bool = True) -> dict:
+    """
+    Packs the traces of a finished pulse store with the encoding in settings (trace_dtype, filter, compressor,
+    level, chunk_rows) and deletes t.npy and E.npy. With verify every chunk is decoded again and checked
+    against the error bound before anything is deleted.
+    Returns the sizes in bytes of the traces before ("raw") and after ("packed").
+    """
+    if is_packed(folder):
+        logging.info(f"Pulse store {folder} is already packed")
+        return {}
+    check_codec(settings)
+    columns = PulseStore.load(folder)
+    E, t = columns["E"], columns["t"]
+    rows, samples = E.shape
+    written = ~np.isnan(columns["timestamps"])
+
+    try:
+        time_bases, time_base_index = np.unique(np.asarray(t[written]).reshape(-1, samples), axis=0, return_inverse=True) \
+            if written.any() else (np.zeros((1, samples)), np.zeros(0, dtype=np.int64))
+        index = np.zeros(rows, dtype=np.int32)
+        index[written] = np.asarray(time_base_index).ravel()
+        np.save(os.path.join(folder, "time_bases.npy"), time_bases)
+        np.save(os.path.join(folder, "time_base_index.npy"), index)
+
+        scales = np.ones(rows)
+        offsets = [0]
+        chunk_rows = int(settings["chunk_rows"])
+        with open(os.path.join(folder, PACKED_TRACES_FILE), 'wb') as file:
+            for start in range(0, rows, chunk_rows):
+                chunk = np.asarray(E[start:start + chunk_rows], dtype=np.float64)
+                chunk_scales = row_scales(chunk)
+                scales[start:start + chunk_rows] = chunk_scales
+                data = encode_chunk(chunk, settings, chunk_scales)
+                if verify:
+                    error = np.abs(decode_chunk(data, settings, chunk.shape, chunk_scales) - chunk)
+                    if (error > error_bound(chunk, settings) * (1 + 1e-6) + 1e-300).any():
+                        raise ValueError(f"Packing rows {start} to {start + len(chunk)} of {folder} exceeds the error bound")
+                file.write(data)
+                offsets.append(offsets[-1] + len(data))
+        if settings["trace_dtype"] == "int16":
+            np.save(os.path.join(folder, "scales.npy"), scales)
+    except Exception:
+        # The store stays unpacked, only the partial encoding is removed
+        _remove_packed_files(folder)
+        raise
+
+    packed = {key: settings[key] for key in ("trace_dtype", "filter", "compressor", "level")}
+    packed.update(chunk_rows=chunk_rows, rows=rows, samples=samples, offsets=offsets)
+    # packed.json is written last: a store is only packed once everything else is on disk
+    with open(os.path.join(folder, PulseStore.PACKED_FILE), 'w') as file:
+        json.dump(packed, file)
+    raw = sum(os.path.getsize(os.path.join(folder, f"{column}.npy")) for column in ("t", "E"))
+    del columns, E, t
+    for column in ("t", "E"):
+        os.remove(os.path.join(folder, f"{column}.npy"))
+    packed_size = offsets[-1] + sum(os.path.getsize(os.path.join(folder, name)) for name in
+                                    ("time_bases.npy", "time_base_index.npy", "scales.npy", PulseStore.PACKED_FILE)
+                                    if os.path.exists(os.path.join(folder, name)))
+    logging.info(f"Packed {rows} traces of {folder}: {raw / 1e6:.1f} MB -> {packed_size / 1e6:.1f} MB "
+                 f"({settings['trace_dtype']}, {settings['filter']}, {settings['compressor']})")
+    return {"raw": raw, "packed": packed_size}
+
+
+def unpack_store(folder: str):
+    """
+    Restores t.npy and E.npy of a packed store (within the error bound of its encoding), so it can be written again.
+    """
+    if not is_packed(folder):
+        return
+    traces = PackedTraces(folder)
+    time_axis = SharedTimeAxis(folder)
+    with open(os.path.join(folder, PulseStore.META_FILE), 'r') as file:
+        capacity = json.load(file)["capacity"]
+    shape = (max(capacity, traces.shape[0]), traces.shape[1])
+    E = open_memmap(os.path.join(folder, "E.npy"), mode="w+", dtype=np.float64, shape=shape)
+    t = open_memmap(os.path.join(folder, "t.npy"), mode="w+", dtype=np.float64, shape=shape)
+    for start in range(0, traces.shape[0], traces.chunk_rows):
+        stop = min(start + traces.chunk_rows, traces.shape[0])
+        E[start:stop] = traces[start:stop]
+        t[start:stop] = time_axis[start:stop]
+    E.flush()
+    t.flush()
+    del E, t
+    os.remove(os.path.join(folder, PulseStore.PACKED_FILE))
+    _remove_packed_files(folder)
+    logging.info(f"Unpacked {traces.shape[0]} traces of {folder}")
+
+
+def _remove_packed_files(folder: str):
+    for name in (PACKED_TRACES_FILE, "time_bases.npy", "time_base_index.npy", "scales.npy"):
+        if os.path.exists(os.path.join(folder, name)):
+            os.remove(os.path.join(folder, name))
+
+
+class _RowColumn(ABC):
+    """
+    Read-only (rows, samples) column that is indexed by row like a memory map, e.g. column[5], column[10:20],
+    column[rows, :100], and only materializes the requested rows. np.asarray(column) reads everything.
+    """
+    dtype = np.dtype(np.float64)
+    ndim = 2
+
+    def __init__(self, shape: tuple):
+        self.shape: tuple = shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    @abstractmethod
+    def _rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+        The (len(rows), samples) values of the given row indices.
+        """
+
+    def __getitem__(self, key):
+        row_key, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(row_key, (int, np.integer)):
+            return self._rows(np.arange(self.shape[0])[[row_key]])[0][rest]
+        return self._rows(np.arange(self.shape[0])[row_key])[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+
+class PackedTraces(_RowColumn):
+    """
+    The field of a packed store. Decodes the chunks of the requested rows, the last few decoded chunks are kept.
+    """
+
+    def __init__(self, folder: str, cached_chunks: int = 4):
+        with open(os.path.join(folder, PulseStore.PACKED_FILE), 'r') as file:
+            self.settings: dict = json.load(file)
+        super().__init__((self.settings["rows"], self.settings["samples"]))
+        self.path: str = os.path.join(folder, PACKED_TRACES_FILE)
+        self.chunk_rows: int = self.settings["chunk_rows"]
+        self.offsets: list = self.settings["offsets"]
+        scales_path = os.path.join(folder, "scales.npy")
+        self.scales: np.ndarray = np.load(scales_path) if os.path.exists(scales_path) else None
+        self.cached_chunks: int = cached_chunks
+        self._cache: dict = {}
+
+    def chunk(self, number: int) -> np.ndarray:
+        if number in self._cache:
+            return self._cache[number]
+        start = number * self.chunk_rows
+        stop = min(start + self.chunk_rows, self.shape[0])
+        with open(self.path, 'rb') as file:
+            file.seek(self.offsets[number])
+            data = file.read(self.offsets[number + 1] - self.offsets[number])
+        scales = None if self.scales is None else self.scales[start:stop]
+        chunk = decode_chunk(data, self.settings, (stop - start, self.shape[1]), scales)
+        if len(self._cache) >= self.cached_chunks:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[number] = chunk
+        return chunk
+
+    def _rows(self, rows: np.ndarray) -> np.ndarray:
+        values = np.empty((len(rows), self.shape[1]))
+        numbers = rows // self.chunk_rows
+        for number in np.unique(numbers):
+            selected = numbers == number
+            values[selected] = self.chunk(int(number))[rows[selected] - number * self.chunk_rows]
+        return values
+
+
+class SharedTimeAxis(_RowColumn):
+    """
+    The time axis of every row of a packed store, from the few distinct time axes it was packed with.
+    """
+
+    def __init__(self, folder: str):
+        self.time_bases: np.ndarray = np.load(os.path.join(folder, "time_bases.npy"))
+        self.index: np.ndarray = np.load(os.path.join(folder, "time_base_index.npy"))
+        super().__init__((len(self.index), self.time_bases.shape[1]))
+
+    def _rows(self, rows: np.ndarray) -> np.ndarray:
+        return self.time_bases[self.index[rows]]
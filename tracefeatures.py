@@ -0,0 +1,118 @@
+import logging
+import os
+
+import numpy as np
+
+from pulsestore import PulseStore
+
+FEATURES_FILE = "features.npz"
+DEFAULT_BANDS = [(0.1, 0.5), (0.5, 1.0), (1.0, 2.0), (2.0, 4.0)]  # THz
+
+
+def extract_features(E: np.ndarray, t: np.ndarray, bands: list = DEFAULT_BANDS, spectrum: bool = True) -> dict:
+    """
+    Computes the features of a stack of traces in one pass.
+    E holds one trace per row (N, samples), t is the shared time axis in ps (samples,).
+    Returns per trace:
+        energy       sum(E^2) * dt, the time-domain energy (TFPulse.energy may use a different scale)
+        peak_peak    E.max() - E.min()
+        peak_time    time of the largest absolute field in ps
+        band_power   (N, len(bands)) power spectrum summed over every [f_min, f_max) band in THz
+        spectrum     (N, samples // 2 + 1) power spectrum |rfft(E)|^2, only if spectrum is set
+    and the frequency axis of the spectrum in THz as "frequencies".
+    """
+    E = np.atleast_2d(np.asarray(E, dtype=np.float64))
+    t = np.asarray(t, dtype=np.float64)
+    dt = t[1] - t[0]
+
+    power_spectrum = np.abs(np.fft.rfft(E, axis=1)) ** 2
+    frequencies = np.fft.rfftfreq(E.shape[1], dt)
+    band_power = np.column_stack([power_spectrum[:, (frequencies >= f_min) & (frequencies < f_max)].sum(axis=1)
+                                  for f_min, f_max in bands]) if bands else np.empty((len(E), 0))
+
+    features = {
+        "energy": np.einsum("ij,ij->i", E, E) * dt,
+        "peak_peak": E.max(axis=1) - E.min(axis=1),
+        "peak_time": t[np.abs(E).argmax(axis=1)],
+        "band_power": band_power,
+        "frequencies": frequencies,
+    }
+    if spectrum:
+        features["spectrum"] = power_spectrum
+    return features
+
+
+def featurize_store(folder: str, bands: list = DEFAULT_BANDS, chunk_rows: int = 4096, save: bool = True) -> dict:
+    """
+    Computes the scalar features and band powers of every trace in a pulse store (or scan cube), chunk by chunk
+    straight from the memory maps, so the store never has to fit in memory.
+    Rows without a trace get NaN features. With save the result is written to features.npz inside the store.
+    """
+    rows = store_rows(folder)
+    features = empty_features(rows, bands)
+    for start in range(0, rows, chunk_rows):
+        add_features(features, featurize_rows(folder, start, min(start + chunk_rows, rows), bands))
+    if save:
+        save_features(folder, features)
+    return features
+
+
+def store_rows(folder: str) -> int:
+    return len(PulseStore.load(folder)["timestamps"])
+
+
+def empty_features(rows: int, bands: list = DEFAULT_BANDS) -> dict:
+    return {
+        "energy": np.full(rows, np.nan),
+        "peak_peak": np.full(rows, np.nan),
+        "peak_time": np.full(rows, np.nan),
+        "band_power": np.full((rows, len(bands)), np.nan),
+        "bands": np.asarray(bands, dtype=np.float64).reshape(-1, 2),
+    }
+
+
+def featurize_rows(folder: str, start: int, stop: int, bands: list = DEFAULT_BANDS) -> dict:
+    """
+    Features of the rows start to stop of a pulse store, for the rows that hold a trace:
+    their row indices as "rows" and the features as in extract_features, without the spectrum.
+    Independent of other chunks, so chunks of one store can be computed in separate processes.
+    """
+    columns = PulseStore.load(folder)
+    written = np.flatnonzero(~np.isnan(columns["timestamps"][start:stop])) + start
+    chunk_features = {"rows": written}
+    if len(written) == 0:
+        return chunk_features
+    time_axis = np.asarray(columns["t"][written[0]])
+    chunk_features.update(extract_features(columns["E"][written], time_axis, bands, spectrum=False))
+    return chunk_features
+
+
+def add_features(features: dict, chunk_features: dict):
+    """
+    Fills the features of one chunk from featurize_rows into the features of the whole store.
+    """
+    rows = chunk_features["rows"]
+    if len(rows) == 0:
+        return
+    for name in ("energy", "peak_peak", "peak_time", "band_power"):
+        features[name][rows] = chunk_features[name]
+
+
+def save_features(folder: str, features: dict):
+    np.savez(os.path.join(folder, FEATURES_FILE), **features)
+    written = int(np.count_nonzero(~np.isnan(features["energy"])))
+    logging.info(f"Features of {written} traces saved to {os.path.join(folder, FEATURES_FILE)}")
+
+
+def features_up_to_date(folder: str) -> bool:
+    """
+    Whether features.npz of a pulse store exists and is not older than the store.
+    """
+    features_path = os.path.join(folder, FEATURES_FILE)
+    meta_path = os.path.join(folder, PulseStore.META_FILE)
+    return os.path.exists(features_path) and os.path.getmtime(features_path) >= os.path.getmtime(meta_path)
+
+
+def load_features(folder: str) -> dict:
+    with np.load(os.path.join(folder, FEATURES_FILE)) as data:
+        return {name: data[name] for name in data.files}
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def decimate_minmax(x: np.ndarray, y: np.ndarray, max_points: int):
+    """
+    Reduces a curve to at most max_points points by splitting it into max_points / 2 bins and keeping the
+    minimum and maximum of every bin, in the order they occur. Peaks stay visible, unlike with plain subsampling.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n_bins = max(max_points // 2, 1)
+    if len(y) <= max_points or len(y) < 2 * n_bins:
+        return x, y
+    bin_size = len(y) // n_bins
+    used = n_bins * bin_size
+    bins = y[:used].reshape(n_bins, bin_size)
+    offsets = np.arange(n_bins) * bin_size
+    arg_min = bins.argmin(axis=1) + offsets
+    arg_max = bins.argmax(axis=1) + offsets
+    indices = np.column_stack([np.minimum(arg_min, arg_max), np.maximum(arg_min, arg_max)]).ravel()
+    if used < len(y):
+        indices = np.append(indices, len(y) - 1)
+    return x[indices], y[indices]
+
+
+class TraceFrame:
+    """
+    Everything the live view shows of one trace, computed off the GUI thread:
+    the (decimated) pulse and spectrum curves, the energy and the peak-peak value.
+    """
+
+    def __init__(self, pulse, max_points: int = 2000):
+        self.pulse = pulse
+        field = pulse.E()
+        self.t, self.E = decimate_minmax(pulse.t(), field, max_points)
+        self.f, self.S = decimate_minmax(pulse.f(), pulse.S(), max_points)
+        self.energy: float = pulse.energy()
+        self.peak_peak: float = field.max() - field.min()
@@ -1,37 +1,20 @@
 import matplotlib.pyplot as plt
-from datetime import datetime
-from scipy.interpolate import griddata
-import numpy as np
+from scanindex import load_scan_index
+from scanimage import image_builder
 
 # File path
 file_path = './measurements/2023-12-15/15-49-54.txt'  # Replace with your file path
 
-# Lists to store x, y, and z values
-x_values = []
-y_values = []
-z_values = []
-measurements = []
-
 try:
-    # Open the file and read lines
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
+    # Parsed columns are cached next to the file, pulse references resolve to their stored energy
+    scan = load_scan_index(file_path)
+    x_values = scan["x"]
+    y_values = scan["y"]
+    z_values = scan["z"]
+    measurements = scan["values"]
 
-        # Extract data from each line
-        for line in lines:
-            parts = line.strip().split('_')
-            date_str, measurement_str, pos_str = parts
-            x_str, y_str, z_str = pos_str.split(',')
-            # Convert date string to datetime object
-            date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S.%f')
-            x_values.append(float(x_str))
-            y_values.append(float(y_str))
-            z_values.append(float(z_str))
-            measurements.append(float(measurement_str))
-    x_linspace = np.sort(list(set(x_values)))
-    y_linspace = np.sort(list(set(y_values)))
-    x_mesh, y_mesh = np.meshgrid(x_linspace, y_linspace)
-    image_data = griddata((x_values, y_values), measurements, (x_mesh, y_mesh), method='linear', fill_value=0)
+    # Regular grids are placed by index, scattered points are triangulated once per point set
+    image_data = image_builder(x_values, y_values).image(measurements)
     # Create the plot
     plt.figure(figsize=(10, 6))
     plt.imshow(image_data, cmap='viridis', label='Measurement Values')
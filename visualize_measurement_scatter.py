@@ -1,31 +1,16 @@
 import matplotlib.pyplot as plt
-from datetime import datetime
+from scanindex import load_scan_index
 
 # File path
 file_path = './measurements/2023-12-15/15-49-54.txt'  # Replace with your file path
 
-# Lists to store x, y, and z values
-x_values = []
-y_values = []
-z_values = []
-measurements = []
-
 try:
-    # Open the file and read lines
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-        # Extract data from each line
-        for line in lines:
-            parts = line.strip().split('_')
-            date_str, measurement_str, pos_str = parts
-            x_str, y_str, z_str = pos_str.split(',')
-            # Convert date string to datetime object
-            date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S.%f')
-            x_values.append(float(x_str))
-            y_values.append(float(y_str))
-            z_values.append(float(z_str))
-            measurements.append(float(measurement_str))
+    # Parsed columns are cached next to the file, pulse references resolve to their stored energy
+    scan = load_scan_index(file_path)
+    x_values = scan["x"]
+    y_values = scan["y"]
+    z_values = scan["z"]
+    measurements = scan["values"]
 
     # Create the plot
     plt.figure(figsize=(10, 6))